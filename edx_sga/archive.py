@@ -0,0 +1,903 @@
+"""
+Building zip archives of student submissions
+"""
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+import zipfile
+from collections import deque
+from fnmatch import fnmatch
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Count, Max
+from edx_sga.constants import (ARCHIVE_BUILD_TIMEOUT, ARCHIVE_CHUNK_SIZE, ARCHIVE_DEFLATE_MIMETYPES,
+                               ARCHIVE_FETCH_WORKERS, ARCHIVE_STATUS_CHECK_INTERVAL, ARCHIVE_STATUS_MAX_WAIT,
+                               ITEM_TYPE)
+from submissions.models import Submission
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # Not available on Windows
+    resource = None
+
+log = logging.getLogger(__name__)
+
+# ZipFile.open() can only write entries since python 3.6
+ZIP_STREAMING_WRITES = sys.version_info >= (3, 6)
+COMPRESSION_NAMES = {
+    zipfile.ZIP_STORED: 'stored',
+    zipfile.ZIP_DEFLATED: 'deflated',
+}
+# Sizes of the zip structures around each entry, besides its name: local header with its ZIP64 extra
+# field, data descriptor, and central directory record with its ZIP64 extra field
+ZIP_LOCAL_ENTRY_OVERHEAD = 30 + 20 + 24
+ZIP_CENTRAL_ENTRY_OVERHEAD = 46 + 28
+# Size of the end of central directory records, including the ZIP64 ones
+ZIP_END_OVERHEAD = 22 + 56 + 20
+
+
+def get_peak_memory_kb():
+    """
+    Returns the peak resident set size of the current process in kilobytes, or None if it is unknown
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def submission_arcname(username, submission_file_path):
+    """
+    Returns the name of a submission file inside the archive
+    """
+    return '{}_{}'.format(username, os.path.basename(submission_file_path))
+
+
+class _CountingReader(object):
+    """
+    Wraps a file object and counts the bytes read from it
+    """
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        """
+        Reads from the wrapped file
+        """
+        data = self.file_obj.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def get_fetch_workers():
+    """
+    Returns the number of submissions fetched from storage concurrently while building an archive
+    """
+    return max(1, int(getattr(settings, 'SGA_ARCHIVE_FETCH_WORKERS', ARCHIVE_FETCH_WORKERS)))
+
+
+def get_compress_type(filename):
+    """
+    Returns the zipfile compression constant for a submission file. Files whose mimetype matches
+    one of the SGA_ARCHIVE_DEFLATE_MIMETYPES patterns, or whose mimetype is unknown, are deflated.
+    Other files are usually compressed already (PDF, images, office documents, video), so they are stored.
+    """
+    mimetype = mimetypes.guess_type(filename)[0]
+    if mimetype is None:
+        return zipfile.ZIP_DEFLATED
+    deflate_mimetypes = getattr(settings, 'SGA_ARCHIVE_DEFLATE_MIMETYPES', ARCHIVE_DEFLATE_MIMETYPES)
+    if any(fnmatch(mimetype, pattern) for pattern in deflate_mimetypes):
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
+
+
+def fetch_submission(submission_file_path, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    Copies a submission file from default_storage into a local temporary file.
+    Files larger than chunk_size are spooled to disk rather than kept in memory.
+
+    Args:
+        submission_file_path (str): Path of the file in default_storage
+        chunk_size (int): Maximum number of bytes held in memory
+
+    Returns:
+        file: A temporary file positioned at its start, to be closed by the caller
+    """
+    local_copy = tempfile.SpooledTemporaryFile(max_size=chunk_size)
+    try:
+        with default_storage.open(submission_file_path, 'rb') as submission_file:
+            shutil.copyfileobj(submission_file, local_copy, chunk_size)
+        local_copy.seek(0)
+    except Exception:
+        local_copy.close()
+        raise
+    return local_copy
+
+
+def iter_fetched_submissions(submission_file_paths, workers=1, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    Fetches submission files from default_storage using a pool of threads. At most twice as many
+    files as there are workers are fetched ahead of the consumer, and files are yielded in the
+    order of submission_file_paths whatever order the fetches complete in.
+
+    Args:
+        submission_file_paths (iterable): Paths of the files in default_storage
+        workers (int): Number of files fetched concurrently. 1 fetches them one after another.
+        chunk_size (int): Maximum number of bytes of each file held in memory
+
+    Yields:
+        file: Temporary copy of each file (see fetch_submission), to be closed by the consumer
+    """
+    if workers <= 1:
+        for submission_file_path in submission_file_paths:
+            yield fetch_submission(submission_file_path, chunk_size)
+        return
+
+    remaining = iter(submission_file_paths)
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for submission_file_path in islice(remaining, workers * 2):
+            pending.append(pool.apply_async(fetch_submission, (submission_file_path, chunk_size)))
+        while pending:
+            local_copy = pending.popleft().get()
+            for submission_file_path in islice(remaining, 1):
+                pending.append(pool.apply_async(fetch_submission, (submission_file_path, chunk_size)))
+            yield local_copy
+    finally:
+        pool.terminate()
+        pool.join()
+        # Clean up any prefetched files if the consumer stopped early
+        for result in pending:
+            if result.ready() and result.successful():
+                result.get().close()
+
+
+def write_zip_entry(zip_file, arcname, source, compress_type=zipfile.ZIP_DEFLATED, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    Copies a file object into a new entry of a zip file, at most chunk_size bytes at a time,
+    so that memory use does not depend on the size of the file.
+
+    Args:
+        zip_file (zipfile.ZipFile): A zip file opened for writing
+        arcname (str): Name of the entry in the archive
+        source (file): File object to read the contents of the entry from
+        compress_type (int): zipfile compression constant for the entry
+        chunk_size (int): Maximum number of bytes read from the source at once
+
+    Returns:
+        int: The number of bytes read from the source
+    """
+    reader = _CountingReader(source)
+    if ZIP_STREAMING_WRITES:
+        info = zipfile.ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+        info.compress_type = compress_type
+        info.external_attr = 0o644 << 16
+        # The size isn't known in advance, so always reserve room for ZIP64 sizes
+        with zip_file.open(info, 'w', force_zip64=True) as entry:
+            shutil.copyfileobj(reader, entry, chunk_size)
+    else:
+        # Older versions of zipfile can only add entries from a file on disk
+        with tempfile.NamedTemporaryFile() as spooled:
+            shutil.copyfileobj(reader, spooled, chunk_size)
+            spooled.flush()
+            zip_file.write(spooled.name, arcname, compress_type)
+    return reader.bytes_read
+
+
+def _iter_submission_files(student_submissions, chunk_size, workers):
+    """
+    Fetches submission files from storage concurrently
+
+    Yields:
+        tuple: The name of the file in the archive, its compression constant and its local copy,
+            to be closed by the consumer
+    """
+    fetched_submissions = iter_fetched_submissions(
+        (submission_file_path for _, _, submission_file_path in student_submissions),
+        workers=workers,
+        chunk_size=chunk_size
+    )
+    try:
+        for _, student_username, submission_file_path in student_submissions:
+            log.info(
+                "Creating zip file for student: %s, submission path: %s ",
+                student_username,
+                submission_file_path
+            )
+            yield (
+                submission_arcname(student_username, submission_file_path),
+                get_compress_type(submission_file_path),
+                next(fetched_submissions)
+            )
+    finally:
+        # Stops the fetch pool if writing the archive failed
+        fetched_submissions.close()
+
+
+def _add_submission_entry(
+        zip_pointer, arcname, compress_type, submission_file, compression, chunk_size, progress=None, offset=0
+):
+    """
+    Adds a fetched submission file to an open zip file, then closes it.
+    The number of files, bytes and seconds spent are added up in compression for each compression method,
+    and the progress of the build is published if there is an ArchiveProgress, offset being the size of
+    the archive parts already complete.
+    """
+    started = time.time()
+    with submission_file:
+        bytes_read = write_zip_entry(
+            zip_pointer,
+            arcname,
+            submission_file,
+            compress_type=compress_type,
+            chunk_size=chunk_size
+        )
+    stats = compression.setdefault(
+        COMPRESSION_NAMES[compress_type], {'files': 0, 'bytes_read': 0, 'seconds': 0}
+    )
+    stats['files'] += 1
+    stats['bytes_read'] += bytes_read
+    stats['seconds'] += time.time() - started
+    if progress is not None:
+        progress.advance(offset + zip_pointer.fp.tell())
+
+
+def _summarize_compression(compression):
+    """
+    Adds the throughput of each compression method to the stats collected by _add_submission_entry
+    """
+    for stats in compression.values():
+        stats['mb_per_second'] = None
+        if stats['seconds']:
+            stats['mb_per_second'] = round(stats['bytes_read'] / 2.0**20 / stats['seconds'], 1)
+        stats['seconds'] = round(stats['seconds'], 3)
+    return compression
+
+
+def _write_submission_entries(zip_pointer, student_submissions, chunk_size, workers, progress=None):
+    """
+    Adds submission files to an open zip file, fetching them from storage concurrently
+
+    Returns:
+        dict: For each compression method used, the number of files, bytes read from storage,
+            seconds spent writing them to the archive and throughput
+    """
+    compression = {}
+    submission_files = _iter_submission_files(student_submissions, chunk_size, workers)
+    try:
+        for arcname, compress_type, submission_file in submission_files:
+            _add_submission_entry(
+                zip_pointer, arcname, compress_type, submission_file, compression, chunk_size, progress
+            )
+    finally:
+        submission_files.close()
+    return _summarize_compression(compression)
+
+
+def write_submissions_archive(
+        destination, student_submissions, chunk_size=ARCHIVE_CHUNK_SIZE, workers=None, progress=None
+):
+    """
+    Writes a zip archive of submission files from default_storage to a file object.
+    Files are fetched from storage concurrently and written to the archive in order by a single writer.
+
+    Args:
+        destination (file): Writable, seekable file object receiving the archive
+        student_submissions (list): 3-element tuples of (submission uuid, student username, submission file path)
+        chunk_size (int): Maximum number of bytes of a submission held in memory at once
+        workers (int): Number of submissions fetched from storage concurrently,
+            defaults to the SGA_ARCHIVE_FETCH_WORKERS setting
+        progress (ArchiveProgress): Publishes the progress of the build after each file, if given
+
+    Returns:
+        dict: Metrics about the archive: number of files, bytes read from storage,
+            size of the archive, duration, fetch workers, peak memory of the process
+            and the throughput of each compression method
+    """
+    if workers is None:
+        workers = get_fetch_workers()
+    if progress is not None:
+        progress.start(len(student_submissions))
+    started = time.time()
+    with zipfile.ZipFile(destination, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zip_pointer:
+        compression = _write_submission_entries(zip_pointer, student_submissions, chunk_size, workers, progress)
+    destination.seek(0, os.SEEK_END)
+    return {
+        'files': len(student_submissions),
+        'bytes_read': sum(stats['bytes_read'] for stats in compression.values()),
+        'compression': compression,
+        'bytes_written': destination.tell(),
+        'seconds': round(time.time() - started, 3),
+        'workers': workers,
+        'peak_memory_kb': get_peak_memory_kb(),
+    }
+
+
+def get_archive_part_path(zip_file_path, number):
+    """
+    Returns the path of a numbered part of a multi-part submissions archive
+    """
+    root, extension = os.path.splitext(zip_file_path)
+    return '{}.part{:03d}{}'.format(root, number, extension)
+
+
+def _get_file_size(file_obj):
+    """
+    Returns the size of a seekable file, leaving it positioned at its start
+    """
+    file_obj.seek(0, os.SEEK_END)
+    size = file_obj.tell()
+    file_obj.seek(0)
+    return size
+
+
+class _ArchivePart(object):
+    """
+    A part of a multi-part submissions archive, built in a local temporary file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = tempfile.TemporaryFile()
+        self.zip_pointer = zipfile.ZipFile(self.file, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.central_directory_size = 0
+
+    @property
+    def files(self):
+        """
+        Number of entries in the part
+        """
+        return len(self.zip_pointer.filelist)
+
+    def projected_size(self, arcname, size):
+        """
+        Returns about how large the finished part would be with an extra entry of the given name and size
+        """
+        name_size = len(arcname.encode('utf-8'))
+        return (
+            self.file.tell() + self.central_directory_size + ZIP_END_OVERHEAD +
+            ZIP_LOCAL_ENTRY_OVERHEAD + ZIP_CENTRAL_ENTRY_OVERHEAD + 2 * name_size + size
+        )
+
+    def add(self, arcname, compress_type, submission_file, compression, chunk_size, progress=None, offset=0):
+        """
+        Adds a fetched submission file to the part
+        """
+        _add_submission_entry(
+            self.zip_pointer, arcname, compress_type, submission_file, compression, chunk_size, progress, offset
+        )
+        self.central_directory_size += ZIP_CENTRAL_ENTRY_OVERHEAD + len(arcname.encode('utf-8'))
+
+    def save(self):
+        """
+        Finishes the part and moves it to default_storage
+
+        Returns:
+            dict: The path of the part in default_storage, its number of files and its size
+        """
+        with self.file:
+            self.zip_pointer.close()
+            size = self.file.tell()
+            self.file.seek(0)
+            self.path = default_storage.save(self.path, self.file)
+        return {'path': self.path, 'files': self.files, 'size': size}
+
+    def discard(self):
+        """
+        Drops an unfinished part
+        """
+        self.file.close()
+
+
+def write_submissions_archive_parts(
+        zip_file_path, student_submissions, max_part_size, chunk_size=ARCHIVE_CHUNK_SIZE, workers=None, progress=None
+):
+    """
+    Writes submission files from default_storage into numbered zip archives of about max_part_size
+    bytes at most. Each part is moved to default_storage as soon as it is complete, so only one part
+    at a time takes local disk space. A file larger than max_part_size gets a part of its own.
+
+    Args:
+        zip_file_path (str): Path of the archive in default_storage, the parts are named after it
+        student_submissions (list): 3-element tuples of (submission uuid, student username, submission file path)
+        max_part_size (int): Size in bytes which parts should not exceed
+        chunk_size (int): Maximum number of bytes of a submission held in memory at once
+        workers (int): Number of submissions fetched from storage concurrently,
+            defaults to the SGA_ARCHIVE_FETCH_WORKERS setting
+        progress (ArchiveProgress): Publishes the progress of the build after each file, if given
+
+    Returns:
+        dict: Metrics about the archive as for write_submissions_archive, plus the path,
+            number of files and size of each part
+    """
+    if workers is None:
+        workers = get_fetch_workers()
+    if progress is not None:
+        progress.start(len(student_submissions))
+    started = time.time()
+    compression = {}
+    parts = []
+    part = None
+    submission_files = _iter_submission_files(student_submissions, chunk_size, workers)
+    try:
+        for arcname, compress_type, submission_file in submission_files:
+            size = _get_file_size(submission_file)
+            if part is not None and part.files and part.projected_size(arcname, size) > max_part_size:
+                parts.append(part.save())
+                part = None
+            if part is None:
+                part = _ArchivePart(get_archive_part_path(zip_file_path, len(parts) + 1))
+            part.add(
+                arcname, compress_type, submission_file, compression, chunk_size,
+                progress=progress, offset=sum(part_info['size'] for part_info in parts)
+            )
+        if part is not None:
+            parts.append(part.save())
+            part = None
+    finally:
+        submission_files.close()
+        if part is not None:
+            part.discard()
+
+    return {
+        'files': len(student_submissions),
+        'bytes_read': sum(stats['bytes_read'] for stats in compression.values()),
+        'compression': _summarize_compression(compression),
+        'bytes_written': sum(part_info['size'] for part_info in parts),
+        'parts': parts,
+        'seconds': round(time.time() - started, 3),
+        'workers': workers,
+        'peak_memory_kb': get_peak_memory_kb(),
+    }
+
+
+def get_manifest_path(zip_file_path):
+    """
+    Returns the path of the manifest stored next to a submissions archive
+    """
+    return '{}.manifest.json'.format(zip_file_path)
+
+
+def get_submissions_fingerprint(course_id, block_id):
+    """
+    Returns a token that changes whenever a submission to the block is made or removed.
+    It comes from a single aggregate query, so it is cheap enough to check on every download request.
+    """
+    # pylint: disable=no-member
+    submissions = Submission.objects.filter(
+        student_item__course_id=course_id,
+        student_item__item_id=block_id,
+        student_item__item_type=ITEM_TYPE
+    ).aggregate(count=Count('id'), last=Max('id'), submitted=Max('submitted_at'))
+    fingerprint = json.dumps(submissions, sort_keys=True, default=str)
+    return hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:16]
+
+
+def build_manifest(student_submissions, parts, fingerprint=None):
+    """
+    Returns the manifest of an archive holding the given submissions
+
+    Args:
+        student_submissions (list): 3-element tuples of (submission uuid, student username, submission file path)
+        parts (list): Paths in default_storage of the files making up the archive
+        fingerprint (str): Submissions fingerprint (see get_submissions_fingerprint) taken before listing them
+
+    Returns:
+        dict: The archive name of each submission keyed on its uuid, the archive files
+            and the fingerprint of the submissions
+    """
+    return {
+        'fingerprint': fingerprint,
+        'parts': parts,
+        'entries': {
+            submission_uuid: submission_arcname(student_username, submission_file_path)
+            for submission_uuid, student_username, submission_file_path in student_submissions
+        },
+    }
+
+
+def read_manifest(zip_file_path):
+    """
+    Returns the manifest of a submissions archive, or None if it is missing or unreadable
+    """
+    manifest_path = get_manifest_path(zip_file_path)
+    try:
+        with default_storage.open(manifest_path, 'rb') as manifest_file:
+            return json.loads(manifest_file.read().decode('utf-8'))
+    except (IOError, OSError):
+        return None
+    except ValueError:
+        log.warning("Ignoring invalid archive manifest at path: %s", manifest_path)
+        return None
+
+
+def is_archive_fresh(manifest, fingerprint):
+    """
+    Returns True if a submissions archive was built from submissions matching the given fingerprint.
+    The manifest is saved after the archive, so an archive without a manifest is never considered fresh.
+
+    Args:
+        manifest (dict): The manifest of the archive as returned by read_manifest, or None
+        fingerprint (str): The current submissions fingerprint
+    """
+    return manifest is not None and manifest.get('fingerprint') == fingerprint
+
+
+def get_archive_parts(manifest):
+    """
+    Returns the paths in default_storage of the files making up a submissions archive,
+    or an empty list if the archive is missing
+
+    Args:
+        manifest (dict): The manifest of the archive as returned by read_manifest, or None
+    """
+    return manifest.get('parts', []) if manifest is not None else []
+
+
+def save_manifest(zip_file_path, manifest):
+    """
+    Writes the manifest of a submissions archive, replacing any previous one
+    """
+    manifest_path = get_manifest_path(zip_file_path)
+    if default_storage.exists(manifest_path):
+        default_storage.delete(manifest_path)
+    default_storage.save(manifest_path, ContentFile(json.dumps(manifest).encode('utf-8')))
+
+
+def delete_archive(zip_file_path):
+    """
+    Deletes a submissions archive, all of its parts and its manifest
+    """
+    for path in (get_manifest_path(zip_file_path), zip_file_path):
+        if default_storage.exists(path):
+            default_storage.delete(path)
+    number = 1
+    part_path = get_archive_part_path(zip_file_path, number)
+    while default_storage.exists(part_path):
+        default_storage.delete(part_path)
+        number += 1
+        part_path = get_archive_part_path(zip_file_path, number)
+
+
+def _get_local_path(name):
+    """
+    Returns the local filesystem path of a file in default_storage, or None for remote storage
+    """
+    try:
+        return default_storage.path(name)
+    except NotImplementedError:
+        return None
+
+
+def _copy_zip_entries(source, destination, arcnames, chunk_size):
+    """
+    Copies entries of a zip file into another one, at most chunk_size bytes at a time
+
+    Args:
+        source (zipfile.ZipFile): A zip file opened for reading
+        destination (zipfile.ZipFile): A zip file opened for writing
+        arcnames (list): Names of the entries to copy
+        chunk_size (int): Maximum number of bytes of an entry held in memory at once
+    """
+    for arcname in arcnames:
+        info = source.getinfo(arcname)
+        with source.open(info) as entry:
+            write_zip_entry(destination, arcname, entry, info.compress_type, chunk_size)
+
+
+def _rewrite_zip_file(source_file, destination_file, removed_arcnames, added_submissions, chunk_size, workers,
+                      progress):
+    """
+    Writes a new zip archive holding the entries of an existing one, except for the removed ones,
+    followed by newly added submissions
+
+    Args:
+        source_file (file): The existing archive, opened for reading
+        destination_file (file): Writable, seekable file object receiving the new archive
+        removed_arcnames (list): Names of the entries to leave out
+        added_submissions (list): Submissions to add, as for write_submissions_archive
+        chunk_size (int): Maximum number of bytes of a submission held in memory at once
+        workers (int): Number of submissions fetched from storage concurrently
+        progress (ArchiveProgress): Publishes the progress of the update after each added file, or None
+
+    Returns:
+        dict: Compression metrics of the added entries, as for write_submissions_archive
+    """
+    removed_arcnames = set(removed_arcnames)
+    with zipfile.ZipFile(source_file) as source:
+        kept_arcnames = [arcname for arcname in source.namelist() if arcname not in removed_arcnames]
+        with zipfile.ZipFile(
+                destination_file, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True
+        ) as destination:
+            _copy_zip_entries(source, destination, kept_arcnames, chunk_size)
+            return _write_submission_entries(destination, added_submissions, chunk_size, workers, progress)
+
+
+def _open_stored_archive(zip_file_path, local_path, chunk_size):
+    """
+    Opens an archive in default_storage for reading. Archives on remote storage are
+    downloaded to a temporary file first, since reading a zip file needs random access.
+    """
+    if local_path is not None:
+        return open(local_path, 'rb')
+    stored_file = tempfile.TemporaryFile()
+    with default_storage.open(zip_file_path, 'rb') as remote_file:
+        shutil.copyfileobj(remote_file, stored_file, chunk_size)
+    stored_file.seek(0)
+    return stored_file
+
+
+def update_submissions_archive(
+        zip_file_path, student_submissions, fingerprint=None, chunk_size=ARCHIVE_CHUNK_SIZE, workers=None,
+        progress=None
+):
+    """
+    Brings an existing submissions archive up to date using its manifest, adding
+    new submissions and dropping the ones which were replaced or removed. Only added
+    submissions are fetched from storage. When nothing is dropped from an archive on
+    local storage, new entries are appended to it in place. Otherwise the entries which
+    are kept are copied into a new archive, which on remote storage means the whole
+    archive is downloaded and saved again. Multi-part archives are always rebuilt.
+
+    Args:
+        zip_file_path (str): Path of the archive in default_storage
+        student_submissions (list): 3-element tuples of (submission uuid, student username, submission file path)
+        fingerprint (str): Submissions fingerprint to record in the manifest
+        chunk_size (int): Maximum number of bytes of a submission held in memory at once
+        workers (int): Number of submissions fetched from storage concurrently,
+            defaults to the SGA_ARCHIVE_FETCH_WORKERS setting
+        progress (ArchiveProgress): Publishes the progress of the update after each added file, if given
+
+    Returns:
+        dict: Metrics about the archive as for write_submissions_archive, plus the number of
+            added and removed entries, or None if the archive has to be rebuilt from scratch
+    """
+    manifest = read_manifest(zip_file_path)
+    if get_archive_parts(manifest) != [zip_file_path] or not default_storage.exists(zip_file_path):
+        return None
+    archive_size = default_storage.size(zip_file_path)
+
+    if workers is None:
+        workers = get_fetch_workers()
+    started = time.time()
+    new_manifest = build_manifest(student_submissions, [zip_file_path], fingerprint=fingerprint)
+    archived, wanted = manifest['entries'], new_manifest['entries']
+    removed_arcnames = [
+        arcname for submission_uuid, arcname in archived.items()
+        if wanted.get(submission_uuid) != arcname
+    ]
+    added_submissions = [
+        submission for submission in student_submissions
+        if archived.get(submission[0]) != wanted[submission[0]]
+    ]
+    compression = {}
+    if progress is not None:
+        progress.start(len(added_submissions))
+    if removed_arcnames or added_submissions:
+        log.info(
+            "Updating archive at path: %s, adding %d and removing %d entries",
+            zip_file_path,
+            len(added_submissions),
+            len(removed_arcnames)
+        )
+        # Without a manifest the archive gets rebuilt, should the update be interrupted
+        default_storage.delete(get_manifest_path(zip_file_path))
+        local_path = _get_local_path(zip_file_path)
+        try:
+            if local_path is not None and not removed_arcnames:
+                with zipfile.ZipFile(
+                        local_path, 'a', compression=zipfile.ZIP_DEFLATED, allowZip64=True
+                ) as zip_pointer:
+                    compression = _write_submission_entries(
+                        zip_pointer, added_submissions, chunk_size, workers, progress
+                    )
+                archive_size = os.path.getsize(local_path)
+            else:
+                with tempfile.TemporaryFile() as zip_file:
+                    with _open_stored_archive(zip_file_path, local_path, chunk_size) as stored_file:
+                        compression = _rewrite_zip_file(
+                            stored_file, zip_file, removed_arcnames, added_submissions, chunk_size, workers,
+                            progress
+                        )
+                    archive_size = zip_file.tell()
+                    zip_file.seek(0)
+                    default_storage.delete(zip_file_path)
+                    default_storage.save(zip_file_path, zip_file)
+        except Exception:  # pylint: disable=broad-except
+            log.exception("Unable to update archive at path: %s, it will be rebuilt", zip_file_path)
+            delete_archive(zip_file_path)
+            return None
+    if new_manifest != manifest:
+        save_manifest(zip_file_path, new_manifest)
+
+    return {
+        'files': len(student_submissions),
+        'added': len(added_submissions),
+        'removed': len(removed_arcnames),
+        'bytes_read': sum(stats['bytes_read'] for stats in compression.values()),
+        'compression': compression,
+        'bytes_written': archive_size,
+        'seconds': round(time.time() - started, 3),
+        'workers': workers,
+        'peak_memory_kb': get_peak_memory_kb(),
+    }
+
+
+def _get_cache_key(kind, *parts):
+    """
+    Returns a cache key, hashed to stay short and free of characters memcached rejects
+    """
+    digest = hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+    return 'edx_sga.archive.{}.{}'.format(kind, digest)
+
+
+def get_build_timeout():
+    """
+    Returns the number of seconds after which an archive build is assumed to have died
+    """
+    return getattr(settings, 'SGA_ARCHIVE_BUILD_TIMEOUT', ARCHIVE_BUILD_TIMEOUT)
+
+
+def claim_archive_build(zip_file_path, fingerprint):
+    """
+    Records that a build of an archive from submissions matching a fingerprint was requested.
+
+    Returns:
+        bool: True if the caller should start the build, False if an identical build is already in flight
+    """
+    return cache.add(_get_cache_key('build', zip_file_path, fingerprint), True, get_build_timeout())
+
+
+def release_archive_build(zip_file_path, fingerprint):
+    """
+    Forgets a build claimed with claim_archive_build, once it finished or failed
+    """
+    cache.delete(_get_cache_key('build', zip_file_path, fingerprint))
+
+
+def acquire_archive_lock(zip_file_path):
+    """
+    Takes the lock which keeps workers from building the same archive at the same time
+
+    Returns:
+        str: A token to release the lock with, or None if another worker holds it
+    """
+    token = uuid.uuid4().hex
+    if cache.add(_get_cache_key('lock', zip_file_path), token, get_build_timeout()):
+        return token
+    return None
+
+
+def release_archive_lock(zip_file_path, token):
+    """
+    Releases a lock taken with acquire_archive_lock, unless it expired and was taken by another worker
+    """
+    lock_key = _get_cache_key('lock', zip_file_path)
+    if cache.get(lock_key) == token:
+        cache.delete(lock_key)
+
+
+class ArchiveProgress(object):
+    """
+    Publishes the progress of an archive build to the cache, where the status handler reads it
+    """
+    # Least number of seconds between two updates of the cache while files get added
+    publish_interval = 1
+
+    def __init__(self, zip_file_path):
+        self.key = get_progress_key(zip_file_path)
+        self.started = time.time()
+        self.published = 0
+        self.record = {
+            'state': 'queued',
+            'files_done': 0,
+            'files_total': None,
+            'bytes_written': 0,
+            'eta_seconds': None,
+            'error': None,
+        }
+
+    def _publish(self, **changes):
+        """
+        Updates the progress record and stores it in the cache
+        """
+        self.record.update(changes)
+        self.published = time.time()
+        cache.set(self.key, dict(self.record, updated=self.published), get_build_timeout())
+
+    def queue(self):
+        """
+        Records that the build was requested but no worker started it yet
+        """
+        self._publish(state='queued')
+
+    def start(self, files_total):
+        """
+        Records that a worker started adding files to the archive
+        """
+        self.started = time.time()
+        self._publish(state='running', files_done=0, files_total=files_total, bytes_written=0, eta_seconds=None)
+
+    def advance(self, bytes_written):
+        """
+        Records that a file was added to the archive, which is now bytes_written long
+        """
+        files_done = self.record['files_done'] + 1
+        files_total = self.record['files_total'] or files_done
+        elapsed = time.time() - self.started
+        self.record.update(
+            files_done=files_done,
+            bytes_written=bytes_written,
+            eta_seconds=int(round(elapsed / files_done * (files_total - files_done))),
+        )
+        if files_done == files_total or time.time() - self.published >= self.publish_interval:
+            self._publish()
+
+    def finish(self):
+        """
+        Records that the archive is complete
+        """
+        self._publish(state='done', eta_seconds=0)
+
+    def fail(self, reason):
+        """
+        Records that the build failed and why
+        """
+        self._publish(state='failed', eta_seconds=None, error=reason)
+
+
+def get_progress_key(zip_file_path):
+    """
+    Returns the cache key of the progress record of an archive build
+    """
+    return _get_cache_key('progress', zip_file_path)
+
+
+def get_archive_progress(zip_file_path):
+    """
+    Returns the latest progress record published by ArchiveProgress for an archive, or None
+    """
+    return cache.get(get_progress_key(zip_file_path))
+
+
+def get_status_max_wait():
+    """
+    Returns the longest number of seconds a status request may wait for archive progress
+    """
+    return getattr(settings, 'SGA_ARCHIVE_STATUS_MAX_WAIT', ARCHIVE_STATUS_MAX_WAIT)
+
+
+def wait_for_archive_progress(zip_file_path, since=None, timeout=0):
+    """
+    Returns the progress record of an archive once it was published later than since, the time of the
+    record the caller already has. Blocks for at most timeout seconds, reading only the cache while it waits.
+    """
+    deadline = time.time() + timeout
+    while True:
+        progress = get_archive_progress(zip_file_path)
+        if (
+                progress is None or
+                since is None or
+                progress['updated'] != since or
+                progress['state'] in ('done', 'failed') or
+                time.time() >= deadline
+        ):
+            return progress
+        time.sleep(min(ARCHIVE_STATUS_CHECK_INTERVAL, max(deadline - time.time(), 0)))
@@ -2,6 +2,37 @@
 
 BLOCK_SIZE = 2**10 * 8  # 8kb
 ITEM_TYPE = 'sga'
+ARCHIVE_CHUNK_SIZE = 2**20  # 1mb, largest piece of a submission held in memory while zipping
+ARCHIVE_FETCH_WORKERS = 4  # submissions fetched from storage concurrently while zipping
+# Submissions with these mimetypes are deflated in archives, others are already compressed and get stored
+ARCHIVE_DEFLATE_MIMETYPES = (
+    'text/*',
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'application/rtf',
+    'application/x-tex',
+    'application/x-sh',
+    'image/svg+xml',
+    'image/bmp',
+    'image/tiff',
+)
+ARCHIVE_BUILD_TIMEOUT = 2 * 60 * 60  # seconds after which an unfinished archive build is assumed dead
+ARCHIVE_LOCK_RETRY_DELAY = 30  # seconds before retrying a build while another one holds the archive
+ARCHIVE_STATUS_MAX_WAIT = 25  # longest a status request may wait for archive progress, in seconds
+ARCHIVE_STATUS_CHECK_INTERVAL = 0.5  # seconds between cache reads while a status request waits
+UPLOAD_CHUNK_SIZE = 2**20 * 8  # 8mb, size of the pieces large submissions are uploaded in
+UPLOAD_STAGING_TIMEOUT = 24 * 60 * 60  # seconds after which an unfinished chunked upload is discarded
+UPLOAD_LOCK_TIMEOUT = 10 * 60  # seconds after which the lock of a chunk being appended is assumed dead
+DIRECT_UPLOAD_EXPIRY = 15 * 60  # seconds a signed direct-to-storage upload target stays valid
+DOWNLOAD_CHUNK_SIZE = 2**16  # 64kb, first read of a download, and every read from local disk
+DOWNLOAD_MAX_CHUNK_SIZE = 2**22  # 4mb, reads from remote storage double up to this size
+DOWNLOAD_OFFLOAD_PREFIX = '/protected/'  # internal nginx location serving MEDIA_ROOT for X-Accel-Redirect
+GRADING_BATCH_SIZE = 500  # rows loaded per bulk query on the grading screen
+GRADING_PAGE_SIZE = 50
+GRADING_MAX_PAGE_SIZE = 500
+GRADING_SORT_KEYS = ('username', 'timestamp', 'score', 'finalized', 'needs_approval')
+GRADE_IMPORT_MAX_SIZE = 2**20 * 10  # 10mb, largest CSV file of grades accepted for import
 
 
 class ShowAnswer(object):
@@ -0,0 +1,111 @@
+"""
+Serving files from storage, with conditional and range requests
+"""
+from __future__ import absolute_import
+
+import hashlib
+
+import six.moves.urllib.parse
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from edx_sga.constants import DOWNLOAD_OFFLOAD_PREFIX
+from edx_sga.utils import StorageFileIter, get_local_path
+from webob import Request
+from webob.response import Response
+
+# Files are served from handler URLs which do not change along with them, so browsers may keep them
+# but must revalidate them against their ETag
+REVALIDATE_CACHE_CONTROL = 'private, no-cache'
+
+
+def get_etag(*parts):
+    """
+    Returns a strong ETag value derived from strings identifying the content of a file
+    """
+    return hashlib.sha1(u'\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def is_not_modified(request, etag):
+    """
+    True if the client sent the ETag of the version it already has in an If-None-Match header
+    """
+    return isinstance(request, Request) and etag in request.if_none_match
+
+
+def get_offload_header(path):
+    """
+    Returns the name and value of the header telling the web server to send a file from default_storage
+    itself, or None when SGA_DOWNLOAD_OFFLOAD is off or the storage is not on local disk.
+
+    SGA_DOWNLOAD_OFFLOAD is 'x-accel-redirect' for nginx, with an internal location at
+    SGA_DOWNLOAD_OFFLOAD_PREFIX serving MEDIA_ROOT, or 'x-sendfile' for Apache and lighttpd.
+    """
+    mode = getattr(settings, 'SGA_DOWNLOAD_OFFLOAD', None)
+    if not mode:
+        return None
+    local_path = get_local_path(path)
+    if local_path is None:
+        return None
+    if mode == 'x-sendfile':
+        return 'X-Sendfile', local_path
+    if mode == 'x-accel-redirect':
+        prefix = getattr(settings, 'SGA_DOWNLOAD_OFFLOAD_PREFIX', DOWNLOAD_OFFLOAD_PREFIX)
+        return 'X-Accel-Redirect', prefix.rstrip('/') + '/' + six.moves.urllib.parse.quote(path.encode('utf-8'))
+    raise ImproperlyConfigured("Unknown SGA_DOWNLOAD_OFFLOAD: {}".format(mode))
+
+
+def file_response(request, path, content_type, content_disposition, etag=None):
+    """
+    Returns a Response with a file from default_storage.
+
+    Answers 304 when the client already has the version identified by etag, and 206 with a single range of
+    the file when asked with a Range header, unless an If-Range header names another version.
+    With SGA_DOWNLOAD_OFFLOAD the web server sends the file, and answers range requests, instead.
+    Raises IOError or OSError when the file does not exist.
+    """
+    size = default_storage.size(path)
+    if not isinstance(request, Request):
+        # Called without an HTTP request, serve the whole file
+        request = Request.blank('/')
+
+    response = Response(content_type=content_type, content_disposition=content_disposition)
+    response.accept_ranges = 'bytes'
+    response.cache_control = REVALIDATE_CACHE_CONTROL
+    if etag is not None:
+        response.etag = etag
+        if is_not_modified(request, etag):
+            response.status = 304
+            del response.content_length
+            return response
+
+    offload_header = get_offload_header(path)
+    if offload_header is not None:
+        response.headers[offload_header[0]] = offload_header[1]
+        del response.content_length
+        return response
+
+    byte_range = request.range
+    if_range = request.headers.get('If-Range')
+    if (
+            byte_range is not None and
+            ',' not in request.headers.get('Range', '') and
+            (if_range is None or (etag is not None and if_range == '"{}"'.format(etag)))
+    ):
+        content_range = byte_range.range_for_length(size)
+        if content_range is None:
+            response.status = 416
+            response.headers['Content-Range'] = 'bytes */{}'.format(size)
+            del response.content_length
+            return response
+        start, stop = content_range
+        response.status = 206
+        response.content_range = (start, stop, size)
+        response.app_iter = StorageFileIter(path, start, stop)
+        response.content_length = stop - start
+        return response
+
+    response.app_iter = StorageFileIter(path)
+    response.content_length = size
+    return response
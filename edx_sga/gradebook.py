@@ -0,0 +1,279 @@
+"""
+Importing and exporting the grades of an SGA block as CSV files
+"""
+from __future__ import absolute_import
+
+import csv
+import io
+import json
+import logging
+
+import six
+
+from django.db import transaction
+from edx_sga.constants import GRADING_BATCH_SIZE
+from edx_sga.grading import StaffGradingDataLoader, _batches, touch_grading_data
+from lms.djangoapps.courseware.models import StudentModule
+from submissions import api as submissions_api
+
+log = logging.getLogger(__name__)
+
+GRADE_IMPORT_COLUMNS = ('username', 'score', 'comment')
+GRADE_EXPORT_COLUMNS = (
+    'username', 'fullname', 'timestamp', 'finalized', 'score', 'approval', 'comment', 'filename'
+)
+# Cells starting with these are run as formulas by spreadsheets
+CSV_FORMULA_PREFIXES = (u'=', u'+', u'-', u'@', u'\t', u'\r')
+
+
+class _Echo(object):
+    """
+    File-like object whose write returns what is written, so that a csv writer returns its rows
+    """
+    def write(self, value):  # pylint: disable=no-self-use
+        """
+        Returns the value instead of writing it
+        """
+        return value
+
+
+def decode_csv(content):
+    """
+    Returns the text of an uploaded CSV file, which must be encoded in UTF-8
+
+    Raises:
+        ValueError: if the file is not valid UTF-8
+    """
+    if isinstance(content, six.binary_type):
+        try:
+            return content.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            raise ValueError("The file must be encoded in UTF-8")
+    return content
+
+
+def read_csv(text):
+    """
+    Yields the rows of a CSV document as lists of text strings, on Python 2 and 3
+    """
+    if six.PY2:
+        # The Python 2 csv module only reads byte strings
+        lines = (line.encode('utf-8') for line in text.splitlines(True))
+        for row in csv.reader(lines):
+            yield [cell.decode('utf-8') for cell in row]
+    else:
+        for row in csv.reader(io.StringIO(text, newline='')):
+            yield row
+
+
+def escape_csv_cell(value):
+    """
+    Prefixes text which a spreadsheet would run as a formula with a quote, which it shows as text
+    """
+    if value.startswith(CSV_FORMULA_PREFIXES):
+        return u"'" + value
+    return value
+
+
+def unescape_csv_cell(value):
+    """
+    Removes the quote added by escape_csv_cell
+    """
+    if value.startswith(u"'") and value[1:].startswith(CSV_FORMULA_PREFIXES):
+        return value[1:]
+    return value
+
+
+def write_csv_row(row):
+    """
+    Returns a row of values as a line of CSV, encoded in UTF-8. None is written as an empty cell,
+    and text which could run as a formula, such as names chosen by students, is escaped.
+    """
+    cells = [
+        u'' if value is None else
+        escape_csv_cell(value) if isinstance(value, six.string_types) else
+        six.text_type(value)
+        for value in row
+    ]
+    if six.PY2:
+        return csv.writer(_Echo()).writerow([cell.encode('utf-8') for cell in cells])
+    return csv.writer(_Echo()).writerow(cells).encode('utf-8')
+
+
+def get_approval_state(row):
+    """
+    Returns whether the score of a grading row was approved by an instructor, awaits it, or is missing
+    """
+    if row['approved']:
+        return 'approved'
+    if row['score'] is not None:
+        return 'awaiting approval'
+    return ''
+
+
+def iter_grades_csv(block, batch_size=GRADING_BATCH_SIZE):
+    """
+    Yields the grading table of a block as CSV, a batch of rows at a time.
+
+    Rows come from StaffGradingDataLoader.iter_rows as they are loaded, so memory
+    use does not depend on the number of students.
+    """
+    yield write_csv_row(GRADE_EXPORT_COLUMNS)
+    rows = StaffGradingDataLoader(block, batch_size=batch_size).iter_rows()
+    for batch in _batches(rows, batch_size):
+        yield b''.join(
+            write_csv_row((
+                row['username'],
+                row['fullname'],
+                row['timestamp'],
+                'yes' if row['finalized'] else 'no',
+                row['score'],
+                get_approval_state(row),
+                row['comment'],
+                row['filename'],
+            ))
+            for row in batch
+        )
+
+
+class GradeImporter(object):
+    """
+    Imports grades for an SGA block from CSV rows of username, score and an optional comment.
+
+    The whole file is checked before anything is written: every row must be valid and name a
+    student who submitted to the block. Scores and student states are then written batch by
+    batch, in a single transaction.
+    """
+
+    def __init__(self, block, instructor=True, batch_size=GRADING_BATCH_SIZE):
+        self.block = block
+        self.instructor = instructor
+        self.batch_size = batch_size
+        self.loader = StaffGradingDataLoader(block, batch_size=batch_size)
+
+    def parse(self, text):
+        """
+        Returns the grades found in a CSV document, and the list of errors in it.
+
+        Each grade is a dict with the 'line', 'username', 'score' and 'comment' of a row.
+        The comment is None when the file has no comment column, so that comments are kept.
+        """
+        rows = read_csv(text)
+        header = [column.strip().lower() for column in next(rows, [])]
+        missing = [column for column in GRADE_IMPORT_COLUMNS[:2] if column not in header]
+        if missing:
+            return [], ["Missing column: {}".format(column) for column in missing]
+
+        max_score = self.block.max_score()
+        grades, errors, seen = [], [], {}
+        for line, row in enumerate(rows, 2):
+            if not any(cell.strip() for cell in row):
+                continue
+            values = dict(zip(header, (unescape_csv_cell(cell.strip()) for cell in row)))
+            username = values.get('username', '')
+            if not username:
+                errors.append("Line {}: missing username".format(line))
+                continue
+            if username in seen:
+                errors.append("Line {}: {} was already graded on line {}".format(line, username, seen[username]))
+                continue
+            seen[username] = line
+            try:
+                score = int(values.get('score', ''))
+            except ValueError:
+                errors.append("Line {}: score must be an integer".format(line))
+                continue
+            if not 0 <= score <= max_score:
+                errors.append("Line {}: score must be between 0 and {}".format(line, max_score))
+                continue
+            grades.append({
+                'line': line,
+                'username': username,
+                'score': score,
+                'comment': values.get('comment') if 'comment' in header else None,
+            })
+        return grades, errors
+
+    def match_students(self, grades):
+        """
+        Adds the 'user' and latest 'submission' of the student to each grade, and returns
+        the errors of the grades which cannot be applied.
+        """
+        by_username = {grade['username']: grade for grade in grades}
+        for batch in _batches(self.loader.latest_submissions(), self.batch_size):
+            users = self.loader.users_by_anonymous_id(
+                [submission['student_id'] for submission in batch]
+            )
+            for submission in batch:
+                user = users.get(submission['student_id'])
+                if user is not None and user.username in by_username:
+                    by_username[user.username].update(user=user, submission=submission)
+
+        errors = []
+        for grade in grades:
+            if 'submission' not in grade:
+                errors.append("Line {}: {} has no submission".format(grade['line'], grade['username']))
+        if not self.instructor:
+            # Like in the grading table, staff may not change grades approved by an instructor
+            submitted = [grade for grade in grades if 'submission' in grade]
+            for batch in _batches(submitted, self.batch_size):
+                scores = self.loader.scores_by_student_item(
+                    [grade['submission']['student_item'] for grade in batch]
+                )
+                for grade in batch:
+                    if grade['submission']['student_item'] in scores:
+                        errors.append("Line {}: the grade of {} was already approved".format(
+                            grade['line'], grade['username']
+                        ))
+        return errors
+
+    def apply(self, grades):
+        """
+        Saves the scores and comments of validated grades, in one transaction
+        """
+        max_score = self.block.max_score()
+        with transaction.atomic():
+            for batch in _batches(grades, self.batch_size):
+                student_modules = self.loader.student_modules_by_user(
+                    [grade['user'] for grade in batch]
+                )
+                for grade in batch:
+                    student_module = student_modules[grade['user'].id]
+                    state = json.loads(student_module.state)
+                    if self.instructor:
+                        submissions_api.set_score(grade['submission']['uuid'], grade['score'], max_score)
+                    else:
+                        state['staff_score'] = grade['score']
+                    if grade['comment'] is not None:
+                        state['comment'] = grade['comment']
+                    student_module.state = json.dumps(state)
+                    # Saved one by one, like enter_grade does, so that the state history and signals are kept
+                    student_module.save()
+        touch_grading_data(self.block)
+
+    def run(self, text, dry_run=False):
+        """
+        Validates a CSV document and, if it has no errors, imports its grades.
+
+        Returns:
+            dict: A report with the number of 'rows' with a grade, the number of grades 'imported'
+                and the list of 'errors'
+        """
+        grades, errors = self.parse(text)
+        if not errors:
+            errors = self.match_students(grades)
+        imported = 0
+        if not errors and not dry_run:
+            self.apply(grades)
+            imported = len(grades)
+            log.info(
+                "Imported %d grades for course:%s block:%s",
+                imported,
+                self.block.block_course_id,
+                self.block.block_id
+            )
+        return {
+            'rows': len(grades),
+            'imported': imported,
+            'errors': errors,
+        }
@@ -0,0 +1,444 @@
+"""
+Batched loading of the data shown on the staff grading screen
+"""
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+import uuid
+from itertools import islice
+
+import six
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import CharField, Count, F, Max, OuterRef, Subquery
+from django.db.models.functions import Lower
+from django.utils.encoding import force_text
+from edx_sga.constants import (GRADING_BATCH_SIZE, GRADING_MAX_PAGE_SIZE,
+                               GRADING_PAGE_SIZE, GRADING_SORT_KEYS, ITEM_TYPE)
+from edx_sga.utils import decode_cursor, is_finalized_submission
+from lms.djangoapps.courseware.models import StudentModule
+from student.models import AnonymousUserId
+from submissions import api as submissions_api
+from submissions.models import ScoreSummary, Submission
+from submissions.serializers import SubmissionSerializer
+from xblock.fields import DateTime
+
+log = logging.getLogger(__name__)
+
+
+def _batches(iterable, size):
+    """
+    Yields lists of at most `size` items from an iterable
+    """
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+# Database orderings matching the grading table's in-memory sort keys, for the columns which are stored
+DATABASE_SORTS = {
+    'username': (Lower('username'), F('username'), F('student_item__student_id')),
+    'timestamp': (F('created_at'), F('username'), F('student_item__student_id')),
+}
+
+
+def _serialize_submissions(submissions):
+    """
+    Yields a queryset of Submissions as dicts, like submissions_api.get_all_submissions does
+    """
+    for submission in submissions.iterator():
+        data = SubmissionSerializer(submission).data
+        data['student_id'] = submission.student_item.student_id
+        yield data
+
+
+class StaffGradingDataLoader(object):
+    """
+    Loads the rows of the staff grading table for an SGA block.
+
+    Instead of querying submissions, scores, users and student modules once per
+    student, submissions are read in batches and everything else needed for a batch
+    is fetched with one bulk query per model, then joined in memory.
+    """
+
+    def __init__(self, block, batch_size=GRADING_BATCH_SIZE):
+        self.block = block
+        self.batch_size = batch_size
+
+    def latest_submissions(self):
+        """
+        Returns an iterator over the most recent submission of every student of the block
+        """
+        return submissions_api.get_all_submissions(
+            self.block.block_course_id,
+            self.block.block_id,
+            ITEM_TYPE,
+            read_replica=False
+        )
+
+    def latest_submissions_query(self, username=None):
+        """
+        Returns a queryset of the most recent submission of every student of the block, annotated
+        with the username of the student, so that the grading table can be filtered, sorted and
+        sliced by the database. Students without a user are left out, as in iter_rows.
+
+        Args:
+            username (unicode): Only keep the students whose username contains it
+        """
+        latest = Submission.objects.filter(
+            student_item=OuterRef('student_item')
+        ).order_by('-submitted_at', '-id').values('id')[:1]
+        usernames = AnonymousUserId.objects.filter(
+            anonymous_user_id=OuterRef('student_item__student_id')
+        ).values('user__username')[:1]
+        submissions = Submission.objects.select_related('student_item').filter(
+            student_item__course_id=self.block.block_course_id,
+            student_item__item_id=self.block.block_id,
+            student_item__item_type=ITEM_TYPE
+        ).annotate(
+            latest_id=Subquery(latest),
+            username=Subquery(usernames, output_field=CharField())
+        ).filter(id=F('latest_id'), username__isnull=False)
+        if username:
+            submissions = submissions.filter(username__icontains=username)
+        return submissions
+
+    def scores_by_student_item(self, student_item_ids):
+        """
+        Returns a dict of student item id => points earned for the visible scores of some student items
+        """
+        summaries = ScoreSummary.objects.filter(
+            student_item_id__in=student_item_ids
+        ).select_related('latest')
+        return {
+            summary.student_item_id: summary.latest.points_earned
+            for summary in summaries
+            if not summary.latest.is_hidden()
+        }
+
+    def users_by_anonymous_id(self, anonymous_ids):
+        """
+        Returns a dict of anonymous id => User, with the profile of each user preloaded
+        """
+        anonymous_users = AnonymousUserId.objects.filter(
+            anonymous_user_id__in=anonymous_ids
+        ).select_related('user', 'user__profile')
+        return {
+            anonymous_user.anonymous_user_id: anonymous_user.user
+            for anonymous_user in anonymous_users
+        }
+
+    def student_modules_by_user(self, users):
+        """
+        Returns a dict of user id => StudentModule for this block, creating missing StudentModules
+        """
+        # pylint: disable=no-member
+        student_modules = {
+            student_module.student_id: student_module
+            for student_module in StudentModule.objects.filter(
+                course_id=self.block.course_id,
+                module_state_key=self.block.location,
+                student__in=users
+            )
+        }
+        for user in users:
+            if user.id not in student_modules:
+                student_modules[user.id] = self.block.get_or_create_student_module(user)
+            # Reuse the already loaded user instead of querying it again through the foreign key
+            student_modules[user.id].student = user
+        return student_modules
+
+    def iter_rows(self, submissions=None):
+        """
+        Yields a grading row for every student with a submission, one batch at a time.
+
+        Args:
+            submissions (iterable): Latest submission dicts (with a 'student_id' key) to build
+                rows for. Defaults to the latest submission of every student of the block.
+        """
+        if submissions is None:
+            submissions = self.latest_submissions()
+        instructor = self.block.is_instructor()
+        for batch in _batches(submissions, self.batch_size):
+            users = self.users_by_anonymous_id(
+                [submission['student_id'] for submission in batch]
+            )
+            student_modules = self.student_modules_by_user(list(users.values()))
+            scores = self.scores_by_student_item(
+                [submission['student_item'] for submission in batch]
+            )
+            for submission in batch:
+                user = users.get(submission['student_id'])
+                if user is None:
+                    log.warning(
+                        "Skipping submission %s of unknown student %s",
+                        submission['uuid'],
+                        submission['student_id']
+                    )
+                    continue
+                yield make_grading_row(
+                    submission,
+                    user,
+                    student_modules[user.id],
+                    scores.get(submission['student_item']),
+                    instructor
+                )
+
+    def row(self, student_id):
+        """
+        Returns the grading row of a single student, or None if the student has no submission
+        """
+        submission = self.block.get_submission(student_id)
+        if not submission:
+            return None
+        submission = dict(submission, student_id=student_id)
+        return next(self.iter_rows([submission]), None)
+
+    def page(self, query):
+        """
+        Returns the rows of a page of the grading table and the number of rows matching a query
+        built by parse_grading_query.
+
+        The username filter is always applied by the database. Pages sorted by username or
+        timestamp, without a finalized or needs_approval filter, are also ordered and sliced
+        there, so rows are only built for the students on the page. Sorting by score, finalized
+        or needs_approval, or filtering on the latter two, needs every matching row to be built
+        and sorted in memory.
+        """
+        submissions = self.latest_submissions_query(query.get('username'))
+        flags = [flag for flag in ('finalized', 'needs_approval') if query.get(flag) is not None]
+        if query['sort_by'] in DATABASE_SORTS and not flags:
+            ordering = DATABASE_SORTS[query['sort_by']]
+            offset = query['offset']
+            page_submissions = submissions.order_by(*[
+                field.desc() if query['order'] == 'desc' else field.asc() for field in ordering
+            ])[offset:offset + query['page_size']]
+            return list(self.iter_rows(_serialize_submissions(page_submissions))), submissions.count()
+
+        if query.get('username'):
+            rows = self.iter_rows(_serialize_submissions(submissions))
+        else:
+            rows = self.iter_rows()
+        return paginate_grading_rows(rows, dict(query, username=None))
+
+    def rows(self):
+        """
+        Returns the list of grading rows for the block, ordered by student item
+        """
+        submissions = sorted(
+            self.latest_submissions(),
+            key=lambda submission: submission['student_item']
+        )
+        return list(self.iter_rows(submissions))
+
+
+def _get_grading_token_key(block):
+    """
+    Returns the cache key of the token which grading_data_version mixes in for a block
+    """
+    digest = hashlib.sha1(u'{}\n{}'.format(block.block_course_id, block.block_id).encode('utf-8')).hexdigest()
+    return 'edx_sga.grading.token.{}'.format(digest)
+
+
+def touch_grading_data(block):
+    """
+    Changes the grading_data_version of a block, after its student states were written.
+
+    The modified time of a StudentModule has a one second resolution on MySQL, so two grades
+    entered within a second cannot be told apart from it. The token is replaced right away and
+    once more when the transaction commits, so a client which read the version in between does
+    not keep data from before the commit.
+    """
+    key = _get_grading_token_key(block)
+    cache.set(key, uuid.uuid4().hex, None)
+    transaction.on_commit(lambda: cache.set(key, uuid.uuid4().hex, None))
+
+
+def _get_grading_token(block):
+    """
+    Returns the token set by touch_grading_data. A token evicted from the cache is replaced
+    with a new one, which changes the version rather than bringing back an old one.
+    """
+    key = _get_grading_token_key(block)
+    token = cache.get(key)
+    if token is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        token = cache.get(key)
+    return token
+
+
+def grading_data_version(block):
+    """
+    Returns a token that changes whenever a submission, score or student state of the block changes.
+
+    It is computed from a few aggregate queries and the token set by touch_grading_data,
+    so clients can cheaply tell whether the grading data they hold is still current.
+    """
+    # pylint: disable=no-member
+    submissions = Submission.objects.filter(
+        student_item__course_id=block.block_course_id,
+        student_item__item_id=block.block_id
+    ).aggregate(count=Count('id'), last=Max('id'), submitted=Max('submitted_at'))
+    scores = ScoreSummary.objects.filter(
+        student_item__course_id=block.block_course_id,
+        student_item__item_id=block.block_id
+    ).aggregate(last=Max('latest'))
+    student_modules = StudentModule.objects.filter(
+        course_id=block.course_id,
+        module_state_key=block.location
+    ).aggregate(count=Count('id'), modified=Max('modified'))
+    fingerprint = json.dumps(
+        [submissions, scores, student_modules, block.max_score(), _get_grading_token(block)],
+        sort_keys=True,
+        default=str
+    )
+    return hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:16]
+
+
+def make_grading_row(submission, user, student_module, score, instructor):
+    """
+    Returns a dict of student assignment information along with annotated file name,
+    student id and module id, this information will be used on grading screen
+
+    Args:
+        submission (dict): The latest submission of the student
+        user (User): The student, with its profile
+        student_module (StudentModule): The student's state for the block
+        score (int): Points earned by the student, or None if no score was published
+        instructor (bool): Whether the grader is an instructor
+    """
+    state = json.loads(student_module.state)
+    approved = score is not None
+    if score is None:
+        score = state.get('staff_score')
+        needs_approval = score is not None
+    else:
+        needs_approval = False
+
+    filename, user_response = None, None
+    if "filename" in submission['answer'].keys():
+        filename = submission['answer']['filename']
+    if "user_response" in submission['answer'].keys():
+        user_response = submission['answer']['user_response']
+
+    return {
+        'module_id': student_module.id,
+        'student_id': submission['student_id'],
+        'submission_id': submission['uuid'],
+        'username': user.username,
+        'fullname': user.profile.name,
+        'filename': filename,
+        'user_response': user_response,
+        'timestamp': submission['created_at'].strftime(
+            DateTime.DATETIME_FORMAT
+        ),
+        'score': score,
+        'approved': approved,
+        'needs_approval': instructor and needs_approval,
+        'may_grade': instructor or not approved,
+        'annotated': force_text(state.get("annotated_filename", '')),
+        'comment': force_text(state.get("comment", '')),
+        'finalized': is_finalized_submission(submission_data=submission)
+    }
+
+
+def _parse_flag(value):
+    """
+    Parses an optional boolean filter value
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        return value
+    if not isinstance(value, six.string_types):
+        raise ValueError("Invalid boolean filter: {}".format(value))
+    if value.lower() in ('true', '1', 'yes'):
+        return True
+    if value.lower() in ('false', '0', 'no'):
+        return False
+    raise ValueError("Invalid boolean filter: {}".format(value))
+
+
+def parse_grading_query(params):
+    """
+    Builds a grading table query from request parameters, or from the cursor they contain.
+
+    Raises:
+        ValueError: if a parameter or the cursor is invalid
+    """
+    if params.get('cursor'):
+        params = decode_cursor(params['cursor'])
+    try:
+        page_size = int(params.get('page_size') or GRADING_PAGE_SIZE)
+        offset = int(params.get('offset') or 0)
+    except (TypeError, ValueError):
+        raise ValueError("page_size and offset must be integers")
+    if not 0 < page_size <= GRADING_MAX_PAGE_SIZE or offset < 0:
+        raise ValueError("Invalid page_size or offset")
+    sort_by = params.get('sort_by') or 'timestamp'
+    if sort_by not in GRADING_SORT_KEYS:
+        raise ValueError("Cannot sort by {}".format(sort_by))
+    order = params.get('order') or 'desc'
+    if order not in ('asc', 'desc'):
+        raise ValueError("order must be asc or desc")
+    username = params.get('username') or None
+    if username is not None and not isinstance(username, six.string_types):
+        raise ValueError("Invalid username filter: {}".format(username))
+    return {
+        'sort_by': sort_by,
+        'order': order,
+        'offset': offset,
+        'page_size': page_size,
+        'username': username,
+        'finalized': _parse_flag(params.get('finalized')),
+        'needs_approval': _parse_flag(params.get('needs_approval')),
+    }
+
+
+def _sort_key(sort_by):
+    """
+    Returns a function computing the sort key of a grading row for a sortable column
+    """
+    def key(row):
+        """
+        Sorts missing values first and breaks ties by username, so pages stay stable
+        """
+        if sort_by == 'username':
+            value = row['username'].lower()
+        else:
+            value = row[sort_by]
+        return (value is not None, value, row['username'], row['student_id'])
+    return key
+
+
+def paginate_grading_rows(rows, query):
+    """
+    Filters, sorts and slices grading rows according to a grading table query.
+
+    Args:
+        rows (iterable): Grading rows as built by make_grading_row
+        query (dict): A query as returned by parse_grading_query, with 'sort_by', 'order', 'offset',
+            'page_size' and optional 'username', 'finalized' and 'needs_approval' filters
+
+    Returns:
+        (list, int): The rows of the requested page and the number of rows matching the filters
+    """
+    username = query.get('username')
+    if username:
+        username = username.lower()
+        rows = (row for row in rows if username in row['username'].lower())
+    for flag in ('finalized', 'needs_approval'):
+        if query.get(flag) is not None:
+            rows = (row for row in rows if row[flag] is query[flag])
+    rows = sorted(
+        rows,
+        key=_sort_key(query['sort_by']),
+        reverse=query['order'] == 'desc'
+    )
+    offset = query['offset']
+    return rows[offset:offset + query['page_size']], len(rows)
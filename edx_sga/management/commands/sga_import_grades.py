@@ -0,0 +1,55 @@
+"""
+Django command which imports the grades of an SGA block from a CSV file with
+username, score and comment columns. Scores are set as an instructor would.
+"""
+from __future__ import absolute_import
+
+import io
+
+from django.core.management.base import BaseCommand, CommandError
+from edx_sga.gradebook import GradeImporter
+from opaque_keys import InvalidKeyError
+from opaque_keys.edx.keys import UsageKey
+from xmodule.modulestore.django import modulestore
+from xmodule.modulestore.exceptions import ItemNotFoundError
+
+
+class Command(BaseCommand):
+    """
+    Imports the grades of an SGA block from a CSV file.
+    """
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument('block_id', help='Usage id of the SGA block')
+        parser.add_argument('csv_file', help='Path of the CSV file of grades')
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only check the file, without saving any grade'
+        )
+
+    def handle(self, *args, **options):
+        """
+        Validates the file, then imports its grades.
+        """
+        try:
+            usage_key = UsageKey.from_string(options['block_id'])
+            block = modulestore().get_item(usage_key)
+        except (InvalidKeyError, ItemNotFoundError):
+            raise CommandError('Unknown block: {}'.format(options['block_id']))
+        if usage_key.block_type != 'edx_sga':
+            raise CommandError('Not an SGA block: {}'.format(options['block_id']))
+        try:
+            with io.open(options['csv_file'], encoding='utf-8-sig') as csv_file:
+                text = csv_file.read()
+        except (IOError, UnicodeDecodeError) as ex:
+            raise CommandError('Cannot read {}: {}'.format(options['csv_file'], ex))
+
+        report = GradeImporter(block).run(text, dry_run=options['dry_run'])
+        if report['errors']:
+            raise CommandError('\n'.join(report['errors']))
+        if options['dry_run']:
+            self.stdout.write('{} grades are ready to be imported'.format(report['rows']))
+        else:
+            self.stdout.write('Imported {} grades'.format(report['imported']))
@@ -8,8 +8,7 @@ import json
 import logging
 import mimetypes
 import os
-from contextlib import closing
-from zipfile import ZipFile
+import re
 
 import pkg_resources
 import six
@@ -17,27 +16,42 @@ import six.moves.urllib.error
 import six.moves.urllib.parse
 import six.moves.urllib.request
 
-import pytz
+from django.apps import apps
 from django.conf import settings
+from django.core import signing
 from django.core.exceptions import PermissionDenied
-from django.core.files import File
 from django.core.files.storage import default_storage
 from django.template import Context, Template
 from django.utils.encoding import force_text
 from django.utils.timezone import now as django_now
 from django.utils.translation import ugettext as _
-from edx_sga.constants import ITEM_TYPE
+from edx_sga.archive import (ArchiveProgress, claim_archive_build,
+                             get_archive_part_path, get_archive_parts,
+                             get_status_max_wait, get_submissions_fingerprint,
+                             is_archive_fresh, read_manifest,
+                             wait_for_archive_progress)
+from edx_sga.constants import GRADE_IMPORT_MAX_SIZE, ITEM_TYPE
+from edx_sga.downloads import (REVALIDATE_CACHE_CONTROL, file_response,
+                               get_etag, is_not_modified)
+from edx_sga.gradebook import GradeImporter, decode_csv, iter_grades_csv
+from edx_sga.grading import (StaffGradingDataLoader, grading_data_version,
+                             parse_grading_query, touch_grading_data)
 from edx_sga.showanswer import ShowAnswerXBlockMixin
 from edx_sga.tasks import (get_zip_file_name, get_zip_file_path,
                            zip_student_submissions)
-from edx_sga.utils import (file_contents_iter, get_file_modified_time_utc,
-                           get_file_storage_path, get_sha1,
-                           is_finalized_submission, utcnow)
+from edx_sga.uploads import (append_chunk, direct_uploads_enabled,
+                             get_chunked_upload_id, get_direct_upload_target,
+                             get_staged_size, get_staged_upload_path,
+                             get_upload_chunk_size, parse_content_range,
+                             remove_staged_upload, remove_stale_uploads,
+                             unsign_direct_upload)
+from edx_sga.utils import (copy_and_hash, encode_cursor,
+                           get_file_storage_path, is_finalized_submission,
+                           save_upload, utcnow)
 from lms.djangoapps.courseware.models import StudentModule
 from safe_lxml import etree
-from student.models import user_by_anonymous_id
+from student.models import anonymous_id_for_user
 from submissions import api as submissions_api
-from submissions.models import StudentItem as SubmissionsStudent
 from submissions.models import Submission
 from webob.response import Response
 from xblock.core import XBlock
@@ -50,21 +64,60 @@ from xmodule.util.duedate import get_extended_due_date
 
 log = logging.getLogger(__name__)
 
+SHA1_RE = re.compile(r'^[0-9a-f]{40}$')
 
-def reify(meth):
+
+class reify(object):  # pylint: disable=invalid-name
     """
     Decorator which caches value so it is only computed once.
-    Keyword arguments:
-    inst
+    Unlike a property it does not define __set__, so the value stored in the
+    instance dict shadows it on later lookups.
     """
-    def getter(inst):
+    def __init__(self, meth):
+        self.meth = meth
+        self.__doc__ = meth.__doc__
+
+    def __get__(self, inst, owner):
         """
         Set value to meth name in dict and returns value.
         """
-        value = meth(inst)
-        inst.__dict__[meth.__name__] = value
+        if inst is None:
+            return self
+        value = self.meth(inst)
+        inst.__dict__[self.meth.__name__] = value
         return value
-    return property(getter)
+
+
+class SubmissionContext(object):
+    """
+    The most recent submission and the score of a student, each fetched at most once.
+    Blocks are instantiated for every request, so this is shared by everything a single
+    view or handler needs to know about the student.
+    """
+    def __init__(self, student_item_dict):
+        self.student_item_dict = student_item_dict
+
+    @reify
+    def submission(self):
+        """
+        Student's most recent submission, or None.
+        """
+        submissions = submissions_api.get_submissions(self.student_item_dict)
+        if submissions:
+            # If I understand docs correctly, most recent submission should
+            # be first
+            return submissions[0]
+        return None
+
+    @reify
+    def score(self):
+        """
+        Student's current score, or None.
+        """
+        score = submissions_api.get_score(self.student_item_dict)
+        if score:
+            return score['points_earned']
+        return None
 
 
 class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMixin, XBlock):
@@ -175,12 +228,50 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
         )
 
     @classmethod
-    def file_size_over_limit(cls, file_obj):
+    def upload_too_large(cls):
         """
-        checks if file size is under limit.
+        Returns the error raised for files over the size limit
         """
-        file_obj.seek(0, os.SEEK_END)
-        return file_obj.tell() > cls.student_upload_max_size()
+        return JsonHandlerError(
+            413, 'Unable to upload file. Max size limit is {size}'.format(
+                size=cls.student_upload_max_size()
+            )
+        )
+
+    def save_upload(self, upload_file, filename):
+        """
+        Stores an uploaded file under the hash of its content and returns its sha1 and storage path.
+        Raises a 413 error as soon as the file goes over the size limit.
+        """
+        stored = save_upload(
+            upload_file,
+            lambda sha1: self.file_storage_path(sha1, filename),
+            self.student_upload_max_size()
+        )
+        if stored is None:
+            raise self.upload_too_large()
+        return stored
+
+    def create_upload_submission(self, user, submission_data, sha1, filename):
+        """
+        Records a stored file as the latest submission of a student, unless it already is
+        """
+        # Uploading an assignment represents a change of state with this user in this block,
+        # so we need to ensure that the user has a StudentModule record, which represents that state.
+        self.get_or_create_student_module(user)
+        answer = {
+            "sha1": sha1,
+            "filename": filename,
+            "mimetype": mimetypes.guess_type(filename)[0],
+            "finalized": False
+        }
+        previous_answer = submission_data['answer'] if submission_data else {}
+        if previous_answer.get('sha1') == sha1 and previous_answer.get('filename') == filename:
+            log.info("Skipping duplicate submission of file: %s for user: %s", filename, user.username)
+        else:
+            student_item_dict = self.get_student_item_dict()
+            submissions_api.create_submission(student_item_dict, answer)
+            self.reset_submission_contexts()
 
     @classmethod
     def parse_xml(cls, node, runtime, keys, id_generator):
@@ -272,6 +363,7 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
         }
         student_item_dict = self.get_student_item_dict()
         submissions_api.create_submission(student_item_dict, answer)
+        self.reset_submission_contexts()
         return Response(json_body=self.student_state())
 
     @XBlock.handler
@@ -279,35 +371,189 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
         # pylint: disable=unused-argument, protected-access
         """
         Save a students submission file.
+
+        Files are stored under the hash of their content, so uploading the same file again neither
+        rewrites it in storage nor records another submission.
         """
-        require(self.upload_allowed())
+        submission_data = self.get_submission()
+        require(self.upload_allowed(submission_data=submission_data))
         user = self.get_real_user()
         require(user)
         upload = request.params['assignment']
-        sha1 = get_sha1(upload.file)
-        if self.file_size_over_limit(upload.file):
-            raise JsonHandlerError(
-                413, 'Unable to upload file. Max size limit is {size}'.format(
-                    size=self.student_upload_max_size()
-                )
+        sha1, path = self.save_upload(upload.file, upload.file.name)
+        self.create_upload_submission(user, submission_data, sha1, upload.file.name)
+        log.info("Saved file: %s at path: %s for user: %s", upload.file.name, path, user.username)
+        return Response(json_body=self.student_state())
+
+    def get_chunked_upload(self, request):
+        """
+        Returns the id of the chunked upload of the file named by the 'filename', 'size' and 'last_modified'
+        parameters of a request, and the size of the file
+        """
+        try:
+            size = int(request.params['size'])
+        except (KeyError, ValueError):
+            raise JsonHandlerError(400, 'File size must be an integer')
+        upload_id = get_chunked_upload_id(
+            self.get_student_item_dict(),
+            request.params['filename'],
+            size,
+            request.params.get('last_modified', '')
+        )
+        return upload_id, size
+
+    @XBlock.handler
+    def start_chunked_upload(self, request, suffix=''):
+        # pylint: disable=unused-argument
+        """
+        Starts or resumes uploading a students submission file in chunks.
+        Returns the id of the upload and the number of bytes already received.
+        """
+        require(self.upload_allowed())
+        require(self.get_real_user())
+        upload_id, size = self.get_chunked_upload(request)
+        if size > self.student_upload_max_size():
+            raise self.upload_too_large()
+        remove_stale_uploads()
+        return Response(json_body={
+            "upload_id": upload_id,
+            "uploaded_bytes": get_staged_size(upload_id),
+            "chunk_size": get_upload_chunk_size(),
+            "direct_uploads": direct_uploads_enabled(),
+        })
+
+    @XBlock.handler
+    def upload_chunk(self, request, suffix=''):
+        # pylint: disable=unused-argument
+        """
+        Adds a chunk to a students submission file uploaded in chunks.
+        The chunk must start where the data received so far ends, as told by its Content-Range header,
+        otherwise a 409 response tells the client where to resume from.
+        """
+        require(self.upload_allowed())
+        require(self.get_real_user())
+        upload_id = self.get_chunked_upload(request)[0]
+        try:
+            content_range = request.headers.get('Content-Range')
+            start, end = parse_content_range(content_range)[:2] if content_range else (0, None)
+            uploaded_bytes = get_staged_size(upload_id)
+            if start != uploaded_bytes:
+                return Response(status=409, json_body={"uploaded_bytes": uploaded_bytes})
+            uploaded_bytes = append_chunk(
+                upload_id, start, request.params['assignment'].file, self.student_upload_max_size()
             )
-        # Uploading an assignment represents a change of state with this user in this block,
-        # so we need to ensure that the user has a StudentModule record, which represents that state.
-        self.get_or_create_student_module(user)
-        answer = {
-            "sha1": sha1,
-            "filename": upload.file.name,
-            "mimetype": mimetypes.guess_type(upload.file.name)[0],
-            "finalized": False
-        }
-        student_item_dict = self.get_student_item_dict()
-        submissions_api.create_submission(student_item_dict, answer)
-        path = self.file_storage_path(sha1, upload.file.name)
-        log.info("Saving file: %s at path: %s for user: %s", upload.file.name, path, user.username)
+        except ValueError as ex:
+            raise JsonHandlerError(400, six.text_type(ex))
+        if uploaded_bytes is None:
+            raise self.upload_too_large()
+        if end is not None and uploaded_bytes != end + 1:
+            # Another request appended to the upload in the meantime, or the chunk was cut short
+            return Response(status=409, json_body={"uploaded_bytes": uploaded_bytes})
+        return Response(json_body={"uploaded_bytes": uploaded_bytes})
+
+    @XBlock.handler
+    def finish_chunked_upload(self, request, suffix=''):
+        # pylint: disable=unused-argument
+        """
+        Saves a students submission file once all of its chunks were uploaded.
+        """
+        submission_data = self.get_submission()
+        require(self.upload_allowed(submission_data=submission_data))
+        user = self.get_real_user()
+        require(user)
+        filename = request.params['filename']
+        upload_id, size = self.get_chunked_upload(request)
+        staged_path = get_staged_upload_path(upload_id)
+        if not os.path.exists(staged_path) or get_staged_size(upload_id) != size:
+            raise JsonHandlerError(409, 'The upload is not complete')
+        with open(staged_path, 'rb') as staged:
+            sha1, path = self.save_upload(staged, filename)
+        remove_staged_upload(upload_id)
+        self.create_upload_submission(user, submission_data, sha1, filename)
+        log.info("Saved file: %s at path: %s for user: %s", filename, path, user.username)
+        return Response(json_body=self.student_state())
+
+    @XBlock.handler
+    def get_direct_upload_target(self, request, suffix=''):
+        # pylint: disable=unused-argument
+        """
+        Returns where the browser should upload a students submission file with the given sha1,
+        when SGA_DIRECT_UPLOADS is on. Nothing needs uploading if a file with that content is already stored.
+        """
+        if not direct_uploads_enabled():
+            raise JsonHandlerError(404, 'Direct uploads are not enabled')
+        require(self.upload_allowed())
+        require(self.get_real_user())
+        sha1 = request.params['sha1']
+        if not SHA1_RE.match(sha1):
+            raise JsonHandlerError(400, 'Invalid sha1: {}'.format(sha1))
+        path = self.file_storage_path(sha1, request.params['filename'])
         if default_storage.exists(path):
-            # save latest submission
+            return Response(json_body={"stored": True})
+        target = get_direct_upload_target(
+            path,
+            sha1,
+            self.student_upload_max_size(),
+            self.runtime.handler_url(self, 'direct_upload')
+        )
+        return Response(json_body=dict(target, stored=False))
+
+    @XBlock.handler
+    def direct_upload(self, request, suffix=''):
+        # pylint: disable=unused-argument
+        """
+        Receives a file uploaded to a signed target, for storage which cannot sign uploads itself.
+        The file is only stored if its content matches the sha1 the target was signed for.
+        """
+        try:
+            path, expected_sha1, max_size = unsign_direct_upload(request.params['token'])
+        except (KeyError, signing.BadSignature):
+            raise JsonHandlerError(403, 'Invalid or expired upload token')
+
+        def get_path(sha1):
+            """
+            Refuses to store content under the path of another sha1
+            """
+            if sha1 != expected_sha1:
+                raise JsonHandlerError(400, 'The file does not match its sha1')
+            return path
+
+        stored = save_upload(request.params['file'].file, get_path, max_size)
+        if stored is None:
+            raise self.upload_too_large()
+        return Response(status=204)
+
+    @XBlock.handler
+    def finish_direct_upload(self, request, suffix=''):
+        # pylint: disable=unused-argument
+        """
+        Records a students submission file once the browser uploaded it straight to storage.
+        The stored file is hashed again, since storage signing its own uploads does not check their content.
+        """
+        if not direct_uploads_enabled():
+            raise JsonHandlerError(404, 'Direct uploads are not enabled')
+        submission_data = self.get_submission()
+        require(self.upload_allowed(submission_data=submission_data))
+        user = self.get_real_user()
+        require(user)
+        sha1 = request.params['sha1']
+        filename = request.params['filename']
+        if not SHA1_RE.match(sha1):
+            raise JsonHandlerError(400, 'Invalid sha1: {}'.format(sha1))
+        path = self.file_storage_path(sha1, filename)
+        if not default_storage.exists(path):
+            raise JsonHandlerError(409, 'The file was not uploaded')
+        if default_storage.size(path) > self.student_upload_max_size():
+            default_storage.delete(path)
+            raise self.upload_too_large()
+        with default_storage.open(path) as stored:
+            stored_sha1 = copy_and_hash(stored, self.student_upload_max_size())
+        if stored_sha1 != sha1:
+            log.warning("Deleting file: %s uploaded by user: %s, which does not match its sha1", path, user.username)
             default_storage.delete(path)
-        default_storage.save(path, File(upload.file))
+            raise JsonHandlerError(400, 'The file does not match its sha1')
+        self.create_upload_submission(user, submission_data, sha1, filename)
+        log.info("Recorded file: %s uploaded to path: %s for user: %s", filename, path, user.username)
         return Response(json_body=self.student_state())
 
     @XBlock.handler
@@ -325,6 +571,7 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
             submission.answer['finalized'] = True
             submission.submitted_at = django_now()
             submission.save()
+            self.reset_submission_contexts()
         return Response(json_body=self.student_state())
 
     @XBlock.handler
@@ -335,33 +582,26 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
         """
         require(self.is_course_staff())
         upload = request.params['annotated']
-        sha1 = get_sha1(upload.file)
-        if self.file_size_over_limit(upload.file):
-            raise JsonHandlerError(
-                413, 'Unable to upload file. Max size limit is {size}'.format(
-                    size=self.student_upload_max_size()
-                )
-            )
+        sha1 = self.save_upload(upload.file, upload.file.name)[0]
+        previous_version = grading_data_version(self)
         module = self.get_student_module(request.params['module_id'])
         state = json.loads(module.state)
         state['annotated_sha1'] = sha1
-        state['annotated_filename'] = filename = upload.file.name
+        state['annotated_filename'] = upload.file.name
         state['annotated_mimetype'] = mimetypes.guess_type(upload.file.name)[0]
         state['annotated_timestamp'] = utcnow().strftime(
             DateTime.DATETIME_FORMAT
         )
-        path = self.file_storage_path(sha1, filename)
-        if not default_storage.exists(path):
-            default_storage.save(path, File(upload.file))
         module.state = json.dumps(state)
         module.save()
+        touch_grading_data(self)
         log.info(
             "staff_upload_annotated for course:%s module:%s student:%s ",
             module.course_id,
             module.module_state_key,
             module.student.username
         )
-        return Response(json_body=self.staff_grading_data())
+        return Response(json_body=self.staff_grading_row(module, previous_version))
 
     @XBlock.handler
     def download_assignment(self, request, suffix=''):
@@ -371,7 +611,7 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
         """
         answer = self.get_submission()['answer']
         path = self.file_storage_path(answer['sha1'], answer['filename'])
-        return self.download(path, answer['mimetype'], answer['filename'])
+        return self.download(path, answer['mimetype'], answer['filename'], request=request)
 
     @XBlock.handler
     def download_annotated(self, request, suffix=''):
@@ -386,7 +626,8 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
         return self.download(
             path,
             self.annotated_mimetype,
-            self.annotated_filename
+            self.annotated_filename,
+            request=request
         )
 
     @XBlock.handler
@@ -403,7 +644,8 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
             path,
             answer['mimetype'],
             answer['filename'],
-            require_staff=True
+            require_staff=True,
+            request=request
         )
 
     @XBlock.handler
@@ -423,7 +665,8 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
             path,
             state['annotated_mimetype'],
             state['annotated_filename'],
-            require_staff=True
+            require_staff=True,
+            request=request
         )
 
     @XBlock.handler
@@ -431,9 +674,26 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
         # pylint: disable=unused-argument
         """
         Return the html for the staff grading view
+
+        When a 'page_size' or 'cursor' parameter is given, only one page of assignments
+        is returned, sorted and filtered on the server, along with cursors for the
+        previous and next pages. When the 'version' parameter matches the current
+        version of the grading data, only that version is returned.
         """
         require(self.is_course_staff())
-        return Response(json_body=self.staff_grading_data())
+        params = request.params if request is not None else {}
+        if params.get('version'):
+            version = grading_data_version(self)
+            if params['version'] == version:
+                return Response(json_body={'version': version, 'unchanged': True})
+        if not params.get('page_size') and not params.get('cursor'):
+            return Response(json_body=self.staff_grading_data())
+
+        try:
+            query = parse_grading_query(params)
+        except ValueError as ex:
+            raise JsonHandlerError(400, six.text_type(ex))
+        return Response(json_body=self.staff_grading_page(query))
 
     @XBlock.handler
     def enter_grade(self, request, suffix=''):
@@ -463,14 +723,17 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
                 )
             )
 
+        previous_version = grading_data_version(self)
         if self.is_instructor():
             uuid = request.params['submission_id']
             submissions_api.set_score(uuid, score, self.max_score())
+            self.reset_submission_contexts()
         else:
             state['staff_score'] = score
         state['comment'] = request.params.get('comment', '')
         module.state = json.dumps(state)
         module.save()
+        touch_grading_data(self)
         log.info(
             "enter_grade for course:%s module:%s student:%s",
             module.course_id,
@@ -478,7 +741,7 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
             module.student.username
         )
 
-        return Response(json_body=self.staff_grading_data())
+        return Response(json_body=self.staff_grading_row(module, previous_version))
 
     @XBlock.handler
     def remove_grade(self, request, suffix=''):
@@ -488,11 +751,13 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
         """
         require(self.is_course_staff())
         student_id = request.params['student_id']
+        previous_version = grading_data_version(self)
         submissions_api.reset_score(
             student_id,
             self.block_course_id,
             self.block_id
         )
+        self.reset_submission_contexts()
         module = self.get_student_module(request.params['module_id'])
         state = json.loads(module.state)
         state['staff_score'] = None
@@ -503,13 +768,54 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
         state['annotated_timestamp'] = None
         module.state = json.dumps(state)
         module.save()
+        touch_grading_data(self)
         log.info(
             "remove_grade for course:%s module:%s student:%s",
             module.course_id,
             module.module_state_key,
             module.student.username
         )
-        return Response(json_body=self.staff_grading_data())
+        return Response(json_body=self.staff_grading_row(module, previous_version))
+
+    @XBlock.handler
+    def export_grades(self, request, suffix=''):
+        # pylint: disable=unused-argument
+        """
+        Stream the grading table as a CSV file, written as the rows are loaded.
+        """
+        require(self.is_course_staff())
+        # pylint: disable=no-member
+        filename = u'{}_grades.csv'.format(self.location.name)
+        return Response(
+            app_iter=iter_grades_csv(self),
+            content_type='text/csv',
+            charset='utf-8',
+            content_disposition='attachment; filename=' + filename,
+            cache_control='no-store',
+        )
+
+    @XBlock.handler
+    def import_grades(self, request, suffix=''):
+        # pylint: disable=unused-argument
+        """
+        Import grades from an uploaded CSV file with username, score and comment columns.
+
+        Nothing is saved unless every row of the file is valid, otherwise the errors
+        are returned with a 400 status.
+        """
+        require(self.is_course_staff())
+        upload = request.params['grades']
+        content = upload.file.read(GRADE_IMPORT_MAX_SIZE + 1)
+        if len(content) > GRADE_IMPORT_MAX_SIZE:
+            raise JsonHandlerError(413, 'The grades file is too large')
+        try:
+            text = decode_csv(content)
+        except ValueError as ex:
+            raise JsonHandlerError(400, six.text_type(ex))
+        report = GradeImporter(self, instructor=self.is_instructor()).run(text)
+        self.reset_submission_contexts()
+        report['version'] = grading_data_version(self)
+        return Response(json_body=report, status=400 if report['errors'] else 200)
 
     @XBlock.handler
     def prepare_download_submissions(self, request, suffix=''):  # pylint: disable=unused-argument
@@ -520,59 +826,47 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
         require(self.is_course_staff())
         user = self.get_real_user()
         require(user)
-        zip_file_ready = False
         location = six.text_type(self.location)
-
-        if self.is_zip_file_available(user):
+        zip_file_path = get_zip_file_path(
+            user.username,
+            self.block_course_id,
+            self.block_id,
+            self.location
+        )
+        manifest = read_manifest(zip_file_path)
+        fingerprint = get_submissions_fingerprint(self.block_course_id, self.block_id)
+        zip_file_ready = is_archive_fresh(manifest, fingerprint)
+        if zip_file_ready:
             log.info("Zip file already available for block: %s for instructor: %s", location, user.username)
-            assignments = self.get_sorted_submissions()
-            if assignments:
-                last_assignment_date = assignments[0]['timestamp'].astimezone(pytz.utc)
-                zip_file_path = get_zip_file_path(
-                    user.username,
-                    self.block_course_id,
-                    self.block_id,
-                    self.location
-                )
-                zip_file_time = get_file_modified_time_utc(zip_file_path)
-                log.info(
-                    "Zip file modified time: %s, last zip file time: %s for block: %s for instructor: %s",
-                    last_assignment_date,
-                    zip_file_time,
-                    location,
-                    user.username
-                )
-                # if last zip file is older the last submission then recreate task
-                if zip_file_time >= last_assignment_date:
-                    zip_file_ready = True
-
-                # check if some one reset submission. If yes the recreate zip file
-                assignment_count = len(assignments)
-                if self.count_archive_files(user) != assignment_count:
-                    zip_file_ready = False
-
-        if not zip_file_ready:
+        elif claim_archive_build(zip_file_path, fingerprint):
             log.info("Creating new zip file for block: %s for instructor: %s", location, user.username)
+            ArchiveProgress(zip_file_path).queue()
             zip_student_submissions.delay(
                 self.block_course_id,
                 self.block_id,
                 location,
-                user.username
+                user.username,
+                fingerprint
             )
+        else:
+            log.info("Zip file already being created for block: %s for instructor: %s", location, user.username)
 
         return Response(json_body={
-            "downloadable": zip_file_ready
+            "downloadable": zip_file_ready,
+            "parts": len(get_archive_parts(manifest)) if zip_file_ready else 0
         })
 
     @XBlock.handler
     def download_submissions(self, request, suffix=''):  # pylint: disable=unused-argument
         """
         Api for downloading zip file which consist of all students submissions.
+        Parts of multi-part archives are selected with the 'part' parameter, starting from 1.
         """
         # pylint: disable=no-member
         require(self.is_course_staff())
         user = self.get_real_user()
         require(user)
+        params = request.params if request is not None else {}
         try:
             zip_file_path = get_zip_file_path(
                 user.username,
@@ -585,12 +879,23 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
                 self.block_course_id,
                 self.block_id
             )
-            return Response(
-                app_iter=file_contents_iter(zip_file_path),
-                content_type='application/zip',
-                content_disposition="attachment; filename=" + zip_file_name
+            manifest = read_manifest(zip_file_path)
+            parts = get_archive_parts(manifest) or [zip_file_path]
+            part = int(params.get('part', 1))
+            if not 1 <= part <= len(parts):
+                raise IOError("No part {} in archive at path: {}".format(part, zip_file_path))
+            if len(parts) > 1:
+                zip_file_name = get_archive_part_path(zip_file_name, part)
+            # Archives are rebuilt in place, they stay the same as long as the submissions do
+            fingerprint = manifest.get('fingerprint') if manifest else None
+            return file_response(
+                request,
+                parts[part - 1],
+                'application/zip',
+                "attachment; filename=" + zip_file_name,
+                etag=get_etag(parts[part - 1], fingerprint) if fingerprint else None
             )
-        except IOError:
+        except (IOError, OSError, ValueError):
             return Response(
                 "Sorry, submissions cannot be found. Press Collect ALL Submissions button or"
                 " contact {} if you issue is consistent".format(settings.TECH_SUPPORT_EMAIL),
@@ -600,27 +905,77 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
     @XBlock.handler
     def download_submissions_status(self, request, suffix=''):  # pylint: disable=unused-argument
         """
-        returns True if zip file is available for download
+        returns True if zip file is available for download, with the number of parts it is split into
+        and the progress of the latest build: its state, files done out of the total, bytes written,
+        estimated seconds left and failure reason.
+
+        With a `since` parameter, the `updated` time of the progress the client already has, the request
+        waits up to `wait` seconds (capped by SGA_ARCHIVE_STATUS_MAX_WAIT) for newer progress before answering.
         """
+        # pylint: disable=no-member
         require(self.is_course_staff())
         user = self.get_real_user()
         require(user)
+        params = request.params if request is not None else {}
+        try:
+            since = float(params['since']) if params.get('since') else None
+            wait = min(max(float(params.get('wait', 0)), 0), get_status_max_wait())
+        except ValueError:
+            raise JsonHandlerError(400, 'since and wait must be numbers')
+        zip_file_path = get_zip_file_path(
+            user.username,
+            self.block_course_id,
+            self.block_id,
+            self.location
+        )
+        progress = wait_for_archive_progress(zip_file_path, since, wait)
+        parts = get_archive_parts(read_manifest(zip_file_path))
         return Response(
             json_body={
-                "zip_available": self.is_zip_file_available(user)
+                "zip_available": bool(parts),
+                "parts": len(parts),
+                "progress": progress
             }
         )
 
+    @XBlock.handler
+    def get_student_state(self, request, suffix=''):
+        # pylint: disable=unused-argument
+        """
+        Return the student's state as JSON, for the student view rendered with
+        SGA_CACHEABLE_STUDENT_VIEW. The response carries an ETag of the state, so
+        browsers revalidate their copy and get a 304 when nothing changed.
+        """
+        state = self.student_state()
+        etag = get_etag(json.dumps(state, sort_keys=True))
+        response = Response(json_body=state)
+        response.cache_control = REVALIDATE_CACHE_CONTROL
+        response.etag = etag
+        if is_not_modified(request, etag):
+            response.status = 304
+            response.body = b''
+        return response
+
     def student_view(self, context=None):
         # pylint: disable=no-member
         """
         The primary view of the StaffGradedAssignmentXBlock, shown to students
         when viewing courses.
+
+        With SGA_CACHEABLE_STUDENT_VIEW the fragment leaves out the student's state,
+        which the client fetches from get_student_state, so it is the same for
+        every learner and may be cached for as long as the block is unchanged.
         """
+        if getattr(settings, 'SGA_CACHEABLE_STUDENT_VIEW', False):
+            student_state = ''
+        else:
+            student_state = json.dumps(self.student_state())
         context = {
-            "student_state": json.dumps(self.student_state()),
+            "student_state": student_state,
             "id": self.location.name.replace('.', '_'),
             "max_file_size": self.student_upload_max_size(),
+            "chunk_size": get_upload_chunk_size(),
+            "direct_uploads": direct_uploads_enabled(),
             "support_email": settings.TECH_SUPPORT_EMAIL
         }
         if self.show_staff_grading_interface():
@@ -636,7 +991,10 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
         )
         fragment.add_css(_resource("static/css/edx_sga.css"))
         fragment.add_javascript(_resource("static/js/src/edx_sga.js"))
-        fragment.add_javascript(_resource("static/js/src/jquery.tablesorter.min.js"))
+        if context.get('is_course_staff'):
+            # The grading interface is only sent to staff, learners don't need its code
+            fragment.add_javascript(_resource("static/js/src/edx_sga_staff.js"))
+            fragment.add_javascript(_resource("static/js/src/jquery.tablesorter.min.js"))
         fragment.initialize_js('StaffGradedAssignmentXBlock')
         return fragment
 
@@ -673,6 +1031,7 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
                 self.block_id,
                 clear_state=True
             )
+        self.reset_submission_contexts()
 
     def max_score(self):
         """
@@ -712,29 +1071,42 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
             "item_type": ITEM_TYPE,
         }
 
+    @reify
+    def submission_contexts(self):
+        """
+        Submission contexts of the students seen during this request, by student id.
+        """
+        return {}
+
+    def get_submission_context(self, student_id=None):
+        """
+        Return the SubmissionContext of a student, the current one by default.
+        """
+        student_item_dict = self.get_student_item_dict(student_id)
+        student_id = student_item_dict['student_id']
+        if student_id not in self.submission_contexts:
+            self.submission_contexts[student_id] = SubmissionContext(student_item_dict)
+        return self.submission_contexts[student_id]
+
+    def reset_submission_contexts(self):
+        """
+        Forget the submissions and scores fetched so far, after changing them.
+        """
+        self.submission_contexts.clear()
+
     def get_submission(self, student_id=None):
         """
         Get student's most recent submission.
         """
-        submissions = submissions_api.get_submissions(
-            self.get_student_item_dict(student_id)
-        )
-        if submissions:
-            # If I understand docs correctly, most recent submission should
-            # be first
-            return submissions[0]
+        return self.get_submission_context(student_id).submission
 
     def get_score(self, student_id=None):
         """
         Return student's current score.
         """
-        score = submissions_api.get_score(
-            self.get_student_item_dict(student_id)
-        )
-        if score:
-            return score['points_earned']
+        return self.get_submission_context(student_id).score
 
-    @reify
+    @property
     def score(self):
         """
         Return score from submissions.
@@ -839,108 +1211,73 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
         Return student assignment information for display on the
         grading screen.
         """
-        def get_student_data():
-            # pylint: disable=no-member
-            """
-            Returns a dict of student assignment information along with
-            annotated file name, student id and module id, this
-            information will be used on grading screen
-            """
-            # Submissions doesn't have API for this, just use model directly.
-            students = SubmissionsStudent.objects.filter(
-                course_id=self.course_id,
-                item_id=self.block_id)
-            for student in students:
-                submission = self.get_submission(student.student_id)
-                if not submission:
-                    continue
-                user = user_by_anonymous_id(student.student_id)
-                student_module = self.get_or_create_student_module(user)
-                state = json.loads(student_module.state)
-                score = self.get_score(student.student_id)
-                approved = score is not None
-                if score is None:
-                    score = state.get('staff_score')
-                    needs_approval = score is not None
-                else:
-                    needs_approval = False
-                instructor = self.is_instructor()
-
-                filename, user_response = None, None
-                if "filename" in submission['answer'].keys():
-                    filename = submission['answer']['filename']
-                if "user_response" in submission['answer'].keys():
-                    user_response = submission['answer']['user_response']
-
-                yield {
-                    'module_id': student_module.id,
-                    'student_id': student.student_id,
-                    'submission_id': submission['uuid'],
-                    'username': student_module.student.username,
-                    'fullname': student_module.student.profile.name,
-                    'filename': filename,
-                    'user_response': user_response,
-                    'timestamp': submission['created_at'].strftime(
-                        DateTime.DATETIME_FORMAT
-                    ),
-                    'score': score,
-                    'approved': approved,
-                    'needs_approval': instructor and needs_approval,
-                    'may_grade': instructor or not approved,
-                    'annotated': force_text(state.get("annotated_filename", '')),
-                    'comment': force_text(state.get("comment", '')),
-                    'finalized': is_finalized_submission(submission_data=submission)
-                }
-
         return {
-            'assignments': list(get_student_data()),
+            'assignments': StaffGradingDataLoader(self).rows(),
             'max_score': self.max_score(),
-            'display_name': force_text(self.display_name)
+            'display_name': force_text(self.display_name),
+            'version': grading_data_version(self),
         }
 
-    def get_sorted_submissions(self):
-        """returns student recent assignments sorted on date"""
-        assignments = []
-        submissions = submissions_api.get_all_submissions(
-            self.course_id,
-            self.block_id,
-            ITEM_TYPE
-        )
+    def staff_grading_row(self, module, previous_version=None):
+        """
+        Return the grading screen information of the student owning a StudentModule,
+        so that clients can update that single row instead of the whole table.
 
-        for submission in submissions:
-            if is_finalized_submission(submission_data=submission):
-                filename, user_response = None, None
-                if "filename" in submission['answer'].keys():
-                    filename = submission['answer']['filename']
-                if "user_response" in submission['answer'].keys():
-                    user_response = submission['answer']['user_response']
-
-                assignments.append({
-                    'submission_id': submission['uuid'],
-                    'filename': filename,
-                    'user_response': user_response,
-                    'timestamp': submission['submitted_at'] or submission['created_at']
-                })
-
-        assignments.sort(
-            key=lambda assignment: assignment['timestamp'], reverse=True
-        )
-        return assignments
+        previous_version is the version of the grading data before the change to the row.
+        Only a client holding that version may take the new one, since it would otherwise
+        skip changes made to other rows in the meantime.
+        """
+        # pylint: disable=no-member
+        student_id = anonymous_id_for_user(module.student, self.course_id)
+        return {
+            'assignment': StaffGradingDataLoader(self).row(student_id),
+            'max_score': self.max_score(),
+            'display_name': force_text(self.display_name),
+            'previous_version': previous_version,
+            'version': grading_data_version(self),
+        }
 
-    def download(self, path, mime_type, filename, require_staff=False):
+    def staff_grading_page(self, query):
+        """
+        Return one page of the grading screen for a query built by parse_grading_query.
+        """
+        assignments, total = StaffGradingDataLoader(self).page(query)
+        offset, page_size = query['offset'], query['page_size']
+        next_cursor, previous_cursor = None, None
+        if offset + page_size < total:
+            next_cursor = encode_cursor(dict(query, offset=offset + page_size))
+        if offset > 0:
+            previous_cursor = encode_cursor(dict(query, offset=max(offset - page_size, 0)))
+        return {
+            'assignments': assignments,
+            'max_score': self.max_score(),
+            'display_name': force_text(self.display_name),
+            'total': total,
+            'offset': offset,
+            'sort_by': query['sort_by'],
+            'order': query['order'],
+            'next_cursor': next_cursor,
+            'previous_cursor': previous_cursor,
+            'version': grading_data_version(self),
+        }
+
+    def download(self, path, mime_type, filename, require_staff=False, request=None):
         """
         Return a file from storage and return in a Response.
+        Download handlers keep the same URL when a student uploads another file, so browsers must
+        revalidate their copy. The ETag comes from the content-addressed path, so unchanged files get a 304.
         """
         try:
             content_disposition = "attachment; filename*=UTF-8''"
             content_disposition += six.moves.urllib.parse.quote(filename.encode('utf-8'))
-            output = Response(
-                app_iter=file_contents_iter(path),
-                content_type=mime_type,
-                content_disposition=content_disposition
+            return file_response(
+                request,
+                path,
+                mime_type,
+                content_disposition,
+                etag=get_etag(path)
             )
-            return output
-        except IOError:
+        except (IOError, OSError):
             if require_staff:
                 return Response(
                     "Sorry, assignment {} cannot be found at"
@@ -1028,34 +1365,6 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
         """
         return get_file_storage_path(self.location, file_hash, original_filename)
 
-    def is_zip_file_available(self, user):
-        """
-        returns True if zip file exists.
-        """
-        # pylint: disable=no-member
-        zip_file_path = get_zip_file_path(
-            user.username,
-            self.block_course_id,
-            self.block_id,
-            self.location
-        )
-        return True if default_storage.exists(zip_file_path) else False
-
-    def count_archive_files(self, user):
-        """
-        returns number of files archive in zip.
-        """
-        # pylint: disable=no-member
-        zip_file_path = get_zip_file_path(
-            user.username,
-            self.block_course_id,
-            self.block_id,
-            self.location
-        )
-        with default_storage.open(zip_file_path, 'rb') as zip_file:
-            with closing(ZipFile(zip_file)) as archive:
-                return len(archive.infolist())
-
     def get_real_user(self):
         """returns session user"""
         # pylint: disable=no-member
@@ -1101,20 +1410,84 @@ class StaffGradedAssignmentXBlock(StudioEditableXBlockMixin, ShowAnswerXBlockMix
         return self.is_course_staff()
 
 
+STUDENT_VIEW_TEMPLATES = (
+    "templates/staff_graded_assignment/show.html",
+)
+STUDENT_VIEW_RESOURCES = STUDENT_VIEW_TEMPLATES + (
+    "static/css/edx_sga.css",
+    "static/js/src/edx_sga.js",
+    "static/js/src/edx_sga_staff.js",
+    "static/js/src/jquery.tablesorter.min.js",
+)
+
+_resource_cache = {}
+_template_cache = {}
+
+
+def resource_cache_enabled():
+    """
+    True if resources and compiled templates are kept for the life of the
+    process. Defaults to off under DEBUG so edits show up without a restart.
+    """
+    return getattr(settings, 'SGA_CACHE_RESOURCES', not settings.DEBUG)
+
+
+def clear_resource_cache():
+    """
+    Forget every cached resource and compiled template.
+    """
+    _resource_cache.clear()
+    _template_cache.clear()
+
+
+def warm_resource_cache():
+    """
+    Load the resources used by student_view into the cache. Templates can only
+    be compiled once Django's apps are loaded, otherwise they are compiled on
+    first render.
+    """
+    if not resource_cache_enabled():
+        return
+    for path in STUDENT_VIEW_RESOURCES:
+        load_resource(path)
+    if apps.ready:
+        for path in STUDENT_VIEW_TEMPLATES:
+            get_template(path)
+
+
 def _resource(path):  # pragma: NO COVER
     """
     Handy helper for getting resources from our kit.
     """
-    data = pkg_resources.resource_string(__name__, path)
-    return data.decode("utf8")
+    return load_resource(path)
 
 
-def load_resource(resource_path):  # pragma: NO COVER
+def load_resource(resource_path):
     """
     Gets the content of a resource
     """
-    resource_content = pkg_resources.resource_string(__name__, resource_path)
-    return six.text_type(resource_content)
+    if not resource_cache_enabled():
+        return pkg_resources.resource_string(__name__, resource_path).decode("utf8")
+    try:
+        return _resource_cache[resource_path]
+    except KeyError:
+        content = pkg_resources.resource_string(__name__, resource_path).decode("utf8")
+        _resource_cache[resource_path] = content
+        return content
+
+
+def get_template(template_path):
+    """
+    Gets the compiled template for a resource path
+    """
+    if not resource_cache_enabled():
+        return Template(load_resource(template_path))
+    try:
+        return _template_cache[template_path]
+    except KeyError:
+        template = Template(load_resource(template_path))
+        _template_cache[template_path] = template
+        return template
 
 
 def render_template(template_path, context=None):  # pragma: NO COVER
@@ -1124,9 +1497,7 @@ def render_template(template_path, context=None):  # pragma: NO COVER
     if context is None:
         context = {}
 
-    template_str = load_resource(template_path)
-    template = Template(template_str)
-    return template.render(Context(context))
+    return get_template(template_path).render(Context(context))
 
 
 def require(assertion):
@@ -1135,3 +1506,6 @@ def require(assertion):
     """
     if not assertion:
         raise PermissionDenied
+
+
+warm_resource_cache()
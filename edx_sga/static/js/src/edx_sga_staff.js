@@ -0,0 +1,487 @@
+/* Javascript for the staff grading interface of StaffGradedAssignmentXBlock.
+ * Only added to the fragment for course staff, and started by edx_sga.js.
+ */
+function StaffGradedAssignmentStaffView(runtime, element, $, _, updateChangeEvent) {
+    var MIN_POLL_DELAY_MS = 2000;
+    var MAX_POLL_DELAY_MS = 30000;
+    var MAX_POLL_TIME_MS = 2 * 60 * 60 * 1000;
+    var MAX_POLL_ERRORS = 5;
+    var LONG_POLL_WAIT_S = 25;
+
+    var getStaffGradingUrl = runtime.handlerUrl(
+      element, 'get_staff_grading_data'
+    );
+    var staffDownloadUrl = runtime.handlerUrl(element, 'staff_download');
+    var staffAnnotatedUrl = runtime.handlerUrl(
+      element, 'staff_download_annotated'
+    );
+    var staffUploadUrl = runtime.handlerUrl(element, 'staff_upload_annotated');
+    var enterGradeUrl = runtime.handlerUrl(element, 'enter_grade');
+    var removeGradeUrl = runtime.handlerUrl(element, 'remove_grade');
+    var importGradesUrl = runtime.handlerUrl(element, 'import_grades');
+    var exportGradesUrl = runtime.handlerUrl(element, 'export_grades');
+    var downloadSubmissionsUrl = runtime.handlerUrl(element, 'download_submissions');
+    var prepareDownloadSubmissionsUrl = runtime.handlerUrl(element, 'prepare_download_submissions');
+    var downloadSubmissionsStatusUrl = runtime.handlerUrl(element, 'download_submissions_status');
+    var block = $(element).find('.sga-block');
+    var gradingTemplate = _.template($(element).find('#sga-grading-tmpl').text());
+    var gradingRowTemplate = _.template($(element).find('#sga-grading-row-tmpl').text());
+    var gradingVersion = null;
+    var gradingQuery = {sort_by: 'timestamp', order: 'desc', page_size: 50};
+    var gradingCursor = null;
+    var preparingSubmissionsMsg = gettext(
+      'Started preparing student submissions zip file. This may take a while.'
+    );
+
+    /* Load a page of the grading table, either from a cursor or from the current query.
+     * When revalidate is set, the page is only sent again if the grading data changed.
+     */
+    function loadStaffGrading(cursor, revalidate) {
+        var params = cursor ? {cursor: cursor} : _.clone(gradingQuery);
+        if (revalidate && gradingVersion) {
+            params.version = gradingVersion;
+        }
+        gradingCursor = cursor || null;
+        $.ajax({
+            url: getStaffGradingUrl,
+            data: params,
+            success: renderStaffGrading
+        });
+    }
+
+    function renderStaffGrading(data) {
+        gradingVersion = data.version;
+        if (data.unchanged) {
+            // The table on screen is still up to date
+            return;
+        }
+
+        if (data.display_name !== '') {
+            $('.sga-block .display_name').html(data.display_name);
+        }
+
+        // Add download urls and the row template to template context
+        data.downloadUrl = staffDownloadUrl;
+        data.annotatedUrl = staffAnnotatedUrl;
+        data.rowTemplate = gradingRowTemplate;
+
+        // Render template
+        $(element).find('#grade-info')
+            .html(gradingTemplate(data))
+            .data(data);
+
+        // Map data to table rows
+        data.assignments.map(function(assignment) {
+          var row = $(element).find('#grade-info #row-' + assignment.module_id).data(assignment);
+          setUpGradingRow(row);
+        });
+
+        // Set up paging and server side sorting
+        $(element).find('#grade-info .grading-previous').on('click', function() {
+            loadStaffGrading(data.previous_cursor);
+        });
+        $(element).find('#grade-info .grading-next').on('click', function() {
+            loadStaffGrading(data.next_cursor);
+        });
+        $(element).find('#submissions th.server-sort').each(function() {
+            if ($(this).data('sort') === data.sort_by) {
+                $(this).addClass(data.order === 'asc' ? 'headerSortDown' : 'headerSortUp');
+            }
+        }).on('click', function() {
+            var sortBy = $(this).data('sort');
+            if (sortBy === gradingQuery.sort_by) {
+                gradingQuery.order = gradingQuery.order === 'desc' ? 'asc' : 'desc';
+            } else {
+                gradingQuery.sort_by = sortBy;
+                gradingQuery.order = 'asc';
+            }
+            loadStaffGrading();
+        });
+
+        $.tablesorter.addParser({
+          id: 'alphanum',
+          is: function(s) {
+            return false;
+          },
+          format: function(s) {
+            var str = s.replace(/(\d{1,2})/g, function(a){
+                return pad(a);
+            });
+
+            return str;
+          },
+          type: 'text'
+        });
+
+        function pad(num) {
+          var s = '00000' + num;
+          return s.substr(s.length-5);
+        }
+        // Columns sorted on the server are not sorted again within the page
+        $("#submissions").tablesorter({
+            headers: {
+              0: { sorter: false },
+              2: { sorter: "alphanum" },
+              3: { sorter: "alphanum" },
+              4: { sorter: false },
+              5: { sorter: false },
+              6: { sorter: false },
+              7: { sorter: "alphanum" }
+            }
+        });
+    }
+
+    /* Replace the row of a single student with the one returned after a grade or annotated file changed */
+    function patchStaffGrading(data) {
+        if (data.hasOwnProperty('error')) {
+            gradeFormError(data['error']);
+            return;
+        }
+        gradeFormError('');
+        $('.grade-modal').hide();
+        // Another grader may have changed other rows since this table was loaded, then only a full reload is current
+        gradingVersion = gradingVersion && data.previous_version === gradingVersion ? data.version : null;
+        if (!data.assignment) {
+            return;
+        }
+
+        var row = $($.trim(gradingRowTemplate({
+            assignment: data.assignment,
+            max_score: data.max_score,
+            downloadUrl: staffDownloadUrl,
+            annotatedUrl: staffAnnotatedUrl
+        }))).data(data.assignment);
+        $(element).find('#grade-info #row-' + data.assignment.module_id).replaceWith(row);
+        setUpGradingRow(row);
+        $("#submissions").trigger("update");
+    }
+
+    /* Set up grade entry and annotated file upload for a row of the grading table */
+    function setUpGradingRow(row) {
+        // Set up grade entry modal
+        row.find('.enter-grade-button')
+            .leanModal({closeButton: '#enter-grade-cancel'})
+            .on('click', handleGradeEntry);
+
+        // Set up annotated file upload
+        row.find('.fileupload').each(function() {
+            var url = staffUploadUrl + "?module_id=" + row.data("module_id");
+            var fileUpload = $(this).fileupload({
+                url: url,
+                progressall: function(e, data) {
+                    var percent = parseInt(data.loaded / data.total * 100, 10);
+                    row.find('.upload').text(interpolate(gettext('Uploading... %(percent)s %'), {percent: percent}, true));
+                },
+                done: function(e, data) {
+                    // Add a time delay so user will notice upload finishing
+                    // for small files
+                    setTimeout(
+                        function() { patchStaffGrading(data.result); },
+                        3000);
+                }
+            });
+
+            updateChangeEvent(fileUpload);
+        });
+    }
+
+    /* Just show error on enter grade dialog */
+    function gradeFormError(error) {
+        var form = $(element).find("#enter-grade-form");
+        form.find('.error').html(error);
+    }
+
+    /* Click event handler for "enter grade" */
+    function handleGradeEntry() {
+        var row = $(this).parents("tr");
+        var form = $(element).find("#enter-grade-form");
+        $(element).find('#student-name').text(row.data('fullname'));
+        form.find('#module_id-input').val(row.data('module_id'));
+        form.find('#submission_id-input').val(row.data('submission_id'));
+        form.find('#grade-input').val(row.data('score'));
+        form.find('#comment-input').text(row.data('comment'));
+        form.find('#remove-grade').prop('disabled', false);
+        form.find('.ccx-enter-grade-spinner').hide();
+        form.off('submit').on('submit', function(event) {
+            var max_score = row.parents('#grade-info').data('max_score');
+            var score = Number(form.find('#grade-input').val());
+            event.preventDefault();
+            if (!score) {
+                gradeFormError('<br/>'+gettext('Grade must be a number.'));
+            } else if (score !== parseInt(score)) {
+                gradeFormError('<br/>'+gettext('Grade must be an integer.'));
+            } else if (score < 0) {
+                gradeFormError('<br/>'+gettext('Grade must be positive.'));
+            } else if (score > max_score) {
+                gradeFormError('<br/>'+interpolate(gettext('Maximum score is %(max_score)s'), {max_score:max_score}, true));
+            } else {
+                // No errors
+                form.find('.ccx-enter-grade-spinner').show();
+                $.post(enterGradeUrl, form.serialize())
+                    .success(patchStaffGrading)
+                    .fail(function() {
+                        form.find('.ccx-enter-grade-spinner').hide();
+                    });
+            }
+        });
+        form.find('#remove-grade').off('click').on('click', function(event) {
+            $(this).prop('disabled', true);
+            form.find('.ccx-enter-grade-spinner').show();
+            var url = removeGradeUrl + '?module_id=' +
+                row.data('module_id') + '&student_id=' +
+                row.data('student_id');
+            event.preventDefault();
+            if (row.data('score')) {
+              // if there is no grade then it is pointless to call api.
+              $.get(url).success(patchStaffGrading).fail(function() {
+                $(this).prop('disabled', false);
+                form.find('.ccx-enter-grade-spinner').hide();
+              });
+            } else {
+              gradeFormError('<br/>'+gettext('No grade to remove.'));
+            }
+        });
+        form.find('#enter-grade-cancel').on('click', function() {
+            /* We're kind of stretching the limits of leanModal, here,
+             * by nesting modals one on top of the other.  One side effect
+             * is that when the enter grade modal is closed, it hides
+             * the overlay for itself and for the staff grading modal,
+             * so the overlay is no longer present to click on to close
+             * the staff grading modal.  Since leanModal uses a fade out
+             * time of 200ms to hide the overlay, our work around is to
+             * wait 225ms and then just "click" the 'Grade Submissions'
+             * button again.  It would also probably be pretty
+             * straightforward to submit a patch to leanModal so that it
+             * would work properly with nested modals.
+             *
+             * See: https://github.com/mitodl/edx-sga/issues/13
+             */
+            setTimeout(function() {
+                $('#grade-submissions-button').click();
+                gradeFormError('');
+            }, 225);
+        });
+    }
+
+    /* Show how a grades import went, or why nothing was imported */
+    function showImportReport(report) {
+        var message = $(element).find('.import-message').empty().show();
+        if (report && report.errors && report.errors.length) {
+            message.text(gettext('No grade was imported. Please fix these errors and try again:'));
+            var list = $('<ul/>').appendTo(message);
+            _.each(report.errors, function(error) {
+                $('<li/>').text(error).appendTo(list);
+            });
+        } else if (report && report.imported !== undefined) {
+            message.text(interpolate(gettext('Imported %(count)s grades.'), {count: report.imported}, true));
+        } else {
+            message.text((report && report.error) || gettext('The grades could not be imported.'));
+        }
+    }
+
+    function showArchiveParts(parts) {
+      // Large archives are split into several zip files, each downloaded on its own
+      var list = $('<ul class="archive-parts"/>');
+      for (var part = 1; part <= parts; part++) {
+        $('<a/>')
+          .attr('href', downloadSubmissionsUrl + '?part=' + part)
+          .text(interpolate(gettext('Part %(part)s of %(parts)s'), {part: part, parts: parts}, true))
+          .appendTo($('<li/>').appendTo(list));
+      }
+      $(element).find('.task-message')
+        .show()
+        .html(gettext("Student submission files ready for download"))
+        .append(list)
+        .removeClass("preparing-msg")
+        .addClass("ready-msg");
+    }
+
+    function showArchiveProgress(progress) {
+      // Tell the instructor how far along the archive build is
+      var message = preparingSubmissionsMsg;
+      if (progress && progress["state"] === 'running' && progress["files_total"]) {
+        message = interpolate(
+          gettext('Compressing student submissions: %(done)s of %(total)s files'),
+          {done: progress["files_done"], total: progress["files_total"]},
+          true
+        );
+        if (progress["eta_seconds"] !== null) {
+          message += ' ' + interpolate(
+            gettext('(about %(minutes)s min left)'),
+            {minutes: Math.max(1, Math.ceil(progress["eta_seconds"] / 60))},
+            true
+          );
+        }
+      }
+      $(element).find('.task-message')
+        .show()
+        .html(message)
+        .removeClass("ready-msg")
+        .addClass("preparing-msg");
+    }
+
+    function pollSubmissionDownload() {
+      pollArchiveStatus(downloadSubmissionsStatusUrl, showArchiveProgress).then(function(response) {
+        $(element).find('#download-init-button').removeClass("disabled");
+        if (response["parts"] > 1) {
+          showArchiveParts(response["parts"]);
+          return;
+        }
+        $(element).find('.task-message')
+          .show()
+          .html(gettext("Student submission file ready for download"))
+          .removeClass("preparing-msg")
+          .addClass("ready-msg");
+      }).fail(function(reason) {
+        $(element).find('#download-init-button').removeClass("disabled");
+        $(element).find('.task-message')
+          .show()
+          // The error of a failed build may contain file names chosen by students
+          .text(
+            reason || interpolate(
+              gettext(
+                'The download file was not created. Please try again or contact %(support_email)s'
+              ),
+              {support_email: $(element).find('.sga-block').attr("data-support-email")},
+              true
+            )
+          )
+          .removeClass("preparing-msg")
+          .addClass("ready-msg");
+      });
+    }
+
+    function getPollDelay(progress) {
+      // Ask again about halfway to the expected end of the build
+      if (progress["eta_seconds"] === null || progress["eta_seconds"] === undefined) {
+        return MIN_POLL_DELAY_MS;
+      }
+      return Math.min(Math.max(progress["eta_seconds"] * 1000 / 2, MIN_POLL_DELAY_MS), MAX_POLL_DELAY_MS);
+    }
+
+    function pollArchiveStatus(url, onProgress) {
+      // Long-polls the status handler, which answers as soon as the build progresses or after
+      // LONG_POLL_WAIT_S seconds. Falls back to exponential backoff when it answers without waiting.
+      var deferred = $.Deferred(),
+        backoffMs = MIN_POLL_DELAY_MS,
+        startedAt = Date.now(),
+        since = null,
+        errors = 0;
+
+      function retryLater() {
+        setTimeout(makeLoopingRequest, backoffMs);
+        backoffMs = Math.min(backoffMs * 2, MAX_POLL_DELAY_MS);
+      }
+
+      function makeLoopingRequest() {
+        var query = since === null ? {} : {since: since, wait: LONG_POLL_WAIT_S},
+          requestedAt = Date.now();
+        $.get(url, query).success(function(response) {
+          var progress = response["progress"];
+          errors = 0;
+          if (response["zip_available"] && (!progress || progress["state"] === 'done')) {
+            deferred.resolve(response);
+          } else if (progress && progress["state"] === 'failed') {
+            deferred.reject(progress["error"]);
+          } else if (Date.now() - startedAt >= MAX_POLL_TIME_MS) {
+            deferred.reject();
+          } else if (!progress) {
+            retryLater();
+          } else if (progress["updated"] !== since) {
+            since = progress["updated"];
+            backoffMs = MIN_POLL_DELAY_MS;
+            onProgress(progress);
+            setTimeout(makeLoopingRequest, getPollDelay(progress));
+          } else if (Date.now() - requestedAt >= MIN_POLL_DELAY_MS) {
+            // The server already waited for news, ask again right away
+            makeLoopingRequest();
+          } else {
+            retryLater();
+          }
+        }).fail(function() {
+          errors++;
+          if (errors < MAX_POLL_ERRORS) {
+            retryLater();
+          } else {
+            deferred.reject();
+          }
+        });
+      }
+      makeLoopingRequest();
+
+      return deferred.promise();
+    }
+
+    block.find('#grade-submissions-button')
+        .leanModal()
+        .on('click', function() {
+            loadStaffGrading(gradingCursor, true);
+        });
+    block.find('.grading-filters').on('change', function() {
+        var form = $(this);
+        gradingQuery.username = form.find('[name=username]').val();
+        gradingQuery.finalized = form.find('[name=finalized]').val();
+        gradingQuery.needs_approval = form.find('[name=needs_approval]').is(':checked') ? 'true' : '';
+        loadStaffGrading();
+    }).on('submit', function(event) {
+        event.preventDefault();
+        $(this).change();
+    });
+    block.find('#export-grades-button').attr('href', exportGradesUrl);
+    var gradesImport = block.find('.grades-import').fileupload({
+        url: importGradesUrl,
+        dataType: 'json',
+        done: function(e, data) {
+            showImportReport(data.result);
+            loadStaffGrading(gradingCursor, true);
+        },
+        fail: function(e, data) {
+            showImportReport(data.jqXHR && data.jqXHR.responseJSON);
+        }
+    });
+    updateChangeEvent(gradesImport);
+    block.find('#staff-debug-info-button')
+        .leanModal();
+
+    $(element).find('#download-init-button').click(function(e) {
+      e.preventDefault();
+      var self = this;
+      $.get(prepareDownloadSubmissionsUrl).then(
+        function(data) {
+          if (data["downloadable"]) {
+            if (data["parts"] > 1) {
+              showArchiveParts(data["parts"]);
+            } else {
+              window.location = downloadSubmissionsUrl;
+            }
+            $(self).removeClass("disabled");
+          } else {
+            $(self).addClass("disabled");
+            $(element).find('.task-message')
+              .show()
+              .html(preparingSubmissionsMsg)
+              .removeClass("ready-msg")
+              .addClass("preparing-msg");
+            pollSubmissionDownload();
+          }
+        }
+      ).fail(
+        function() {
+          $(self).removeClass("disabled");
+          $(element).find('.task-message')
+            .show()
+            .html(
+              interpolate(
+                gettext(
+                  'The download file was not created. Please try again or contact %(support_email)s'
+                ),
+                {support_email: $(element).find('.sga-block').attr("data-support-email")},
+                true
+              )
+            )
+            .removeClass("preparing-msg")
+            .addClass("ready-msg");
+        }
+      );
+    });
+}
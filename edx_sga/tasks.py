@@ -5,10 +5,16 @@ import hashlib
 import logging
 import os
 import tempfile
-import zipfile
 
+import six
+from celery.exceptions import MaxRetriesExceededError
+from django.conf import settings
 from django.core.files.storage import default_storage
-from edx_sga.constants import ITEM_TYPE
+from edx_sga.archive import (ArchiveProgress, acquire_archive_lock, build_manifest, delete_archive,
+                             get_build_timeout, get_submissions_fingerprint, release_archive_build,
+                             release_archive_lock, save_manifest, update_submissions_archive,
+                             write_submissions_archive, write_submissions_archive_parts)
+from edx_sga.constants import ARCHIVE_LOCK_RETRY_DELAY, ITEM_TYPE
 from edx_sga.utils import get_file_storage_path
 from lms import CELERY_APP  # pylint: disable=no-name-in-module
 from opaque_keys.edx.locator import BlockUsageLocator
@@ -20,7 +26,8 @@ log = logging.getLogger(__name__)
 
 def _get_student_submissions(block_id, course_id, locator):
     """
-    Returns valid submission file paths with the username of the student that submitted them.
+    Returns valid submission file paths with the uuid of the submission and the username of the student
+    that submitted them.
 
     Args:
         course_id (unicode): edx course id
@@ -28,7 +35,7 @@ def _get_student_submissions(block_id, course_id, locator):
         locator (BlockUsageLocator): BlockUsageLocator for the sga module
 
     Returns:
-        list(tuple): A list of 2-element tuples - (student username, submission file path)
+        list(tuple): A list of 3-element tuples - (submission uuid, student username, submission file path)
     """
     submissions = submissions_api.get_all_submissions(
         course_id,
@@ -37,6 +44,7 @@ def _get_student_submissions(block_id, course_id, locator):
     )
     return [
         (
+            submission['uuid'],
             user_by_anonymous_id(submission['student_id']).username,
             get_file_storage_path(
                 locator,
@@ -48,65 +56,162 @@ def _get_student_submissions(block_id, course_id, locator):
     ]
 
 
-def _compress_student_submissions(zip_file_path, block_id, course_id, locator):
+def _compress_student_submissions(
+        zip_file_path, block_id, course_id, locator, incremental=False, max_part_size=None, progress=None
+):
     """
     Creates a zip file of all student submissions for some course
 
     Args:
         destination_path (str): path (including name) of folder/file which we want to compress.
+        incremental (bool): Update the existing zip file if there is one, instead of rebuilding it
+        max_part_size (int): If set, split the archive into numbered zip files of about this many bytes at most
+        progress (ArchiveProgress): Publishes the progress of the build, if given
+
+    Returns:
+        dict: Metrics about the archive (see write_submissions_archive), or None if there was nothing to compress
     """
+    # Taken before listing submissions, so that any made meanwhile leave the archive stale
+    fingerprint = get_submissions_fingerprint(course_id, block_id)
     student_submissions = _get_student_submissions(block_id, course_id, locator)
     if not student_submissions:
-        return
+        delete_archive(zip_file_path)
+        return None
+
+    if max_part_size:
+        log.info(
+            "Compressing %d student submissions to parts of at most %d bytes at path: %s ",
+            len(student_submissions),
+            max_part_size,
+            zip_file_path
+        )
+        metrics = write_submissions_archive_parts(
+            zip_file_path, student_submissions, max_part_size, progress=progress
+        )
+        parts = [part['path'] for part in metrics['parts']]
+        save_manifest(zip_file_path, build_manifest(student_submissions, parts, fingerprint=fingerprint))
+        _log_archive_metrics(metrics)
+        return metrics
+
+    if incremental:
+        metrics = update_submissions_archive(
+            zip_file_path, student_submissions, fingerprint=fingerprint, progress=progress
+        )
+        if metrics is not None:
+            log.info(
+                "Updated zip file at path: %s, %d entries added and %d removed",
+                zip_file_path,
+                metrics['added'],
+                metrics['removed']
+            )
+            _log_archive_metrics(metrics)
+            return metrics
+        delete_archive(zip_file_path)
 
     log.info("Compressing %d student submissions to path: %s ", len(student_submissions), zip_file_path)
-    # Build the zip file in memory using temporary file.
+    # Build the zip file on disk using a temporary file, copying submissions in chunks
     with tempfile.TemporaryFile() as tmp:
-        with zipfile.ZipFile(tmp, 'w', compression=zipfile.ZIP_DEFLATED) as zip_pointer:
-            for student_username, submission_file_path in student_submissions:
-                log.info(
-                    "Creating zip file for student: %s, submission path: %s ",
-                    student_username,
-                    submission_file_path
-                )
-                with default_storage.open(submission_file_path, 'rb') as destination_file:
-                    filename_in_zip = '{}_{}'.format(
-                        student_username,
-                        os.path.basename(submission_file_path)
-                    )
-                    zip_pointer.writestr(filename_in_zip, destination_file.read())
+        metrics = write_submissions_archive(tmp, student_submissions, progress=progress)
         # Reset file pointer
         tmp.seek(0)
-        # Write the bytes of the in-memory zip file to an actual file
         log.info(
-            "Moving zip file from memory to storage at path: %s ", zip_file_path
+            "Moving zip file from temporary file to storage at path: %s ", zip_file_path
         )
         default_storage.save(zip_file_path, tmp)
+    # Saved last, as the archive is only served once its manifest matches the submissions
+    save_manifest(zip_file_path, build_manifest(student_submissions, [zip_file_path], fingerprint=fingerprint))
+    _log_archive_metrics(metrics)
+    return metrics
 
 
-@CELERY_APP.task
-def zip_student_submissions(course_id, block_id, locator_unicode, username):
+def _log_archive_metrics(metrics):
+    """
+    Logs the metrics returned when building a zip file
     """
-    Task to download all submissions as zip file
+    log.info(
+        "Compressed %(files)d submissions (%(bytes_read)d bytes read) into %(bytes_written)d bytes "
+        "in %(seconds)ss, peak memory %(peak_memory_kb)s kb",
+        metrics
+    )
+    for method, stats in sorted(metrics['compression'].items()):
+        log.info(
+            "Compression method: %s, %d files, %d bytes in %ss (%s MB/s)",
+            method,
+            stats['files'],
+            stats['bytes_read'],
+            stats['seconds'],
+            stats['mb_per_second']
+        )
+
+
+@CELERY_APP.task(bind=True)
+def zip_student_submissions(self, course_id, block_id, locator_unicode, username, fingerprint=None):
+    """
+    Task to download all submissions as zip file. When the SGA_ARCHIVE_MAX_PART_SIZE setting
+    is set, the submissions are split into numbered zip files of at most that many bytes.
+    Otherwise, when the SGA_ARCHIVE_INCREMENTAL setting is enabled, an existing zip file
+    is brought up to date rather than rebuilt.
+
+    Only one worker at a time builds a given zip file, the task is retried later while another one does.
+    The progress of the build is published for download_submissions_status to report it.
 
     Args:
         course_id (unicode): edx course id
         block_id (unicode): edx block id
         locator_unicode (unicode): Unicode representing a BlockUsageLocator for the sga module
         username (unicode): user name of the staff user requesting the zip file
+        fingerprint (unicode): Submissions fingerprint of the build claimed when the task was queued,
+            released once the task is done or runs out of retries
+
+    Returns:
+        dict: Metrics about the archive, or None if there were no submissions
     """
     locator = BlockUsageLocator.from_string(locator_unicode)
     zip_file_path = get_zip_file_path(username, course_id, block_id, locator)
-    log.info("Creating zip file for course: %s at path: %s", locator, zip_file_path)
-    if default_storage.exists(zip_file_path):
-        log.info("Deleting already-existing zip file at path: %s", zip_file_path)
-        default_storage.delete(zip_file_path)
-    _compress_student_submissions(
-        zip_file_path,
-        block_id,
-        course_id,
-        locator
-    )
+    lock_token = acquire_archive_lock(zip_file_path)
+    if lock_token is None:
+        log.info("Zip file at path: %s is being built by another worker, retrying later", zip_file_path)
+        try:
+            raise self.retry(
+                countdown=ARCHIVE_LOCK_RETRY_DELAY,
+                max_retries=get_build_timeout() // ARCHIVE_LOCK_RETRY_DELAY
+            )
+        except MaxRetriesExceededError:
+            # The task won't run again, so the build it claimed is not in flight anymore
+            if fingerprint is not None:
+                release_archive_build(zip_file_path, fingerprint)
+            raise
+
+    progress = ArchiveProgress(zip_file_path)
+    try:
+        incremental = getattr(settings, 'SGA_ARCHIVE_INCREMENTAL', False)
+        max_part_size = getattr(settings, 'SGA_ARCHIVE_MAX_PART_SIZE', None)
+        log.info("Creating zip file for course: %s at path: %s", locator, zip_file_path)
+        if max_part_size or not incremental:
+            log.info("Deleting any already-existing zip file at path: %s", zip_file_path)
+            delete_archive(zip_file_path)
+        metrics = _compress_student_submissions(
+            zip_file_path,
+            block_id,
+            course_id,
+            locator,
+            incremental=incremental,
+            max_part_size=max_part_size,
+            progress=progress
+        )
+    except Exception as error:
+        progress.fail(six.text_type(error) or error.__class__.__name__)
+        raise
+    else:
+        if metrics is None:
+            progress.fail("There are no submissions to download")
+        else:
+            progress.finish()
+        return metrics
+    finally:
+        release_archive_lock(zip_file_path, lock_token)
+        if fingerprint is not None:
+            release_archive_build(zip_file_path, fingerprint)
 
 
 def get_zip_file_dir(locator):
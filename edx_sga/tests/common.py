@@ -3,6 +3,7 @@ from __future__ import absolute_import
 
 import hashlib
 import shutil
+import time
 import unittest
 from contextlib import contextmanager
 from datetime import datetime
@@ -14,7 +15,7 @@ from mock import Mock
 import pytz
 from django.conf import settings
 from django.core.files.base import ContentFile
-from django.core.files.storage import default_storage
+from django.core.files.storage import FileSystemStorage, default_storage
 from xblock.fields import DateTime
 
 
@@ -84,6 +85,19 @@ class TempfileMixin(unittest.TestCase):
                 default_storage.delete(rel_file_path)
 
 
+class SlowStorage(FileSystemStorage):
+    """
+    Local file storage which waits before opening each file, to stand in for remote storage
+    """
+    def __init__(self, latency, **kwargs):
+        super(SlowStorage, self).__init__(**kwargs)
+        self.latency = latency
+
+    def _open(self, name, mode='rb'):
+        time.sleep(self.latency)
+        return super(SlowStorage, self)._open(name, mode)
+
+
 class DummyResource(object):
     """
      A Resource class for use in tests
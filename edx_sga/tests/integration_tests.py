@@ -4,8 +4,10 @@ Tests for SGA
 """
 from __future__ import absolute_import
 
+import csv
 import datetime
 import html
+import io
 import json
 import os
 import shutil
@@ -20,12 +22,16 @@ import pytz
 from ddt import data, ddt, unpack
 from django.contrib.auth.models import User
 from django.core.exceptions import PermissionDenied
-from django.db import transaction
-from django.test.utils import override_settings
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from django.test.utils import CaptureQueriesContext, override_settings
 from edx_sga.constants import ShowAnswer
+from edx_sga.gradebook import iter_grades_csv
+from edx_sga.grading import make_grading_row
 from edx_sga.sga import StaffGradedAssignmentXBlock
 from edx_sga.tests.common import (DummyResource, TempfileMixin, get_sha1,
                                   is_near_now, parse_timestamp, reformat_xml)
+from edx_sga.utils import encode_cursor
 from lms.djangoapps.courseware import module_render as render
 from lms.djangoapps.courseware.models import StudentModule
 from lms.djangoapps.courseware.tests.factories import StaffFactory
@@ -35,6 +41,7 @@ from student.models import UserProfile, anonymous_id_for_user
 from student.tests.factories import AdminFactory
 from submissions import api as submissions_api
 from submissions.models import StudentItem
+from xblock.exceptions import JsonHandlerError
 from xblock.field_data import DictFieldData
 from xblock.fields import ScopeIds
 from xmodule.modulestore.django import modulestore
@@ -477,7 +484,9 @@ class StaffGradedAssignmentXblockTests(TempfileMixin, ModuleStoreTestCase):
                 'module_id': fred.id
             })
             resp = block.staff_upload_annotated(request)
-        assert resp.json == block.staff_grading_data()
+        assert resp.json == dict(
+            block.staff_grading_row(block.get_student_module(fred.id)), previous_version=resp.json['previous_version']
+        )
         state = json.loads(block.get_student_module(fred.id).state)
         assert state['annotated_mimetype'] == 'text/plain'
         parsed_date = parse_timestamp(state['annotated_timestamp'])
@@ -703,6 +712,123 @@ class StaffGradedAssignmentXblockTests(TempfileMixin, ModuleStoreTestCase):
         assert fred_assignment['submission_id'] == fred['submission']['uuid']
         assert is_near_now(parse_timestamp(fred_assignment['timestamp']))
 
+    def test_get_staff_grading_data_paginated(self):
+        """
+        Test fetching sorted pages of grading data with cursors
+        """
+        block = self.make_one()
+        for index, name in enumerate(["carol", "alice", "dave", "bob", "eve"]):
+            self.make_student(block, name, filename="foo.txt", score=index * 10)
+
+        data = block.get_staff_grading_data(mock.Mock(params={  # lint-amnesty, pylint: disable=redefined-outer-name
+            'page_size': '2', 'sort_by': 'username', 'order': 'asc'
+        })).json_body
+        assert [assignment['username'] for assignment in data['assignments']] == ["alice", "bob"]
+        assert data['total'] == 5
+        assert data['previous_cursor'] is None
+
+        data = block.get_staff_grading_data(mock.Mock(params={'cursor': data['next_cursor']})).json_body
+        assert [assignment['username'] for assignment in data['assignments']] == ["carol", "dave"]
+        assert data['offset'] == 2
+        assert data['previous_cursor'] is not None
+
+        data = block.get_staff_grading_data(mock.Mock(params={'cursor': data['next_cursor']})).json_body
+        assert [assignment['username'] for assignment in data['assignments']] == ["eve"]
+        assert data['next_cursor'] is None
+
+        data = block.get_staff_grading_data(mock.Mock(params={
+            'page_size': '10', 'sort_by': 'score', 'order': 'desc', 'username': 'E'
+        })).json_body
+        assert [assignment['username'] for assignment in data['assignments']] == ["eve", "dave", "alice"]
+        assert data['total'] == 3
+
+    @data(
+        ('username', ["Dan", "Carol"], 2),
+        ('timestamp', ["dave", "alice"], 2),
+        ('score', ["dave", "alice"], 4),
+    )
+    @unpack
+    def test_get_staff_grading_data_database_page(self, sort_by, expected, rows_built):
+        """
+        Pages sorted by username or timestamp are sorted and sliced by the database, so rows are only
+        built for the students on them. Other sorts build every row matching the username filter.
+        """
+        block = self.make_one()
+        for index, name in enumerate(["Carol", "alice", "dave", "bob", "eve", "Dan"]):
+            self.make_student(block, name, filename="foo.txt", score=index)
+
+        with mock.patch('edx_sga.grading.make_grading_row', wraps=make_grading_row) as mocked_make_row:
+            data = block.get_staff_grading_data(mock.Mock(params={  # lint-amnesty, pylint: disable=redefined-outer-name
+                'page_size': '2', 'offset': '1', 'sort_by': sort_by, 'order': 'desc', 'username': 'a'
+            })).json_body
+        assert [assignment['username'] for assignment in data['assignments']] == expected
+        assert data['total'] == 4
+        assert mocked_make_row.call_count == rows_built
+
+    @data(
+        {'page_size': '0'},
+        {'page_size': 'ten'},
+        {'page_size': '10', 'sort_by': 'fullname'},
+        {'page_size': '10', 'order': 'up'},
+        {'page_size': '10', 'finalized': 'maybe'},
+        {'cursor': 'garbage'},
+        {'cursor': encode_cursor({'username': 5})},
+        {'cursor': encode_cursor({'finalized': 1})},
+        {'cursor': encode_cursor({'needs_approval': ['yes']})},
+    )
+    def test_get_staff_grading_data_invalid_query(self, params):
+        """
+        Invalid pagination parameters should be rejected
+        """
+        block = self.make_one()
+        with self.assertRaises(JsonHandlerError):
+            block.get_staff_grading_data(mock.Mock(params=params))
+
+    def test_staff_grading_data_query_count(self):
+        """
+        The number of queries needed for the grading data should not depend on the number of students
+        """
+        block = self.make_one()
+        for index in range(2):
+            self.make_student(block, "student{}".format(index), filename="foo.txt", score=index)
+        with CaptureQueriesContext(connection) as queries_for_two:
+            assert len(block.staff_grading_data()['assignments']) == 2
+
+        for index in range(2, 6):
+            self.make_student(block, "student{}".format(index), filename="foo.txt", comment="ok")
+        with CaptureQueriesContext(connection) as queries_for_six:
+            assignments = block.staff_grading_data()['assignments']
+        assert len(assignments) == 6
+        assert len(queries_for_six) == len(queries_for_two)
+        assert [assignment['username'] for assignment in assignments] == [
+            "student{}".format(index) for index in range(6)
+        ]
+
+    @mock.patch('edx_sga.sga._resource', DummyResource)
+    @mock.patch('edx_sga.sga.render_template')
+    @mock.patch('edx_sga.sga.Fragment')
+    def test_student_view_query_count(self, fragment, render_template):
+        # pylint: disable=unused-argument
+        """
+        A learner's view should fetch their submission and their score only once
+        """
+        block = self.make_one(showanswer=ShowAnswer.FINISHED)
+        self.personalize(block, **self.make_student(
+            block, 'fred', filename='foo.txt', score=10))
+        with mock.patch(
+            'edx_sga.sga.submissions_api.get_submissions',
+            wraps=submissions_api.get_submissions
+        ) as get_submissions, mock.patch(
+            'edx_sga.sga.submissions_api.get_score',
+            wraps=submissions_api.get_score
+        ) as get_score:
+            block.student_view()
+        assert get_submissions.call_count == 1
+        assert get_score.call_count == 1
+        student_state = json.loads(render_template.call_args[0][1]['student_state'])
+        assert student_state['graded']['score'] == 10
+        assert student_state['upload_allowed'] is False
+
     @mock.patch('edx_sga.sga.log')
     def test_assert_logging_when_student_module_created(self, mocked_log):
         """
@@ -742,6 +868,245 @@ class StaffGradedAssignmentXblockTests(TempfileMixin, ModuleStoreTestCase):
         self.assertEqual(state['comment'], 'Good!')
         self.assertEqual(block.get_score(fred['item'].student_id), 9)
 
+    def test_enter_grade_returns_row(self):
+        # pylint: disable=no-member
+        """
+        enter_grade should only return the updated row and the new version of the grading data
+        """
+        block = self.make_one()
+        block.is_instructor = lambda: True
+        fred = self.make_student(block, "fred5", filename='foo.txt')
+        self.make_student(block, "barney", filename='bar.txt')
+        version = block.staff_grading_data()['version']
+        data = block.enter_grade(mock.Mock(params={  # lint-amnesty, pylint: disable=redefined-outer-name
+            'module_id': fred['module'].id,
+            'submission_id': fred['submission']['uuid'],
+            'grade': 9,
+            'comment': "Good!"})).json_body
+        assert 'assignments' not in data
+        assert data['assignment']['module_id'] == fred['module'].id
+        assert data['assignment']['score'] == 9
+        assert data['assignment']['comment'] == "Good!"
+        assert data['previous_version'] == version
+        assert data['version'] != version
+        assert data['version'] == block.staff_grading_data()['version']
+
+    def test_enter_grade_two_graders(self):
+        """
+        A grader whose table is behind another grader's change should not be given the version
+        which includes it along with the row they graded
+        """
+        block = self.make_one()
+        block.is_instructor = lambda: True
+        fred = self.make_student(block, "fred", filename='foo.txt')
+        barney = self.make_student(block, "barney", filename='bar.txt')
+        first_grader_version = block.staff_grading_data()['version']
+        second_grader_version = block.staff_grading_data()['version']
+
+        data = block.enter_grade(mock.Mock(params={  # lint-amnesty, pylint: disable=redefined-outer-name
+            'module_id': barney['module'].id,
+            'submission_id': barney['submission']['uuid'],
+            'grade': 7,
+            'comment': ''})).json_body
+        # The second grader's table was current, so it may take the new version
+        assert data['previous_version'] == second_grader_version
+
+        data = block.enter_grade(mock.Mock(params={
+            'module_id': fred['module'].id,
+            'submission_id': fred['submission']['uuid'],
+            'grade': 9,
+            'comment': ''})).json_body
+        # The first grader's table misses barney's grade, so it must be reloaded
+        assert data['previous_version'] != first_grader_version
+        data = block.get_staff_grading_data(mock.Mock(params={'version': first_grader_version})).json_body
+        assert 'unchanged' not in data
+        assert [assignment['score'] for assignment in data['assignments']] == [9, 7]
+
+    def test_enter_grade_staff_changes_version(self):
+        """
+        Every grade entered by staff should change the version, even within the same second
+        """
+        block = self.make_one()
+        fred = self.make_student(block, "fred", filename='foo.txt')
+        versions = {block.staff_grading_data()['version']}
+        # The modified time of the student state does not change between the grades
+        now = datetime.datetime.now(pytz.utc).replace(microsecond=0)
+        with mock.patch('django.utils.timezone.now', return_value=now):
+            for grade in (8, 9):
+                data = block.enter_grade(mock.Mock(params={  # lint-amnesty, pylint: disable=redefined-outer-name
+                    'module_id': fred['module'].id,
+                    'submission_id': fred['submission']['uuid'],
+                    'grade': grade,
+                    'comment': ''})).json_body
+                assert data['version'] not in versions
+                versions.add(data['version'])
+
+    def import_grades(self, block, content):
+        """
+        Posts a CSV file of grades to the import_grades handler
+        """
+        upload = mock.Mock(file=io.BytesIO(content.encode('utf-8')))
+        return block.import_grades(mock.Mock(params={'grades': upload}))
+
+    def test_import_grades_instructor(self):
+        # pylint: disable=no-member
+        """
+        Instructors import scores and comments for every student of the file
+        """
+        block = self.make_one()
+        block.is_instructor = lambda: True
+        fred = self.make_student(block, "fred", filename='foo.txt', comment='Old')
+        barney = self.make_student(block, "barney", filename='bar.txt')
+        wilma = self.make_student(block, "wilma", filename='baz.txt', comment='Kept')
+        version = block.staff_grading_data()['version']
+
+        response = self.import_grades(block, u"Username,Score,Comment\nfred,9,Good!\n\nbarney,7,\n")
+        assert response.status_code == 200
+        assert response.json_body['rows'] == 2
+        assert response.json_body['imported'] == 2
+        assert response.json_body['errors'] == []
+        assert response.json_body['version'] != version
+        assert block.get_score(fred['item'].student_id) == 9
+        assert block.get_score(barney['item'].student_id) == 7
+        assert block.get_score(wilma['item'].student_id) is None
+        for student, comment in ((fred, 'Good!'), (barney, ''), (wilma, 'Kept')):
+            state = json.loads(StudentModule.objects.get(pk=student['module'].id).state)
+            assert state['comment'] == comment
+
+    def test_import_grades_keeps_comments(self):
+        # pylint: disable=no-member
+        """
+        Comments are left alone when the file has no comment column
+        """
+        block = self.make_one()
+        block.is_instructor = lambda: True
+        fred = self.make_student(block, "fred", filename='foo.txt', comment='Old')
+        response = self.import_grades(block, u"username,score\nfred,9\n")
+        assert response.json_body['imported'] == 1
+        state = json.loads(StudentModule.objects.get(pk=fred['module'].id).state)
+        assert state['comment'] == 'Old'
+
+    def test_import_grades_staff(self):
+        # pylint: disable=no-member
+        """
+        Staff import scores which need an instructor's approval, and cannot change approved scores
+        """
+        block = self.make_one()
+        block.is_instructor = lambda: False
+        fred = self.make_student(block, "fred", filename='foo.txt')
+        self.make_student(block, "barney", filename='bar.txt', score=5)
+
+        response = self.import_grades(block, u"username,score\nfred,9\nbarney,7\n")
+        assert response.status_code == 400
+        assert response.json_body['errors'] == ["Line 3: the grade of barney was already approved"]
+
+        receiver = mock.Mock()
+        post_save.connect(receiver, sender=StudentModule)
+        try:
+            response = self.import_grades(block, u"username,score\nfred,9\n")
+        finally:
+            post_save.disconnect(receiver, sender=StudentModule)
+        assert response.status_code == 200
+        state = json.loads(StudentModule.objects.get(pk=fred['module'].id).state)
+        assert state['staff_score'] == 9
+        assert block.get_score(fred['item'].student_id) is None
+        # The state is saved like enter_grade saves it, so its history is recorded
+        assert [call[1]['instance'].id for call in receiver.call_args_list] == [fred['module'].id]
+
+    def test_import_grades_invalid(self):
+        # pylint: disable=no-member
+        """
+        Nothing is imported unless every row of the file is valid
+        """
+        block = self.make_one()
+        block.is_instructor = lambda: True
+        fred = self.make_student(block, "fred", filename='foo.txt')
+        self.make_student(block, "barney", filename='bar.txt')
+        self.make_student(block, "wilma", filename='baz.txt')
+
+        response = self.import_grades(block, u"username,score\nfred,9\nbarney,abc\nwilma,101\nfred,3\n,4\n")
+        assert response.status_code == 400
+        assert response.json_body['imported'] == 0
+        assert response.json_body['errors'] == [
+            "Line 3: score must be an integer",
+            "Line 4: score must be between 0 and 100",
+            "Line 5: fred was already graded on line 2",
+            "Line 6: missing username",
+        ]
+        response = self.import_grades(block, u"username,score\nfred,9\nbetty,4\n")
+        assert response.json_body['errors'] == ["Line 3: betty has no submission"]
+        response = self.import_grades(block, u"name,grade\nfred,9\n")
+        assert response.json_body['errors'] == ["Missing column: username", "Missing column: score"]
+        assert block.get_score(fred['item'].student_id) is None
+
+    def test_export_grades(self):
+        """
+        The grading table is exported as CSV, one row per student with a submission
+        """
+        block = self.make_one()
+        self.make_student(block, "fred", filename='foo.txt', finalized=True, score=9, comment=u'Très bien')
+        self.make_student(block, "barney", filename='bar.txt', staff_score=7)
+        self.make_student(block, "wilma", filename='baz.txt', finalized=False)
+        self.make_student(block, "betty")
+
+        response = block.export_grades(None)
+        assert response.content_type == 'text/csv'
+        assert response.content_disposition == 'attachment; filename=name_grades.csv'
+        rows = list(csv.reader(io.StringIO(b''.join(response.app_iter).decode('utf-8'))))
+        assert rows[0] == [
+            'username', 'fullname', 'timestamp', 'finalized', 'score', 'approval', 'comment', 'filename'
+        ]
+        assert sorted((row[0], row[3], row[4], row[5], row[6], row[7]) for row in rows[1:]) == [
+            ('barney', 'yes', '7', 'awaiting approval', '', 'bar.txt'),
+            ('fred', 'yes', '9', 'approved', u'Très bien', 'foo.txt'),
+            ('wilma', 'no', '', '', '', 'baz.txt'),
+        ]
+
+    def test_export_grades_escapes_formulas(self):
+        """
+        Text which a spreadsheet would run as a formula is exported with a quote, which the import removes
+        """
+        block = self.make_one()
+        block.is_instructor = lambda: True
+        fred = self.make_student(block, "fred", filename='foo.txt', comment='-1 for lateness')
+        UserProfile.objects.filter(user__username='fred').update(name='=HYPERLINK("http://example.com")')
+
+        rows = list(csv.reader(io.StringIO(b''.join(iter_grades_csv(block)).decode('utf-8'))))
+        assert (rows[1][1], rows[1][6]) == ('\'=HYPERLINK("http://example.com")', "'-1 for lateness")
+
+        response = self.import_grades(block, u"username,score,comment\nfred,9,'-1 for lateness\n")
+        assert response.status_code == 200
+        state = json.loads(StudentModule.objects.get(pk=fred['module'].id).state)
+        assert state['comment'] == '-1 for lateness'
+
+    def test_export_grades_batches(self):
+        """
+        Rows are written a batch at a time
+        """
+        block = self.make_one()
+        for index in range(5):
+            self.make_student(block, "student{}".format(index), filename="foo.txt")
+        chunks = list(iter_grades_csv(block, batch_size=2))
+        assert len(chunks) == 4
+        assert [chunk.count(b'\r\n') for chunk in chunks] == [1, 2, 2, 1]
+
+    def test_get_staff_grading_data_unchanged(self):
+        """
+        The grading data should not be sent again if the client already has its current version
+        """
+        block = self.make_one()
+        self.make_student(block, "fred", filename="foo.txt")
+        version = block.get_staff_grading_data(None).json_body['version']
+        data = block.get_staff_grading_data(  # lint-amnesty, pylint: disable=redefined-outer-name
+            mock.Mock(params={'version': version, 'page_size': '50'})
+        ).json_body
+        assert data == {'version': version, 'unchanged': True}
+
+        self.make_student(block, "barney", filename="bar.txt")
+        data = block.get_staff_grading_data(mock.Mock(params={'version': version, 'page_size': '50'})).json_body
+        assert data['version'] != version
+        assert len(data['assignments']) == 2
+
     def test_enter_grade_staff(self):
         # pylint: disable=no-member
         """
@@ -0,0 +1,457 @@
+"""
+Tests for building submission archives
+"""
+from __future__ import absolute_import
+
+import io
+import tempfile
+import threading
+import time
+import zipfile
+
+import mock
+import pytest
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from edx_sga.archive import (ArchiveProgress, acquire_archive_lock, build_manifest, claim_archive_build,
+                             delete_archive, fetch_submission, get_archive_part_path, get_archive_parts,
+                             get_archive_progress, get_compress_type,
+                             get_manifest_path, get_submissions_fingerprint, is_archive_fresh, read_manifest,
+                             release_archive_build, release_archive_lock, save_manifest,
+                             update_submissions_archive, write_submissions_archive,
+                             wait_for_archive_progress, write_submissions_archive_parts, write_zip_entry)
+from edx_sga.tests.common import SlowStorage
+from submissions import api as submissions_api
+
+
+class RecordingReader(io.BytesIO):
+    """
+    In-memory file which records the size of every read
+    """
+    def __init__(self, *args, **kwargs):
+        super(RecordingReader, self).__init__(*args, **kwargs)
+        self.read_sizes = []
+
+    def read(self, size=-1):  # pylint: disable=arguments-differ
+        data = super(RecordingReader, self).read(size)
+        self.read_sizes.append(size)
+        return data
+
+
+@pytest.fixture
+def storage_root(settings, tmpdir):
+    """
+    Points default_storage at a temporary directory
+    """
+    settings.DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+    settings.MEDIA_ROOT = str(tmpdir)
+    return tmpdir
+
+
+def test_write_zip_entry_reads_in_chunks():
+    """
+    write_zip_entry should never read more than chunk_size bytes of the source at once
+    """
+    contents = b'0123456789' * 1000
+    source = RecordingReader(contents)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zip_file:
+        assert write_zip_entry(zip_file, 'entry.txt', source, chunk_size=512) == len(contents)
+
+    assert source.read_sizes
+    assert all(0 < size <= 512 for size in source.read_sizes)
+    with zipfile.ZipFile(archive) as zip_file:
+        assert zip_file.read('entry.txt') == contents
+
+
+def test_write_submissions_archive(storage_root):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    write_submissions_archive should zip every submission and report metrics about the archive
+    """
+    files = {
+        'org/course/sga/abc/one.txt': b'first submission',
+        'org/course/sga/def/two.pdf': b'\x00\x01' * 5000,
+    }
+    for path, contents in files.items():
+        default_storage.save(path, ContentFile(contents))
+
+    archive = io.BytesIO()
+    metrics = write_submissions_archive(
+        archive,
+        [('uuid1', 'alice', 'org/course/sga/abc/one.txt'), ('uuid2', 'bob', 'org/course/sga/def/two.pdf')],
+        chunk_size=1024
+    )
+
+    with zipfile.ZipFile(archive) as zip_file:
+        assert sorted(zip_file.namelist()) == ['alice_one.txt', 'bob_two.pdf']
+        assert zip_file.read('alice_one.txt') == files['org/course/sga/abc/one.txt']
+        assert zip_file.read('bob_two.pdf') == files['org/course/sga/def/two.pdf']
+    assert metrics['files'] == 2
+    assert metrics['bytes_read'] == sum(len(contents) for contents in files.values())
+    assert metrics['bytes_written'] == len(archive.getvalue())
+    assert metrics['peak_memory_kb'] > 0
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_write_submissions_archive_order(storage_root, workers):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    Entries should be written in the order of the submissions whatever the number of fetch workers
+    """
+    student_submissions = []
+    for index in range(10):
+        path = 'org/course/sga/{index}/file{index}.txt'.format(index=index)
+        default_storage.save(path, ContentFile(b'x' * (10 - index) * 100))
+        student_submissions.append(('uuid{}'.format(index), 'user{}'.format(index), path))
+
+    archive = io.BytesIO()
+    metrics = write_submissions_archive(archive, student_submissions, workers=workers)
+
+    with zipfile.ZipFile(archive) as zip_file:
+        assert zip_file.namelist() == [
+            'user{index}_file{index}.txt'.format(index=index) for index in range(10)
+        ]
+    assert metrics['workers'] == workers
+
+
+def test_parallel_fetch_speedup(tmpdir):
+    """
+    Fetching submissions concurrently should hide most of the storage latency
+    """
+    storage = SlowStorage(latency=0.05, location=str(tmpdir))
+    student_submissions = []
+    for index in range(16):
+        path = 'sga/{}.bin'.format(index)
+        storage.save(path, ContentFile(b'\x00' * 50000))
+        student_submissions.append(('uuid{}'.format(index), 'user{}'.format(index), path))
+
+    with mock.patch('edx_sga.archive.default_storage', storage):
+        sequential = write_submissions_archive(io.BytesIO(), student_submissions, workers=1)
+        parallel = write_submissions_archive(io.BytesIO(), student_submissions, workers=8)
+
+    assert sequential['seconds'] >= 16 * 0.05
+    assert parallel['seconds'] < sequential['seconds'] / 2
+
+
+def _save_submission(submission_uuid, username, contents):
+    """
+    Saves a submission file to default_storage and returns its archive tuple
+    """
+    path = default_storage.save('org/course/sga/{}/file.txt'.format(submission_uuid), ContentFile(contents))
+    return submission_uuid, username, path
+
+
+def _save_archive(zip_file_path, student_submissions):
+    """
+    Builds an archive and its manifest in default_storage
+    """
+    archive = io.BytesIO()
+    write_submissions_archive(archive, student_submissions)
+    archive.seek(0)
+    default_storage.save(zip_file_path, ContentFile(archive.getvalue()))
+    save_manifest(zip_file_path, build_manifest(student_submissions, [zip_file_path]))
+
+
+def _read_archive(zip_file_path):
+    """
+    Returns the contents of each entry of an archive in default_storage
+    """
+    with default_storage.open(zip_file_path, 'rb') as zip_file:
+        with zipfile.ZipFile(zip_file) as archive:
+            return {name: archive.read(name) for name in archive.namelist()}
+
+
+@pytest.mark.parametrize('remote', [False, True])
+def test_update_submissions_archive(storage_root, remote):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    update_submissions_archive should only fetch new submissions and drop replaced or removed ones
+    """
+    zip_file_path = 'org/course/sga_zipped/submissions.zip'
+    kept = _save_submission('kept', 'alice', b'alice submission')
+    replaced = _save_submission('replaced', 'bob', b'bob first submission')
+    removed = _save_submission('removed', 'carol', b'carol submission')
+    _save_archive(zip_file_path, [kept, replaced, removed])
+
+    replacement = _save_submission('replacement', 'bob', b'bob second submission')
+    added = _save_submission('added', 'dave', b'dave submission')
+    local_path = None if remote else default_storage.path(zip_file_path)
+    with mock.patch('edx_sga.archive._get_local_path', return_value=local_path):
+        with mock.patch('edx_sga.archive.fetch_submission', wraps=fetch_submission) as fetch:
+            metrics = update_submissions_archive(zip_file_path, [kept, replacement, added], fingerprint='new')
+
+    assert sorted(call[0][0] for call in fetch.call_args_list) == sorted([replacement[2], added[2]])
+    assert metrics['added'] == 2
+    assert metrics['removed'] == 2
+    assert _read_archive(zip_file_path) == {
+        'alice_file.txt': b'alice submission',
+        'bob_file.txt': b'bob second submission',
+        'dave_file.txt': b'dave submission',
+    }
+    manifest = read_manifest(zip_file_path)
+    assert manifest['fingerprint'] == 'new'
+    assert manifest['entries'] == {
+        'kept': 'alice_file.txt',
+        'replacement': 'bob_file.txt',
+        'added': 'dave_file.txt',
+    }
+
+
+@pytest.mark.parametrize('remote', [False, True])
+def test_update_submissions_archive_append(
+        storage_root, remote
+):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    update_submissions_archive should keep the existing entries when submissions are only added
+    """
+    zip_file_path = 'org/course/sga_zipped/submissions.zip'
+    kept = _save_submission('kept', 'alice', b'alice submission')
+    _save_archive(zip_file_path, [kept])
+
+    added = _save_submission('added', 'bob', b'bob submission')
+    local_path = None if remote else default_storage.path(zip_file_path)
+    with mock.patch('edx_sga.archive._get_local_path', return_value=local_path):
+        with mock.patch('edx_sga.archive.fetch_submission', wraps=fetch_submission) as fetch:
+            metrics = update_submissions_archive(zip_file_path, [kept, added], fingerprint='new')
+
+    assert [call[0][0] for call in fetch.call_args_list] == [added[2]]
+    assert metrics['added'] == 1
+    assert metrics['removed'] == 0
+    assert metrics['bytes_written'] == default_storage.size(zip_file_path)
+    assert _read_archive(zip_file_path) == {
+        'alice_file.txt': b'alice submission',
+        'bob_file.txt': b'bob submission',
+    }
+
+
+def test_update_submissions_archive_rebuild(storage_root):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    update_submissions_archive should ask for a rebuild without a manifest or for a multi-part archive
+    """
+    zip_file_path = 'org/course/sga_zipped/submissions.zip'
+    submission = _save_submission('uuid', 'alice', b'alice submission')
+    _save_archive(zip_file_path, [submission])
+
+    save_manifest(zip_file_path, build_manifest([submission], [zip_file_path, zip_file_path + '.2']))
+    assert update_submissions_archive(zip_file_path, [submission]) is None
+
+    default_storage.delete(get_manifest_path(zip_file_path))
+    assert update_submissions_archive(zip_file_path, [submission]) is None
+
+
+def test_is_archive_fresh(storage_root):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    An archive is fresh only if its manifest was saved with the current submissions fingerprint
+    """
+    zip_file_path = 'org/course/sga_zipped/submissions.zip'
+    assert is_archive_fresh(read_manifest(zip_file_path), 'fingerprint') is False
+    assert get_archive_parts(read_manifest(zip_file_path)) == []
+
+    save_manifest(zip_file_path, build_manifest([], [zip_file_path], fingerprint='fingerprint'))
+    assert is_archive_fresh(read_manifest(zip_file_path), 'fingerprint') is True
+    assert is_archive_fresh(read_manifest(zip_file_path), 'other') is False
+    assert get_archive_parts(read_manifest(zip_file_path)) == [zip_file_path]
+
+    default_storage.delete(get_manifest_path(zip_file_path))
+    default_storage.save(get_manifest_path(zip_file_path), ContentFile(b'not json'))
+    assert is_archive_fresh(read_manifest(zip_file_path), 'fingerprint') is False
+
+
+@pytest.mark.django_db
+def test_get_submissions_fingerprint():
+    """
+    The fingerprint should change when a submission to the block is made or removed
+    """
+    student_item = {
+        'student_id': 'student',
+        'course_id': 'org/course/run',
+        'item_id': 'block',
+        'item_type': 'sga',
+    }
+    empty = get_submissions_fingerprint('org/course/run', 'block')
+
+    submissions_api.create_submission(student_item, {'filename': 'file.txt', 'sha1': 'abc'})
+    submitted = get_submissions_fingerprint('org/course/run', 'block')
+    assert submitted != empty
+    assert get_submissions_fingerprint('org/course/run', 'other block') == empty
+
+    submissions_api.reset_score('student', 'org/course/run', 'block', clear_state=True)
+    assert get_submissions_fingerprint('org/course/run', 'block') == empty
+
+
+@pytest.mark.parametrize('filename,compress_type', [
+    ('essay.txt', zipfile.ZIP_DEFLATED),
+    ('data.json', zipfile.ZIP_DEFLATED),
+    ('unknown.extension', zipfile.ZIP_DEFLATED),
+    ('report.pdf', zipfile.ZIP_STORED),
+    ('photo.jpg', zipfile.ZIP_STORED),
+    ('video.mp4', zipfile.ZIP_STORED),
+])
+def test_get_compress_type(filename, compress_type):
+    """
+    Text-like files should be deflated and already compressed ones stored
+    """
+    assert get_compress_type(filename) == compress_type
+
+
+def test_get_compress_type_setting(settings):
+    """
+    The mimetypes which get deflated should be configurable
+    """
+    settings.SGA_ARCHIVE_DEFLATE_MIMETYPES = ['application/pdf']
+    assert get_compress_type('report.pdf') == zipfile.ZIP_DEFLATED
+    assert get_compress_type('essay.txt') == zipfile.ZIP_STORED
+
+
+def test_write_submissions_archive_compression(storage_root):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    The archive should store already compressed files and report metrics for each compression method
+    """
+    student_submissions = [
+        ('uuid1', 'alice', default_storage.save('sga/essay.txt', ContentFile(b'words ' * 1000))),
+        ('uuid2', 'bob', default_storage.save('sga/report.pdf', ContentFile(b'%PDF' * 1000))),
+    ]
+    archive = io.BytesIO()
+    metrics = write_submissions_archive(archive, student_submissions)
+
+    with zipfile.ZipFile(archive) as zip_file:
+        assert zip_file.getinfo('alice_essay.txt').compress_type == zipfile.ZIP_DEFLATED
+        assert zip_file.getinfo('bob_report.pdf').compress_type == zipfile.ZIP_STORED
+    assert sorted(metrics['compression']) == ['deflated', 'stored']
+    assert metrics['compression']['deflated']['files'] == 1
+    assert metrics['compression']['stored']['bytes_read'] == 4000
+
+
+def test_write_submissions_archive_parts(storage_root):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    Submissions should be split into parts which stay under the maximum size, except for a single larger file
+    """
+    zip_file_path = 'org/course/sga_zipped/submissions.zip'
+    sizes = [4000, 4000, 4000, 12000, 1000]
+    student_submissions = [
+        ('uuid{}'.format(index), 'user{}'.format(index), default_storage.save(
+            'sga/{}/video.mp4'.format(index), ContentFile(b'\x01' * size)
+        ))
+        for index, size in enumerate(sizes)
+    ]
+
+    metrics = write_submissions_archive_parts(zip_file_path, student_submissions, max_part_size=10000)
+
+    assert [part['path'] for part in metrics['parts']] == [
+        get_archive_part_path(zip_file_path, number) for number in (1, 2, 3, 4)
+    ]
+    assert [part['files'] for part in metrics['parts']] == [2, 1, 1, 1]
+    assert metrics['bytes_written'] == sum(part['size'] for part in metrics['parts'])
+    names = []
+    for part in metrics['parts']:
+        assert part['size'] == default_storage.size(part['path'])
+        if part['files'] > 1:
+            assert part['size'] <= 10000
+        names.extend(_read_archive(part['path']))
+    assert names == ['user{index}_video.mp4'.format(index=index) for index in range(len(sizes))]
+
+    save_manifest(zip_file_path, build_manifest(student_submissions, [part['path'] for part in metrics['parts']]))
+    delete_archive(zip_file_path)
+    assert not any(default_storage.exists(part['path']) for part in metrics['parts'])
+    assert read_manifest(zip_file_path) is None
+
+
+def test_zip64_entry_count():
+    """
+    Archives with more entries than fit in a classic zip central directory should be readable
+    """
+    entries = 2 ** 16 + 10
+    archive = tempfile.TemporaryFile()
+    with archive:
+        with zipfile.ZipFile(archive, 'w', allowZip64=True) as zip_file:
+            for index in range(entries):
+                write_zip_entry(zip_file, '{}.txt'.format(index), io.BytesIO(b'x'), compress_type=zipfile.ZIP_STORED)
+        archive.seek(0)
+        with zipfile.ZipFile(archive) as zip_file:
+            assert len(zip_file.infolist()) == entries
+            assert zip_file.read('{}.txt'.format(entries - 1)) == b'x'
+
+
+def test_claim_archive_build():
+    """
+    Only the first request for a build of the same archive and submissions should start it
+    """
+    cache.clear()
+    assert claim_archive_build('archive.zip', 'fingerprint') is True
+    assert claim_archive_build('archive.zip', 'fingerprint') is False
+    assert claim_archive_build('archive.zip', 'other fingerprint') is True
+    assert claim_archive_build('other.zip', 'fingerprint') is True
+
+    release_archive_build('archive.zip', 'fingerprint')
+    assert claim_archive_build('archive.zip', 'fingerprint') is True
+
+
+def test_archive_lock():
+    """
+    Only one worker at a time should hold the lock of an archive
+    """
+    cache.clear()
+    token = acquire_archive_lock('archive.zip')
+    assert token is not None
+    assert acquire_archive_lock('archive.zip') is None
+    assert acquire_archive_lock('other.zip') is not None
+
+    release_archive_lock('archive.zip', 'someone else')
+    assert acquire_archive_lock('archive.zip') is None
+    release_archive_lock('archive.zip', token)
+    assert acquire_archive_lock('archive.zip') is not None
+
+
+def test_archive_progress(storage_root):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    The progress of an archive build should be readable from the cache while it runs
+    """
+    cache.clear()
+    assert get_archive_progress('archive.zip') is None
+
+    progress = ArchiveProgress('archive.zip')
+    progress.queue()
+    assert get_archive_progress('archive.zip')['state'] == 'queued'
+
+    subs = [_save_submission('uuid{}'.format(num), 'student{}'.format(num), b'x' * 100) for num in range(3)]
+    with tempfile.TemporaryFile() as archive:
+        write_submissions_archive(archive, subs, 64, progress=progress)
+    record = get_archive_progress('archive.zip')
+    assert record['state'] == 'running'
+    assert record['files_done'] == record['files_total'] == 3
+    assert record['bytes_written'] > 0
+    assert record['eta_seconds'] == 0
+
+    progress.finish()
+    assert get_archive_progress('archive.zip')['state'] == 'done'
+    progress.fail('Something went wrong')
+    record = get_archive_progress('archive.zip')
+    assert record['state'] == 'failed'
+    assert record['error'] == 'Something went wrong'
+    assert get_archive_progress('other.zip') is None
+
+
+def test_wait_for_archive_progress():
+    """
+    Waiting for progress should end as soon as newer progress is published, or at the timeout
+    """
+    cache.clear()
+    assert wait_for_archive_progress('archive.zip', since=1, timeout=5) is None
+
+    progress = ArchiveProgress('archive.zip')
+    progress.publish_interval = 0
+    progress.start(10)
+    since = get_archive_progress('archive.zip')['updated']
+    assert wait_for_archive_progress('archive.zip', timeout=5)['updated'] == since
+
+    started = time.time()
+    assert wait_for_archive_progress('archive.zip', since=since, timeout=0.2)['updated'] == since
+    assert 0.2 <= time.time() - started < 1
+
+    timer = threading.Timer(0.2, progress.advance, [100])
+    timer.start()
+    started = time.time()
+    record = wait_for_archive_progress('archive.zip', since=since, timeout=5)
+    timer.join()
+    assert record['files_done'] == 1
+    assert time.time() - started < 2
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for serving files from storage
+"""
+from __future__ import absolute_import
+
+import mock
+import pytest
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from edx_sga.downloads import REVALIDATE_CACHE_CONTROL, file_response, get_etag, get_offload_header
+from webob import Request
+
+CONTENTS = b'0123456789'
+
+
+@pytest.fixture
+def stored_file(settings, tmpdir):
+    """
+    Saves a file to default_storage in a temporary directory and returns its path
+    """
+    settings.DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+    settings.MEDIA_ROOT = str(tmpdir)
+    return default_storage.save('org/course/sga/block/file.txt', ContentFile(CONTENTS))
+
+
+def _get(stored_file, headers=None, etag='abc'):  # pylint: disable=redefined-outer-name
+    """
+    Requests the stored file with the given headers
+    """
+    return file_response(
+        Request.blank('/', headers=headers or {}),
+        stored_file,
+        'text/plain',
+        'attachment; filename=file.txt',
+        etag=etag,
+    )
+
+
+def test_get_etag():
+    """
+    ETags should identify their parts
+    """
+    assert get_etag('path') == get_etag('path')
+    assert get_etag('path', 'fingerprint') != get_etag('path', 'other fingerprint')
+
+
+def test_file_response(stored_file):  # pylint: disable=redefined-outer-name
+    """
+    A plain request should get the whole file with its validators
+    """
+    response = _get(stored_file)
+    assert response.status_code == 200
+    assert response.body == CONTENTS
+    assert response.content_length == len(CONTENTS)
+    assert response.headers['ETag'] == '"abc"'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.headers['Cache-Control'] == REVALIDATE_CACHE_CONTROL
+    assert response.content_disposition == 'attachment; filename=file.txt'
+
+    response = _get(stored_file, etag=None)
+    assert 'ETag' not in response.headers
+
+    response = file_response(None, stored_file, 'text/plain', 'attachment', etag='abc')
+    assert response.status_code == 200
+    assert response.body == CONTENTS
+
+
+@pytest.mark.parametrize('if_none_match,status_code', [('"abc"', 304), ('"old", "abc"', 304), ('"old"', 200)])
+def test_file_response_not_modified(stored_file, if_none_match, status_code):  # pylint: disable=redefined-outer-name
+    """
+    A client which already has the file should be told so without getting it again
+    """
+    response = _get(stored_file, {'If-None-Match': if_none_match})
+    assert response.status_code == status_code
+    assert response.headers['ETag'] == '"abc"'
+    if status_code == 304:
+        assert response.body == b''
+
+
+@pytest.mark.parametrize('headers,status_code,body,content_range', [
+    ({'Range': 'bytes=2-5'}, 206, b'2345', 'bytes 2-5/10'),
+    ({'Range': 'bytes=7-'}, 206, b'789', 'bytes 7-9/10'),
+    ({'Range': 'bytes=-3'}, 206, b'789', 'bytes 7-9/10'),
+    ({'Range': 'bytes=4-100'}, 206, b'456789', 'bytes 4-9/10'),
+    ({'Range': 'bytes=2-5', 'If-Range': '"abc"'}, 206, b'2345', 'bytes 2-5/10'),
+    ({'Range': 'bytes=2-5', 'If-Range': '"old"'}, 200, CONTENTS, None),
+    ({'Range': 'bytes=0-1,5-6'}, 200, CONTENTS, None),
+    ({'Range': 'bytes=20-'}, 416, b'', 'bytes */10'),
+])
+def test_file_response_range(stored_file, headers, status_code, body, content_range):
+    # pylint: disable=redefined-outer-name
+    """
+    A single satisfiable range of the current version of the file should be served alone
+    """
+    response = _get(stored_file, headers)
+    assert response.status_code == status_code
+    assert response.body == body
+    assert response.headers.get('Content-Range') == content_range
+
+
+def test_file_response_missing(stored_file):  # pylint: disable=redefined-outer-name
+    """
+    A missing file should raise an error the download handlers turn into a 404
+    """
+    with pytest.raises((IOError, OSError)):
+        _get(stored_file + '.missing')
+
+
+@pytest.mark.parametrize('offload,header,value', [
+    ('x-accel-redirect', 'X-Accel-Redirect', '/protected/org/course/sga/block/file.txt'),
+    ('x-sendfile', 'X-Sendfile', None),
+])
+def test_file_response_offload(settings, stored_file, offload, header, value):
+    # pylint: disable=redefined-outer-name
+    """
+    With offloading on, the web server should be told to send the file
+    """
+    settings.SGA_DOWNLOAD_OFFLOAD = offload
+    response = _get(stored_file, {'Range': 'bytes=2-5'})
+    assert response.status_code == 200
+    assert response.body == b''
+    assert 'Content-Length' not in response.headers
+    assert response.headers[header] == (value or default_storage.path(stored_file))
+    assert response.headers['ETag'] == '"abc"'
+    assert response.content_disposition == 'attachment; filename=file.txt'
+
+    assert _get(stored_file, {'If-None-Match': '"abc"'}).status_code == 304
+    with pytest.raises((IOError, OSError)):
+        _get(stored_file + '.missing')
+
+
+def test_get_offload_header_remote(settings):
+    """
+    Files not on local disk should still be sent by Django
+    """
+    settings.SGA_DOWNLOAD_OFFLOAD = 'x-accel-redirect'
+    with mock.patch('edx_sga.utils.default_storage') as storage:
+        storage.path.side_effect = NotImplementedError
+        assert get_offload_header('org/course/sga/block/file.txt') is None
+
+
+def test_file_response_offload_unknown(settings, stored_file):  # pylint: disable=redefined-outer-name
+    """
+    An unknown offload mode is a configuration error
+    """
+    settings.SGA_DOWNLOAD_OFFLOAD = 'x-unknown'
+    with pytest.raises(ImproperlyConfigured):
+        _get(stored_file)
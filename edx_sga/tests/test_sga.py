@@ -8,7 +8,6 @@ import datetime
 import json
 import mimetypes
 import os
-import uuid
 
 import mock
 import pytest
@@ -19,11 +18,15 @@ import pytz
 from ddt import data, ddt, unpack
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.test.utils import override_settings
 from django.utils.timezone import now as django_now
-from edx_sga.tests.common import DummyResource, TempfileMixin
+from edx_sga.tests.common import DummyResource, TempfileMixin, get_sha1
 from opaque_keys.edx.locations import Location
 from opaque_keys.edx.locator import CourseLocator
+from webob import Request
 from workbench.runtime import WorkbenchRuntime
+from xblock.exceptions import JsonHandlerError
 from xblock.field_data import DictFieldData
 from xblock.fields import DateTime
 
@@ -45,7 +48,7 @@ pytestmark = pytest.mark.django_db  # pylint: disable=invalid-name
 def fake_get_submission(**kwargs):
     """returns fake submission data"""
     answer = {
-        "sha1": SHA1,
+        "sha1": kwargs.get("sha1", SHA1),
         "filename": kwargs.get("filename", "file.txt"),
         "mimetype": kwargs.get("mimetype", "mime/type"),
     }
@@ -58,9 +61,10 @@ def fake_get_submission(**kwargs):
     }
 
 
-def fake_upload_submission(upload):
+def fake_upload_submission(upload, sha1=SHA1):
     """returns fake submission data with values calculated from an upload object"""
     return fake_get_submission(
+        sha1=sha1,
         filename=upload.file.name,
         mimetype=mimetypes.guess_type(upload.file.name)[0]
     )
@@ -240,9 +244,75 @@ class StaffGradedAssignmentMockedTests(TempfileMixin):
             assert student_state['graded'] is None
             fragment.add_css.assert_called_once_with(
                 DummyResource("static/css/edx_sga.css"))
+            fragment.add_javascript.assert_any_call(
+                DummyResource("static/js/src/edx_sga_staff.js"))
             fragment.initialize_js.assert_called_once_with(
                 "StaffGradedAssignmentXBlock")
 
+    @mock.patch('edx_sga.sga._resource', DummyResource)
+    @mock.patch('edx_sga.sga.render_template')
+    @mock.patch('edx_sga.sga.Fragment')
+    def test_student_view_learner(self, fragment, render_template):
+        # pylint: disable=unused-argument
+        """
+        Learners are not sent the staff grading interface nor its code
+        """
+        block = self.make_xblock()
+        with mock.patch(
+            'edx_sga.sga.StaffGradedAssignmentXBlock.show_staff_grading_interface',
+            return_value=False
+        ), mock.patch(
+            'edx_sga.sga.StaffGradedAssignmentXBlock.student_state', return_value={}
+        ):
+            fragment = block.student_view()
+        assert 'is_course_staff' not in render_template.call_args[0][1]
+        assert fragment.add_javascript.call_args_list == [
+            mock.call(DummyResource("static/js/src/edx_sga.js"))
+        ]
+
+    @mock.patch('edx_sga.sga._resource', DummyResource)
+    @mock.patch('edx_sga.sga.render_template')
+    @mock.patch('edx_sga.sga.Fragment')
+    def test_cacheable_student_view(self, fragment, render_template):
+        # pylint: disable=unused-argument
+        """
+        The cacheable student view leaves the student's state out of the fragment
+        """
+        block = self.make_xblock()
+        with override_settings(SGA_CACHEABLE_STUDENT_VIEW=True), mock.patch(
+            'edx_sga.sga.StaffGradedAssignmentXBlock.student_state'
+        ) as student_state:
+            block.student_view()
+        assert student_state.called is False
+        context = render_template.call_args[0][1]
+        assert context['student_state'] == ''
+        assert context['id'] == 'name'
+
+    def test_get_student_state(self):
+        """
+        The student's state is sent with an ETag, and not sent again while it is unchanged
+        """
+        block = self.make_xblock()
+        state = {'uploaded': None, 'graded': None, 'max_score': 100}
+        with mock.patch(
+            'edx_sga.sga.StaffGradedAssignmentXBlock.student_state', return_value=state
+        ):
+            response = block.get_student_state(None)
+            assert response.status_code == 200
+            assert response.json_body == state
+            assert response.cache_control.no_cache
+            etag = response.etag
+
+            response = block.get_student_state(Request.blank('/', headers={'If-None-Match': '"{}"'.format(etag)}))
+            assert response.status_code == 304
+            assert response.body == b''
+
+            state['graded'] = {'score': 10, 'comment': ''}
+            response = block.get_student_state(Request.blank('/', headers={'If-None-Match': '"{}"'.format(etag)}))
+            assert response.status_code == 200
+            assert response.etag != etag
+            assert response.json_body == state
+
     @mock.patch('edx_sga.sga._resource', DummyResource)
     @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.upload_allowed')
     @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.get_score')
@@ -365,10 +435,52 @@ class StaffGradedAssignmentMockedTests(TempfileMixin):
         point_positive_int_test()
         weights_positive_float_test()
 
+    @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.get_student_item_dict')
+    @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.upload_allowed', return_value=True)
+    def test_download_after_reupload(self, upload_allowed, get_student_item_dict):
+        # pylint: disable=unused-argument
+        """
+        Browsers must revalidate downloads, and get the new file once the student uploads another one
+        """
+        block = self.make_xblock()
+        get_student_item_dict.return_value = {
+            "student_id": 1,
+            "course_id": block.block_course_id,
+            "item_id": block.block_id,
+            "item_type": 'sga',
+        }
+        etag = None
+        for content in (b"first version", b"second version"):
+            with self.dummy_upload('test.txt', content) as (upload, expected):
+                with mock.patch('submissions.api.create_submission'), mock.patch(
+                    'edx_sga.sga.StaffGradedAssignmentXBlock.student_state', return_value={}
+                ), mock.patch(
+                    'edx_sga.sga.StaffGradedAssignmentXBlock.get_or_create_student_module',
+                    return_value=fake_student_module()
+                ):
+                    block.upload_assignment(mock.Mock(params={'assignment': upload}))
+
+                with mock.patch(
+                    'edx_sga.sga.StaffGradedAssignmentXBlock.get_submission',
+                    return_value=fake_upload_submission(upload, sha1=get_sha1(expected))
+                ):
+                    headers = {'If-None-Match': '"{}"'.format(etag)} if etag else {}
+                    response = block.download_assignment(Request.blank('/', headers=headers))
+                    assert response.status_code == 200
+                    assert response.body == expected
+                    assert response.cache_control.no_cache
+                    assert response.cache_control.max_age is None
+                    assert response.etag != etag
+                    etag = response.etag
+
+                    response = block.download_assignment(
+                        Request.blank('/', headers={'If-None-Match': '"{}"'.format(etag)})
+                    )
+                    assert response.status_code == 304
+
     @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.get_student_item_dict')
     @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.upload_allowed')
-    @mock.patch('edx_sga.sga.get_sha1')
-    def test_upload_download_assignment(self, get_sha1, upload_allowed, get_student_item_dict):
+    def test_upload_download_assignment(self, upload_allowed, get_student_item_dict):
         # pylint: disable=unused-argument
         """
         Tests upload and download assignment for non staff.
@@ -417,6 +529,189 @@ class StaffGradedAssignmentMockedTests(TempfileMixin):
                 response = block.download_assignment(None)
                 assert response.status_code == 404
 
+    @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.upload_allowed', return_value=True)
+    @data(
+        (b"some information", True, False),
+        (b"some information", False, True),
+        (b"other information", True, True),
+    )
+    @unpack
+    def test_upload_assignment_same_file(self, previous_data, same_filename, submission_expected, upload_allowed):
+        # pylint: disable=unused-argument
+        """
+        Uploading the same file again should neither write it to storage nor record another submission
+        """
+        file_name = 'test.txt'
+        block = self.make_xblock()
+
+        with self.dummy_upload(file_name) as (upload, expected):
+            with self.dummy_file_in_storage(
+                block.file_storage_path(get_sha1(expected), file_name)
+            ), mock.patch(
+                'edx_sga.sga.StaffGradedAssignmentXBlock.get_submission',
+                return_value=fake_get_submission(
+                    filename=upload.file.name if same_filename else 'other.txt',
+                    sha1=get_sha1(previous_data)
+                )
+            ), mock.patch(
+                'edx_sga.sga.StaffGradedAssignmentXBlock.get_student_item_dict', return_value={}
+            ), mock.patch(
+                'edx_sga.sga.StaffGradedAssignmentXBlock.student_state', return_value={}
+            ), mock.patch(
+                'edx_sga.sga.StaffGradedAssignmentXBlock.get_or_create_student_module',
+                return_value=fake_student_module()
+            ), mock.patch(
+                'submissions.api.create_submission'
+            ) as mocked_create_submission, mock.patch(
+                'edx_sga.utils.os.rename'
+            ) as mocked_rename:
+                block.upload_assignment(mock.Mock(params={'assignment': upload}))
+        assert mocked_create_submission.called is submission_expected
+        assert mocked_rename.called is False
+
+    @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.upload_allowed', return_value=True)
+    @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.get_student_item_dict')
+    def test_chunked_upload(self, get_student_item_dict, upload_allowed):
+        # pylint: disable=unused-argument
+        """
+        A file uploaded in chunks should be resumable and stored like a file uploaded at once
+        """
+        block = self.make_xblock()
+        get_student_item_dict.return_value = {
+            "student_id": 1,
+            "course_id": block.block_course_id,
+            "item_id": block.block_id,
+            "item_type": 'sga',
+        }
+        expected = b"0123456789"
+        file_params = {'filename': 'test.txt', 'size': str(len(expected)), 'last_modified': '1500000000000'}
+
+        def send_chunk(start, end, params=file_params):
+            """Uploads a chunk of the file"""
+            return block.upload_chunk(mock.Mock(
+                params=dict(params, assignment=mock.Mock(file=six.BytesIO(expected[start:end]))),
+                headers={'Content-Range': 'bytes {}-{}/{}'.format(start, end - 1, len(expected))}
+            ))
+
+        with mock.patch(
+            'edx_sga.uploads.get_staging_dir', return_value=os.path.join(self.temp_directory, 'staging')
+        ), mock.patch(
+            'edx_sga.sga.StaffGradedAssignmentXBlock.student_state', return_value={}
+        ), mock.patch(
+            'edx_sga.sga.StaffGradedAssignmentXBlock.get_or_create_student_module',
+            return_value=fake_student_module()
+        ), mock.patch(
+            'submissions.api.create_submission'
+        ) as mocked_create_submission:
+            response = block.start_chunked_upload(mock.Mock(params=file_params))
+            upload_id = response.json_body['upload_id']
+            assert response.json_body['uploaded_bytes'] == 0
+            assert send_chunk(0, 4).json_body == {'uploaded_bytes': 4}
+
+            # The upload was interrupted, and resumes from what was received
+            response = block.start_chunked_upload(mock.Mock(params=file_params))
+            assert response.json_body == dict(response.json_body, upload_id=upload_id, uploaded_bytes=4)
+            response = send_chunk(0, 4)
+            assert response.status_code == 409
+            assert response.json_body == {'uploaded_bytes': 4}
+            # The upload is found from the student and the file, not from an id sent by the client
+            response = send_chunk(4, 10, params=dict(file_params, filename='other.txt', upload_id=upload_id))
+            assert response.status_code == 409
+            assert response.json_body == {'uploaded_bytes': 0}
+            # Another file with the same name and size does not resume on top of it
+            response = block.start_chunked_upload(mock.Mock(params=dict(file_params, last_modified='1600000000000')))
+            assert response.json_body['upload_id'] != upload_id
+            assert response.json_body['uploaded_bytes'] == 0
+            with self.assertRaises(JsonHandlerError):
+                block.finish_chunked_upload(mock.Mock(params=file_params))
+
+            assert send_chunk(4, 10).json_body == {'uploaded_bytes': 10}
+            block.finish_chunked_upload(mock.Mock(params=file_params))
+            assert mocked_create_submission.call_args[0][1]['sha1'] == get_sha1(expected)
+            assert block.start_chunked_upload(mock.Mock(params=file_params)).json_body['uploaded_bytes'] == 0
+
+        with self.assertRaises(JsonHandlerError):
+            block.start_chunked_upload(mock.Mock(params={'filename': 'test.txt', 'size': str(2 ** 40)}))
+        with self.default_storage.open(block.file_storage_path(get_sha1(expected), "test.txt")) as stored:
+            assert stored.read() == expected
+
+    @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.upload_allowed', return_value=True)
+    def test_direct_upload(self, upload_allowed):
+        # pylint: disable=unused-argument
+        """
+        A file uploaded to a signed target should be stored and recorded by finish_direct_upload
+        """
+        block = self.make_xblock()
+        expected = b"some information"
+        file_params = {'sha1': get_sha1(expected), 'filename': 'test.txt'}
+
+        with self.assertRaises(JsonHandlerError):
+            block.get_direct_upload_target(mock.Mock(params=file_params))
+
+        with mock.patch('edx_sga.sga.direct_uploads_enabled', return_value=True), mock.patch(
+            'edx_sga.sga.StaffGradedAssignmentXBlock.get_submission', return_value=None
+        ), mock.patch(
+            'edx_sga.sga.StaffGradedAssignmentXBlock.get_student_item_dict', return_value={}
+        ), mock.patch(
+            'edx_sga.sga.StaffGradedAssignmentXBlock.student_state', return_value={}
+        ), mock.patch(
+            'edx_sga.sga.StaffGradedAssignmentXBlock.get_or_create_student_module',
+            return_value=fake_student_module()
+        ), mock.patch(
+            'submissions.api.create_submission'
+        ) as mocked_create_submission:
+            with self.assertRaises(JsonHandlerError):
+                block.finish_direct_upload(mock.Mock(params=file_params))
+
+            target = block.get_direct_upload_target(mock.Mock(params=file_params)).json_body
+            assert target['stored'] is False
+            with self.assertRaises(JsonHandlerError):
+                block.direct_upload(mock.Mock(params={
+                    'token': target['fields']['token'] + 'x',
+                    'file': mock.Mock(file=six.BytesIO(expected)),
+                }))
+            with self.assertRaises(JsonHandlerError) as raised:
+                block.direct_upload(mock.Mock(params={
+                    'token': target['fields']['token'],
+                    'file': mock.Mock(file=six.BytesIO(b"planted content")),
+                }))
+            assert raised.exception.status_code == 400
+            assert not self.default_storage.exists(block.file_storage_path(get_sha1(expected), "test.txt"))
+            response = block.direct_upload(mock.Mock(params={
+                'token': target['fields']['token'],
+                'file': mock.Mock(file=six.BytesIO(expected)),
+            }))
+            assert response.status_code == 204
+
+            block.finish_direct_upload(mock.Mock(params=file_params))
+            assert mocked_create_submission.call_args[0][1]['sha1'] == get_sha1(expected)
+            assert block.get_direct_upload_target(mock.Mock(params=file_params)).json_body == {'stored': True}
+
+        with self.default_storage.open(block.file_storage_path(get_sha1(expected), "test.txt")) as stored:
+            assert stored.read() == expected
+
+    @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.upload_allowed', return_value=True)
+    def test_finish_direct_upload_mismatch(self, upload_allowed):
+        # pylint: disable=unused-argument
+        """
+        A file stored directly under the sha1 of other content should be deleted instead of recorded
+        """
+        block = self.make_xblock()
+        file_params = {'sha1': get_sha1(b"some information"), 'filename': 'test.txt'}
+        path = block.file_storage_path(file_params['sha1'], 'test.txt')
+        self.default_storage.save(path, ContentFile(b"planted content"))
+
+        with mock.patch('edx_sga.sga.direct_uploads_enabled', return_value=True), mock.patch(
+            'edx_sga.sga.StaffGradedAssignmentXBlock.get_submission', return_value=None
+        ), mock.patch(
+            'submissions.api.create_submission'
+        ) as mocked_create_submission:
+            with self.assertRaises(JsonHandlerError) as raised:
+                block.finish_direct_upload(mock.Mock(params=file_params))
+        assert raised.exception.status_code == 400
+        assert mocked_create_submission.called is False
+        assert not self.default_storage.exists(path)
+
     @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.get_student_item_dict')
     @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.upload_allowed')
     @data(({'finalized': False}, True), ({}, True), ({'finalized': True}, False))
@@ -457,28 +752,26 @@ class StaffGradedAssignmentMockedTests(TempfileMixin):
 
     @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.get_student_module')
     @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.is_course_staff')
-    @mock.patch('edx_sga.sga.get_sha1')
-    def test_staff_upload_download_annotated(self, get_sha1, is_course_staff, get_student_module):
+    def test_staff_upload_download_annotated(self, is_course_staff, get_student_module):
         # pylint: disable=no-member
         """
         Tests upload and download of annotated staff files.
         """
         get_student_module.return_value = fake_student_module()
         is_course_staff.return_value = True
-        get_sha1.return_value = SHA1
         file_name = 'test.txt'
         block = self.make_xblock()
 
         with self.dummy_upload(file_name) as (upload, expected), mock.patch(
-            "edx_sga.sga.StaffGradedAssignmentXBlock.staff_grading_data",
+            "edx_sga.sga.StaffGradedAssignmentXBlock.staff_grading_row",
             return_value={}
-        ) as staff_grading_data:
+        ) as staff_grading_row:
             block.staff_upload_annotated(mock.Mock(params={'annotated': upload, 'module_id': 1}))
-        assert staff_grading_data.called is True
+        assert staff_grading_row.called is True
 
         with mock.patch(
             "edx_sga.sga.StaffGradedAssignmentXBlock.file_storage_path",
-            return_value=block.file_storage_path(SHA1, file_name)
+            return_value=block.file_storage_path(get_sha1(expected), file_name)
         ):
             response = block.staff_download_annotated(mock.Mock(params={'module_id': 1}))
             assert response.body == expected
@@ -494,33 +787,31 @@ class StaffGradedAssignmentMockedTests(TempfileMixin):
 
     @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.get_student_module')
     @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.is_course_staff')
-    @mock.patch('edx_sga.sga.get_sha1')
-    def test_download_annotated(self, get_sha1, is_course_staff, get_student_module):
+    def test_download_annotated(self, is_course_staff, get_student_module):
         # pylint: disable=no-member
         """
         Test download annotated assignment for non staff.
         """
         get_student_module.return_value = fake_student_module()
         is_course_staff.return_value = True
-        get_sha1.return_value = SHA1
 
         file_name = 'test.txt'
         block = self.make_xblock()
 
         with self.dummy_upload(file_name) as (upload, expected):
             with mock.patch(
-                "edx_sga.sga.StaffGradedAssignmentXBlock.staff_grading_data",
+                "edx_sga.sga.StaffGradedAssignmentXBlock.staff_grading_row",
                 return_value={}
-            ) as staff_grading_data:
+            ) as staff_grading_row:
                 block.staff_upload_annotated(mock.Mock(params={
                     'annotated': upload,
                     'module_id': 1
                 }))
-            assert staff_grading_data.called is True
+            assert staff_grading_row.called is True
             self.personalize_upload(block, upload)
         with mock.patch(
             "edx_sga.sga.StaffGradedAssignmentXBlock.file_storage_path",
-            return_value=block.file_storage_path(SHA1, file_name)
+            return_value=block.file_storage_path(get_sha1(expected), file_name)
         ):
             response = block.download_annotated(None)
             assert response.body == expected
@@ -535,15 +826,13 @@ class StaffGradedAssignmentMockedTests(TempfileMixin):
     @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.upload_allowed')
     @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.get_student_module')
     @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.is_course_staff')
-    @mock.patch('edx_sga.sga.get_sha1')
-    def test_staff_download(self, get_sha1, is_course_staff, get_student_module, upload_allowed):
+    def test_staff_download(self, is_course_staff, get_student_module, upload_allowed):
         """
         Test download for staff.
         """
         get_student_module.return_value = fake_student_module()
         is_course_staff.return_value = True
         upload_allowed.return_value = True
-        get_sha1.return_value = SHA1
         block = self.make_xblock()
 
         with self.dummy_upload('test.txt') as (upload, expected), mock.patch(
@@ -560,7 +849,7 @@ class StaffGradedAssignmentMockedTests(TempfileMixin):
 
         with mock.patch(
             'edx_sga.sga.StaffGradedAssignmentXBlock.get_submission',
-            return_value=fake_upload_submission(upload)
+            return_value=fake_upload_submission(upload, sha1=get_sha1(expected))
         ):
             response = block.staff_download(mock.Mock(params={
                 'student_id': 1}))
@@ -602,141 +891,136 @@ class StaffGradedAssignmentMockedTests(TempfileMixin):
         ):
             assert block.upload_allowed(submission_data={}) is expected_value
 
-    @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.count_archive_files')
     @mock.patch('edx_sga.sga.zip_student_submissions')
-    @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.get_sorted_submissions')
-    @data((False, False), (True, True))
+    @mock.patch('edx_sga.sga.get_submissions_fingerprint')
+    @mock.patch('edx_sga.sga.read_manifest')
+    @mock.patch('edx_sga.sga.claim_archive_build', return_value=True)
+    @data(('fingerprint', True, 2), ('stale', False, 0))
     @unpack
     def test_prepare_download_submissions(
             self,
-            is_zip_file_available,
+            manifest_fingerprint,
             downloadable,
-            get_sorted_submissions,
-            zip_student_submissions,
-            count_archive_files
+            parts,
+            claim_archive_build,  # pylint: disable=unused-argument
+            read_manifest,
+            get_submissions_fingerprint,
+            zip_student_submissions
     ):
         """
         Test prepare download api
         """
         block = self.make_xblock()
-        count_archive_files.return_value = 2
-        get_sorted_submissions.return_value = [
-            {
-                'submission_id': uuid.uuid4().hex,
-                'filename': "test_{}.txt".format(uuid.uuid4().hex),
-                'timestamp': datetime.datetime.now(tz=pytz.utc)
-            } for __ in range(2)
-        ]
+        read_manifest.return_value = {
+            'fingerprint': manifest_fingerprint,
+            'parts': ['path/to/archive.part001.zip', 'path/to/archive.part002.zip'],
+        }
+        get_submissions_fingerprint.return_value = 'fingerprint'
         zip_student_submissions.delay = mock.Mock()
         with mock.patch(
-            "edx_sga.sga.StaffGradedAssignmentXBlock.is_zip_file_available",
-            return_value=is_zip_file_available
-        ), mock.patch(
             'edx_sga.sga.StaffGradedAssignmentXBlock.get_real_user',
             return_value=self.staff
         ), mock.patch(
-            'edx_sga.utils.default_storage.modified_time',
-            return_value=datetime.datetime.now()
+            "edx_sga.sga.get_zip_file_path", return_value="path/to/archive.zip"
         ):
             response = block.prepare_download_submissions(None)
             response_body = json.loads(response.body.decode('utf-8'))
             assert response_body["downloadable"] is downloadable
+            assert response_body["parts"] == parts
 
-    @mock.patch('edx_sga.sga.get_file_modified_time_utc')
-    @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.count_archive_files')
-    @mock.patch('edx_sga.sga.zip_student_submissions')
-    @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.get_sorted_submissions')
-    @data((2, True, False), (1, False, True))
-    @unpack
-    def test_prepare_download_submissions_when_student_score_reset(
-            self,
-            count_archive_files,
-            downloadable,
-            zip_task_called,
-            get_sorted_submissions,
-            zip_student_submissions,
-            count_archive_files_mock,
-            get_file_modified_time_utc
-    ):
-        """
-        Test prepare download api
-        """
-        now = datetime.datetime.now(tz=pytz.utc)
-        block = self.make_xblock()
-        count_archive_files_mock.return_value = count_archive_files
-        get_sorted_submissions.return_value = [
-            {
-                'submission_id': uuid.uuid4().hex,
-                'filename': "test_{}.txt".format(uuid.uuid4().hex),
-                'timestamp': now
-            } for __ in range(2)
-        ]
-        get_file_modified_time_utc.return_value = now
-        zip_student_submissions.delay = mock.Mock()
-        with mock.patch(
-            "edx_sga.sga.StaffGradedAssignmentXBlock.is_zip_file_available", return_value=True
-        ), mock.patch(
-            'edx_sga.sga.StaffGradedAssignmentXBlock.get_real_user', return_value=self.staff
-        ), mock.patch(
-            'edx_sga.utils.default_storage.modified_time', return_value=datetime.datetime.now()
-        ):
-            response = block.prepare_download_submissions(None)
-            response_body = json.loads(response.body.decode('utf-8'))
-            assert response_body["downloadable"] is downloadable
-            assert zip_student_submissions.delay.called is zip_task_called
+        get_submissions_fingerprint.assert_called_once_with(block.block_course_id, block.block_id)
+        read_manifest.assert_called_once_with("path/to/archive.zip")
+        assert zip_student_submissions.delay.called is not downloadable
 
     @mock.patch('edx_sga.sga.zip_student_submissions')
-    @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.get_sorted_submissions')
+    @mock.patch('edx_sga.sga.get_submissions_fingerprint')
+    @mock.patch('edx_sga.sga.claim_archive_build')
+    @data(True, False)
     def test_prepare_download_submissions_task_called(
             self,
-            get_sorted_submissions,
+            build_claimed,
+            claim_archive_build,
+            get_submissions_fingerprint,
             zip_student_submissions
     ):
         """
-        Test prepare download api
+        Test prepare download api, which should only queue a task if no identical one is in flight
         """
         block = self.make_xblock()
-        get_sorted_submissions.return_value = [
-            {
-                'submission_id': uuid.uuid4().hex,
-                'filename': "test_{}.txt".format(uuid.uuid4().hex),
-                'timestamp': datetime.datetime.utcnow()
-            } for __ in range(2)
-        ]
+        get_submissions_fingerprint.return_value = 'fingerprint'
+        claim_archive_build.return_value = build_claimed
         zip_student_submissions.delay = mock.Mock()
         with mock.patch(
-            "edx_sga.sga.StaffGradedAssignmentXBlock.is_zip_file_available",
-            return_value=False
+            "edx_sga.sga.read_manifest",
+            return_value=None
         ), mock.patch(
             'edx_sga.sga.StaffGradedAssignmentXBlock.get_real_user',
             return_value=self.staff
         ), mock.patch(
-            'edx_sga.sga.default_storage.modified_time',
-            return_value=datetime.datetime.now()
+            "edx_sga.sga.get_zip_file_path", return_value="path/to/archive.zip"
         ):
             response = block.prepare_download_submissions(None)
             response_body = json.loads(response.body.decode('utf-8'))
             assert response_body["downloadable"] is False
 
-        zip_student_submissions.delay.assert_called_once_with(
-            six.text_type(block.block_course_id),
-            six.text_type(block.block_id),
-            six.text_type(block.location),
-            self.staff.username
-        )
+        claim_archive_build.assert_called_once_with("path/to/archive.zip", 'fingerprint')
+        if build_claimed:
+            zip_student_submissions.delay.assert_called_once_with(
+                six.text_type(block.block_course_id),
+                six.text_type(block.block_id),
+                six.text_type(block.location),
+                self.staff.username,
+                'fingerprint'
+            )
+        else:
+            assert zip_student_submissions.delay.called is False
 
-    @data((False, False), (True, True))
+    @data(([], False), (['archive.zip'], True), (['archive.part001.zip', 'archive.part002.zip'], True))
     @unpack
-    def test_download_submissions_status(self, is_zip_file_available, downloadable):
+    def test_download_submissions_status(self, parts, downloadable):
         """test download_submissions_status api"""
         block = self.make_xblock()
+        progress = {'state': 'running', 'files_done': 3, 'files_total': 10, 'eta_seconds': 7}
         with mock.patch(
-            "edx_sga.sga.StaffGradedAssignmentXBlock.is_zip_file_available",
-            return_value=is_zip_file_available
-        ):
+            "edx_sga.sga.get_zip_file_path", return_value="path/to/archive.zip"
+        ), mock.patch(
+            "edx_sga.sga.read_manifest", return_value={'parts': parts}
+        ), mock.patch(
+            "edx_sga.sga.get_archive_parts", return_value=parts
+        ), mock.patch(
+            "edx_sga.sga.wait_for_archive_progress", return_value=progress
+        ) as wait_for_archive_progress:
             response = block.download_submissions_status(None)
             response_body = json.loads(response.body.decode('utf-8'))
             assert response_body["zip_available"] is downloadable
+            assert response_body["parts"] == len(parts)
+            assert response_body["progress"] == progress
+            wait_for_archive_progress.assert_called_once_with("path/to/archive.zip", None, 0)
+
+    @data(
+        ({'since': '1500000000.25', 'wait': '10'}, 1500000000.25, 10),
+        ({'since': '1500000000.25', 'wait': '600'}, 1500000000.25, 25),
+        ({'since': '', 'wait': '-3'}, None, 0),
+    )
+    @unpack
+    def test_download_submissions_status_wait(self, params, since, wait):
+        """download_submissions_status should wait a bounded time for newer progress"""
+        block = self.make_xblock()
+        with mock.patch(
+            "edx_sga.sga.get_zip_file_path", return_value="path/to/archive.zip"
+        ), mock.patch(
+            "edx_sga.sga.read_manifest", return_value=None
+        ), mock.patch(
+            "edx_sga.sga.wait_for_archive_progress", return_value=None
+        ) as wait_for_archive_progress:
+            block.download_submissions_status(mock.Mock(params=params))
+            wait_for_archive_progress.assert_called_once_with("path/to/archive.zip", since, wait)
+
+    def test_download_submissions_status_bad_wait(self):
+        """download_submissions_status should reject a non-numeric since or wait"""
+        block = self.make_xblock()
+        with self.assertRaises(JsonHandlerError):
+            block.download_submissions_status(mock.Mock(params={'since': 'yesterday'}))
 
     @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.is_course_staff')
     def test_download_submissions(self, is_course_staff):
@@ -762,6 +1046,60 @@ class StaffGradedAssignmentMockedTests(TempfileMixin):
             assert response.status_code == 200
             assert response.body == expected
 
+    @mock.patch('edx_sga.sga.StaffGradedAssignmentXBlock.is_course_staff')
+    @data(('2', 200), ('3', 404), ('0', 404), ('two', 404))
+    @unpack
+    def test_download_submissions_part(self, part, status_code, is_course_staff):
+        """tests download_submissions for a multi-part archive"""
+        block = self.make_xblock()
+        is_course_staff.return_value = True
+        parts = []
+        for number in range(1, 3):
+            part_path = os.path.join(self.temp_directory, "foo.part00{}.zip".format(number))
+            with open(part_path, "wb") as temp_file:
+                temp_file.write("part {}".format(number).encode('utf-8'))
+            parts.append(part_path)
+
+        with mock.patch(
+            "edx_sga.sga.get_zip_file_path", return_value=os.path.join(self.temp_directory, "foo.zip")
+        ), mock.patch(
+            'edx_sga.sga.StaffGradedAssignmentXBlock.get_real_user',
+            return_value=self.staff
+        ), mock.patch(
+            "edx_sga.sga.get_zip_file_name", return_value="foo.zip"
+        ), mock.patch(
+            "edx_sga.sga.read_manifest", return_value={'parts': parts}
+        ):
+            response = block.download_submissions(mock.Mock(params={'part': part}))
+            assert response.status_code == status_code
+            if status_code == 200:
+                assert response.body == b"part 2"
+                assert response.content_disposition == "attachment; filename=foo.part002.zip"
+
+    def test_submission_context(self):
+        """
+        Submissions and scores are fetched once per student until they are changed
+        """
+        block = self.make_xblock()
+        with mock.patch(
+            "edx_sga.sga.submissions_api.get_submissions",
+            return_value=[fake_get_submission(finalized=True)]
+        ) as get_submissions, mock.patch(
+            "edx_sga.sga.submissions_api.get_score",
+            return_value={'points_earned': 5}
+        ) as get_score:
+            for _ in range(2):
+                assert block.get_submission() == fake_get_submission(finalized=True)
+                assert block.has_attempted() is True
+                assert block.score == 5
+                assert block.get_score('other') == 5
+            assert get_submissions.call_count == 1
+            assert get_score.call_count == 2
+
+            block.reset_submission_contexts()
+            assert block.get_score() == 5
+            assert get_score.call_count == 3
+
     def test_clear_student_state(self):
         """Tests that a student's state in the given problem is properly cleared"""
         block = self.make_xblock()
@@ -784,3 +1122,26 @@ class StaffGradedAssignmentMockedTests(TempfileMixin):
                 assert mocked_reset_score.called is True
                 # Clearing the student state should also delete the uploaded file
                 assert self.default_storage.exists(file_path) is False
+
+    @data(True, False)
+    def test_resource_cache(self, cache_enabled):
+        """
+        Resources and compiled templates are loaded once per process unless the cache is disabled
+        """
+        from edx_sga import sga
+        template_path = 'templates/staff_graded_assignment/show.html'
+        sga.clear_resource_cache()
+        with mock.patch(
+            'edx_sga.sga.resource_cache_enabled', return_value=cache_enabled
+        ), mock.patch(
+            'edx_sga.sga.pkg_resources.resource_string', return_value=b'{{ name }} \xc3\xa9'
+        ) as resource_string, mock.patch(
+            'edx_sga.sga.Template', wraps=sga.Template
+        ) as template:
+            for _ in range(3):
+                assert sga.render_template(template_path, {'name': 'sga'}) == u'sga \xe9'
+                assert sga._resource('static/css/edx_sga.css') == u'{{ name }} \xe9'  # pylint: disable=protected-access
+            expected_calls = 2 if cache_enabled else 6
+            assert resource_string.call_count == expected_calls
+            assert template.call_count == (1 if cache_enabled else 3)
+        sga.clear_resource_cache()
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for staging chunked uploads
+"""
+from __future__ import absolute_import
+
+import io
+import os
+import time
+
+import mock
+import pytest
+
+from django.core import signing
+from edx_sga.constants import UPLOAD_LOCK_TIMEOUT
+from edx_sga.uploads import (append_chunk, get_chunked_upload_id, get_direct_upload_target, get_staged_size,
+                             get_staged_upload_path, parse_content_range, remove_stale_uploads,
+                             sign_direct_upload, unsign_direct_upload)
+
+STUDENT_ITEM = {'student_id': 'student', 'course_id': 'org/course/run', 'item_id': 'block', 'item_type': 'sga'}
+
+
+@pytest.fixture
+def staging_dir(settings, tmpdir):
+    """
+    Stages chunked uploads in a temporary directory
+    """
+    settings.SGA_UPLOAD_STAGING_DIR = str(tmpdir.join('staging'))
+    return settings.SGA_UPLOAD_STAGING_DIR
+
+
+def test_get_chunked_upload_id():
+    """
+    Uploads of the same file by the same student to the same block should share their id,
+    and another file with the same name and size should not
+    """
+    upload_id = get_chunked_upload_id(STUDENT_ITEM, 'video.mp4', 1000, '1500000000000')
+    assert upload_id == get_chunked_upload_id(dict(STUDENT_ITEM), 'video.mp4', 1000, '1500000000000')
+    assert upload_id != get_chunked_upload_id(STUDENT_ITEM, 'video.mp4', 1001, '1500000000000')
+    assert upload_id != get_chunked_upload_id(STUDENT_ITEM, 'other.mp4', 1000, '1500000000000')
+    other_student = dict(STUDENT_ITEM, student_id='other')
+    assert upload_id != get_chunked_upload_id(other_student, 'video.mp4', 1000, '1500000000000')
+    assert upload_id != get_chunked_upload_id(STUDENT_ITEM, 'video.mp4', 1000, '1600000000000')
+
+
+@pytest.mark.parametrize('upload_id', ['', '../../etc/passwd', 'A' * 40])
+def test_get_staged_upload_path_invalid(upload_id):
+    """
+    Only upload ids made by get_chunked_upload_id should map to a staging file
+    """
+    with pytest.raises(ValueError):
+        get_staged_upload_path(upload_id)
+
+
+@pytest.mark.parametrize('header,expected', [
+    ('bytes 0-99/1000', (0, 99, 1000)),
+    ('bytes 900-999/1000', (900, 999, 1000)),
+    ('bytes 900-1000/1000', None),
+    ('bytes 100-99/1000', None),
+    ('bytes */1000', None),
+    (None, None),
+])
+def test_parse_content_range(header, expected):
+    """
+    parse_content_range should accept the ranges sent by the upload client and nothing else
+    """
+    if expected is None:
+        with pytest.raises(ValueError):
+            parse_content_range(header)
+    else:
+        assert parse_content_range(header) == expected
+
+
+def test_append_chunk(staging_dir):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    Chunks should be appended in order, and a repeated chunk should be ignored
+    """
+    upload_id = get_chunked_upload_id(STUDENT_ITEM, 'file.txt', 10, '1500000000000')
+    assert get_staged_size(upload_id) == 0
+    assert append_chunk(upload_id, 0, io.BytesIO(b'01234'), 10) == 5
+    assert append_chunk(upload_id, 0, io.BytesIO(b'01234'), 10) == 5
+    assert append_chunk(upload_id, 5, io.BytesIO(b'56789'), 10) == 10
+    with open(get_staged_upload_path(upload_id), 'rb') as staged:
+        assert staged.read() == b'0123456789'
+
+
+def test_append_chunk_too_large(staging_dir):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    An upload going over the size limit should be discarded
+    """
+    upload_id = get_chunked_upload_id(STUDENT_ITEM, 'file.txt', 10, '1500000000000')
+    assert append_chunk(upload_id, 0, io.BytesIO(b'01234'), 8) == 5
+    assert append_chunk(upload_id, 5, io.BytesIO(b'56789'), 8) is None
+    assert not os.path.exists(get_staged_upload_path(upload_id))
+
+
+def test_append_chunk_locked(staging_dir):  # pylint: disable=unused-argument,redefined-outer-name
+    """
+    A chunk should not be appended while another request appends to the upload, unless its lock is dead
+    """
+    upload_id = get_chunked_upload_id(STUDENT_ITEM, 'file.txt', 10, '1500000000000')
+    assert append_chunk(upload_id, 0, io.BytesIO(b'01234'), 10) == 5
+    lock_path = get_staged_upload_path(upload_id) + '.lock'
+    open(lock_path, 'w').close()
+    assert append_chunk(upload_id, 5, io.BytesIO(b'56789'), 10) == 5
+    assert os.path.exists(lock_path)
+
+    past = time.time() - UPLOAD_LOCK_TIMEOUT - 1
+    os.utime(lock_path, (past, past))
+    assert append_chunk(upload_id, 5, io.BytesIO(b'56789'), 10) == 10
+    assert not os.path.exists(lock_path)
+
+
+def test_remove_stale_uploads(settings, staging_dir):  # pylint: disable=redefined-outer-name
+    """
+    Uploads nobody added to for longer than the timeout should be deleted
+    """
+    settings.SGA_UPLOAD_STAGING_TIMEOUT = 60
+    stale_id = get_chunked_upload_id(STUDENT_ITEM, 'stale.txt', 10, '1500000000000')
+    fresh_id = get_chunked_upload_id(STUDENT_ITEM, 'fresh.txt', 10, '1500000000000')
+    append_chunk(stale_id, 0, io.BytesIO(b'01234'), 10)
+    append_chunk(fresh_id, 0, io.BytesIO(b'01234'), 10)
+    stale_lock_path = get_staged_upload_path(stale_id) + '.lock'
+    open(stale_lock_path, 'w').close()
+    past = time.time() - 120
+    os.utime(get_staged_upload_path(stale_id), (past, past))
+    os.utime(stale_lock_path, (past, past))
+
+    remove_stale_uploads()
+    assert os.listdir(staging_dir) == ['{}.part'.format(fresh_id)]
+
+
+def test_sign_direct_upload(settings):
+    """
+    A direct upload token should only be accepted untampered and before it expires
+    """
+    token = sign_direct_upload('org/course/sga/block/file.txt', 'a' * 40, 100)
+    assert unsign_direct_upload(token) == ('org/course/sga/block/file.txt', 'a' * 40, 100)
+    with pytest.raises(signing.BadSignature):
+        unsign_direct_upload(token[:-1] + ('A' if token[-1] != 'A' else 'B'))
+
+    settings.SGA_DIRECT_UPLOAD_EXPIRY = 60
+    with mock.patch('time.time', return_value=time.time() + 120):
+        with pytest.raises(signing.SignatureExpired):
+            unsign_direct_upload(token)
+
+
+def test_get_direct_upload_target():
+    """
+    Storage which cannot sign uploads should get the fallback url and a signed token
+    """
+    target = get_direct_upload_target('org/course/sga/block/file.txt', 'a' * 40, 100, '/handler/direct_upload')
+    assert target['url'] == '/handler/direct_upload'
+    assert unsign_direct_upload(target['fields']['token']) == ('org/course/sga/block/file.txt', 'a' * 40, 100)
+
+
+def test_get_direct_upload_target_s3():
+    """
+    S3 storage should get a presigned POST limited to the maximum size
+    """
+    with mock.patch('edx_sga.uploads.default_storage') as storage:
+        storage.location = 'media'
+        storage.bucket.name = 'bucket'
+        generate_presigned_post = storage.bucket.meta.client.generate_presigned_post
+        generate_presigned_post.return_value = {'url': 'https://bucket.s3.amazonaws.com/', 'fields': {}}
+        target = get_direct_upload_target('org/file.txt', 'a' * 40, 100, '/handler/direct_upload')
+    assert target == generate_presigned_post.return_value
+    generate_presigned_post.assert_called_once_with(
+        'bucket',
+        'media/org/file.txt',
+        Conditions=[['content-length-range', 0, 100]],
+        ExpiresIn=15 * 60,
+    )
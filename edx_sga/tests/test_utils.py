@@ -4,11 +4,41 @@ Tests for SGA utility functions
 """
 from __future__ import absolute_import
 
+import io
+import logging
+import os
+import time
+from functools import partial
+
+import mock
 import pytest
 
 import pytz
-from edx_sga.tests.common import is_near_now
-from edx_sga.utils import is_finalized_submission, utcnow
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from edx_sga.constants import BLOCK_SIZE
+from edx_sga.tests.common import get_sha1, is_near_now
+from edx_sga.utils import (StorageFileIter, copy_and_hash, decode_cursor,
+                           encode_cursor, is_finalized_submission,
+                           save_upload, utcnow)
+
+log = logging.getLogger(__name__)
+
+
+class RemoteReader(io.BytesIO):
+    """
+    In-memory file standing in for remote storage, where every read costs a round trip
+    """
+    latency = 0.0005
+
+    def __init__(self, *args, **kwargs):
+        super(RemoteReader, self).__init__(*args, **kwargs)
+        self.reads = 0
+
+    def read(self, size=-1):  # pylint: disable=arguments-differ
+        time.sleep(self.latency)
+        self.reads += 1
+        return super(RemoteReader, self).read(size)
 
 
 @pytest.mark.parametrize(
@@ -33,3 +63,138 @@ def test_utcnow():
     now = utcnow()
     assert is_near_now(now)
     assert now.tzinfo.zone == pytz.utc.zone
+
+
+def test_cursor_round_trip():
+    """
+    A cursor should decode to the query it was encoded from
+    """
+    query = {'sort_by': 'username', 'order': 'asc', 'offset': 50, 'username': u'fr\xe9d'}
+    assert decode_cursor(encode_cursor(query)) == query
+
+
+@pytest.mark.parametrize('cursor', ['not a cursor', encode_cursor([1, 2])])
+def test_decode_invalid_cursor(cursor):
+    """
+    decode_cursor should raise ValueError for malformed cursors
+    """
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_copy_and_hash():
+    """
+    copy_and_hash should hash and copy a file in one pass, and give up once it is too large
+    """
+    data = b'x' * 100000
+    destination = io.BytesIO()
+    assert copy_and_hash(io.BytesIO(data), len(data), destination) == get_sha1(data)
+    assert destination.getvalue() == data
+
+    source = io.BytesIO(data + b'x' * 1000000)
+    assert copy_and_hash(source, len(data)) is None
+    assert source.tell() < len(data) * 2
+
+
+def test_save_upload(settings, tmpdir):
+    """
+    save_upload should move the upload into place under its hash and leave no staging file behind
+    """
+    settings.DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+    settings.MEDIA_ROOT = str(tmpdir)
+    data = b'some information'
+    sha1 = get_sha1(data)
+
+    def get_path(file_hash):
+        """Storage path of an upload"""
+        return 'org/course/sga/{}.txt'.format(file_hash)
+
+    assert save_upload(io.BytesIO(data), get_path, len(data)) == (sha1, get_path(sha1))
+    with default_storage.open(get_path(sha1)) as stored:
+        assert stored.read() == data
+    with mock.patch('edx_sga.utils.os.rename') as rename:
+        assert save_upload(io.BytesIO(data), get_path, len(data)) == (sha1, get_path(sha1))
+    assert rename.called is False
+
+    assert save_upload(io.BytesIO(data), get_path, len(data) - 1) is None
+    assert sorted(os.listdir(str(tmpdir))) == ['org']
+    assert os.listdir(str(tmpdir.join('org', 'course', 'sga'))) == ['{}.txt'.format(sha1)]
+
+
+def test_save_upload_remote():
+    """
+    On remote storage save_upload should hash the upload and then save it
+    """
+    data = b'some information'
+    sha1 = get_sha1(data)
+    with mock.patch('edx_sga.utils.default_storage') as storage:
+        storage.path.side_effect = NotImplementedError
+        storage.exists.return_value = False
+        assert save_upload(io.BytesIO(data), lambda file_hash: file_hash, len(data)) == (sha1, sha1)
+    storage.save.assert_called_once_with(sha1, mock.ANY)
+    assert storage.save.call_args[0][1].read() == data
+
+
+def test_storage_file_iter(settings, tmpdir):
+    """
+    StorageFileIter should yield a file or a range of it, and close it once read
+    """
+    settings.DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+    settings.MEDIA_ROOT = str(tmpdir)
+    data = os.urandom(300000)
+    path = default_storage.save('file.bin', ContentFile(data))
+
+    body = StorageFileIter(path)
+    assert body.local is True
+    assert b''.join(body) == data
+    assert body.filelike.closed
+
+    body = StorageFileIter(path, 1000, 250000)
+    assert b''.join(body) == data[1000:250000]
+    assert body.filelike.closed
+
+    body = StorageFileIter(path)
+    next(body)
+    body.close()
+    assert body.filelike.closed
+
+
+def test_storage_file_iter_remote():
+    """
+    Reads from remote storage should grow up to the maximum chunk size
+    """
+    data = b'x' * (10 * 2**20)
+    with mock.patch('edx_sga.utils.default_storage') as storage:
+        storage.path.side_effect = NotImplementedError
+        storage.open.return_value = io.BytesIO(data)
+        body = StorageFileIter('file.bin')
+        chunks = [len(chunk) for chunk in body]
+    assert body.local is False
+    assert chunks == [2**16, 2**17, 2**18, 2**19, 2**20, 2**21, 2**22, 10 * 2**20 - (2**23 - 2**16)]
+
+
+def test_storage_file_iter_benchmark():
+    """
+    StorageFileIter should stream a file from remote storage faster than fixed BLOCK_SIZE reads
+    """
+    data = b'x' * (4 * 2**20)
+
+    reader = RemoteReader(data)
+    started = time.time()
+    assert b''.join(iter(partial(reader.read, BLOCK_SIZE), b'')) == data
+    block_seconds, block_reads = time.time() - started, reader.reads
+
+    reader = RemoteReader(data)
+    with mock.patch('edx_sga.utils.default_storage') as storage:
+        storage.path.side_effect = NotImplementedError
+        storage.open.return_value = reader
+        started = time.time()
+        assert b''.join(StorageFileIter('file.bin')) == data
+    iter_seconds, iter_reads = time.time() - started, reader.reads
+
+    log.info(
+        "Streamed %s bytes in %s reads at %.1f MB/s with BLOCK_SIZE, in %s reads at %.1f MB/s with StorageFileIter",
+        len(data), block_reads, len(data) / block_seconds / 2**20, iter_reads, len(data) / iter_seconds / 2**20,
+    )
+    assert iter_reads * 20 < block_reads
+    assert iter_seconds < block_seconds
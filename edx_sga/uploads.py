@@ -0,0 +1,250 @@
+"""
+Staging student submissions which are uploaded in several chunks, and signing direct uploads to storage
+"""
+from __future__ import absolute_import
+
+import errno
+import hashlib
+import json
+import os
+import posixpath
+import re
+import tempfile
+import time
+from functools import partial
+
+from django.conf import settings
+from django.core import signing
+from django.core.files.storage import default_storage
+from edx_sga.constants import (BLOCK_SIZE, DIRECT_UPLOAD_EXPIRY, UPLOAD_CHUNK_SIZE, UPLOAD_LOCK_TIMEOUT,
+                               UPLOAD_STAGING_TIMEOUT)
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{40}$')
+DIRECT_UPLOAD_SALT = 'edx_sga.uploads.direct_upload'
+
+
+def get_upload_chunk_size():
+    """
+    Returns the size in bytes of the chunks a large submission is uploaded in
+    """
+    return getattr(settings, 'SGA_UPLOAD_CHUNK_SIZE', UPLOAD_CHUNK_SIZE)
+
+
+def get_staging_dir():
+    """
+    Returns the directory where chunked uploads are put together. When the LMS runs on several
+    nodes, SGA_UPLOAD_STAGING_DIR must be shared by all of them, since the chunks of an upload
+    may reach different nodes.
+    """
+    return getattr(settings, 'SGA_UPLOAD_STAGING_DIR', None) or os.path.join(tempfile.gettempdir(), 'sga-uploads')
+
+
+def get_chunked_upload_id(student_item_dict, filename, size, last_modified):
+    """
+    Returns the id of a chunked upload. Every attempt of a student to upload the same file to the same
+    block gets the same id, so an interrupted upload can resume where it stopped.
+
+    The last modification time of the file, as told by the browser, is part of the id, so that another
+    file with the same name and size does not resume on top of the bytes received for the first one.
+    """
+    key = json.dumps([
+        student_item_dict['student_id'],
+        student_item_dict['course_id'],
+        student_item_dict['item_id'],
+        filename,
+        size,
+        last_modified,
+    ])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def get_staged_upload_path(upload_id):
+    """
+    Returns the local path of a chunked upload, or raises ValueError for an invalid id
+    """
+    if not UPLOAD_ID_RE.match(upload_id or ''):
+        raise ValueError("Invalid upload id: {}".format(upload_id))
+    return os.path.join(get_staging_dir(), '{}.part'.format(upload_id))
+
+
+def get_staged_size(upload_id):
+    """
+    Returns the number of bytes of a chunked upload received so far
+    """
+    try:
+        return os.path.getsize(get_staged_upload_path(upload_id))
+    except OSError:
+        return 0
+
+
+def parse_content_range(header):
+    """
+    Returns the first byte, last byte and total size from a Content-Range header,
+    or raises ValueError if it is malformed
+    """
+    match = CONTENT_RANGE_RE.match(header or '')
+    if match is None:
+        raise ValueError("Invalid Content-Range: {}".format(header))
+    start, end, total = (int(value) for value in match.groups())
+    if not start <= end < total:
+        raise ValueError("Invalid Content-Range: {}".format(header))
+    return start, end, total
+
+
+def _acquire_staged_upload_lock(upload_id):
+    """
+    Creates the lock file which keeps requests from appending to a chunked upload at the same time.
+    Returns False if another request holds it. A lock older than UPLOAD_LOCK_TIMEOUT is assumed dead
+    and taken over.
+    """
+    lock_path = get_staged_upload_path(upload_id) + '.lock'
+    for _ in range(2):
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        try:
+            if time.time() - os.path.getmtime(lock_path) <= UPLOAD_LOCK_TIMEOUT:
+                return False
+            os.remove(lock_path)
+        except OSError:
+            # Released by its holder in the meantime
+            pass
+    return False
+
+
+def _release_staged_upload_lock(upload_id):
+    """
+    Deletes the lock file of a chunked upload
+    """
+    try:
+        os.remove(get_staged_upload_path(upload_id) + '.lock')
+    except OSError:
+        pass
+
+
+def append_chunk(upload_id, offset, chunk_file, max_size):
+    """
+    Appends a chunk to a chunked upload if it starts where the data received so far ends, and returns the
+    size of the upload afterwards. Returns None, and discards the upload, once it is larger than max_size.
+
+    Appends are serialized with a lock file, and the offset is checked while holding it. While another
+    request appends to the upload, the chunk is not written and the size received so far is returned.
+    """
+    path = get_staged_upload_path(upload_id)
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+    if not _acquire_staged_upload_lock(upload_id):
+        return get_staged_size(upload_id)
+    try:
+        with open(path, 'ab') as staged:
+            staged.seek(0, os.SEEK_END)
+            size = staged.tell()
+            if offset != size:
+                # Most likely a retry of a chunk which was already received, the client resumes from size
+                return size
+            for block in iter(partial(chunk_file.read, BLOCK_SIZE), b''):
+                size += len(block)
+                if size > max_size:
+                    break
+                staged.write(block)
+        if size > max_size:
+            remove_staged_upload(upload_id)
+            return None
+        return size
+    finally:
+        _release_staged_upload_lock(upload_id)
+
+
+def remove_staged_upload(upload_id):
+    """
+    Deletes a chunked upload
+    """
+    try:
+        os.remove(get_staged_upload_path(upload_id))
+    except OSError:
+        pass
+
+
+def remove_stale_uploads():
+    """
+    Deletes chunked uploads which were not added to for longer than SGA_UPLOAD_STAGING_TIMEOUT,
+    along with their leftover lock files
+    """
+    staging_dir = get_staging_dir()
+    timeout = getattr(settings, 'SGA_UPLOAD_STAGING_TIMEOUT', UPLOAD_STAGING_TIMEOUT)
+    try:
+        names = os.listdir(staging_dir)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(staging_dir, name)
+        try:
+            if name.endswith(('.part', '.lock')) and time.time() - os.path.getmtime(path) > timeout:
+                os.remove(path)
+        except OSError:
+            # Finished or removed by another request in the meantime
+            pass
+
+
+def direct_uploads_enabled():
+    """
+    Returns whether browsers upload submission files straight to storage instead of through the LMS
+    """
+    return getattr(settings, 'SGA_DIRECT_UPLOADS', False)
+
+
+def get_direct_upload_expiry():
+    """
+    Returns the number of seconds a signed upload target stays valid
+    """
+    return getattr(settings, 'SGA_DIRECT_UPLOAD_EXPIRY', DIRECT_UPLOAD_EXPIRY)
+
+
+def sign_direct_upload(path, sha1, max_size):
+    """
+    Returns a token allowing to upload a file of at most max_size bytes with the given sha1 to path
+    in default_storage
+    """
+    return signing.dumps(
+        {'path': path, 'sha1': sha1, 'max_size': max_size}, salt=DIRECT_UPLOAD_SALT, compress=True
+    )
+
+
+def unsign_direct_upload(token):
+    """
+    Returns the path, expected sha1 and maximum size of the file a token allows to upload.
+    Raises signing.BadSignature if it was tampered with or has expired.
+    """
+    upload = signing.loads(token, salt=DIRECT_UPLOAD_SALT, max_age=get_direct_upload_expiry())
+    return upload['path'], upload['sha1'], upload['max_size']
+
+
+def get_direct_upload_target(path, sha1, max_size, fallback_url):
+    """
+    Returns the url and form fields of a POST request which uploads a file of at most max_size bytes
+    with the given sha1 to path in default_storage.
+
+    S3 storage gets a presigned POST, so the file never goes through the LMS and its content must be
+    checked once uploaded. Other storage gets fallback_url, which must check the signed token from the
+    form fields with unsign_direct_upload, and the sha1 of the file before storing it.
+    """
+    bucket = getattr(default_storage, 'bucket', None)
+    if bucket is not None:
+        location = getattr(default_storage, 'location', '')
+        return bucket.meta.client.generate_presigned_post(
+            bucket.name,
+            posixpath.join(location, path) if location else path,
+            Conditions=[['content-length-range', 0, max_size]],
+            ExpiresIn=get_direct_upload_expiry(),
+        )
+    return {
+        'url': fallback_url,
+        'fields': {'token': sign_direct_upload(path, sha1, max_size)},
+    }
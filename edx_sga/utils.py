@@ -3,18 +3,23 @@ Utility functions for the SGA XBlock
 """
 from __future__ import absolute_import
 
+import base64
+import binascii
 import datetime
+import errno
 import hashlib
+import json
 import os
-import time
+import tempfile
 from functools import partial
 
 import six
 
 import pytz
 from django.conf import settings
+from django.core.files import File
 from django.core.files.storage import default_storage
-from edx_sga.constants import BLOCK_SIZE
+from edx_sga.constants import BLOCK_SIZE, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_MAX_CHUNK_SIZE
 
 
 def utcnow():
@@ -33,35 +38,71 @@ def is_finalized_submission(submission_data):
     return False
 
 
-def get_file_modified_time_utc(file_path):
+def copy_and_hash(file_descriptor, max_size, destination=None):
     """
-    Gets the UTC timezone-aware modified time of a file at the given file path
-    """
-    file_timezone = (
-        # time.tzname returns a 2 element tuple:
-        #   (local non-DST timezone, e.g.: 'EST', local DST timezone, e.g.: 'EDT')
-        pytz.timezone(time.tzname[0])
-        if settings.DEFAULT_FILE_STORAGE == 'django.core.files.storage.FileSystemStorage'
-        else pytz.utc
-    )
-    return file_timezone.localize(
-        default_storage.modified_time(file_path)
-    ).astimezone(
-        pytz.utc
-    )
-
-
-def get_sha1(file_descriptor):
-    """
-    Get file hex digest (fingerprint).
+    Get file hex digest (fingerprint) in a single pass, copying the file to destination along the way.
+    Returns None as soon as more than max_size bytes have been read.
     """
     sha1 = hashlib.sha1()
+    size = 0
     for block in iter(partial(file_descriptor.read, BLOCK_SIZE), b''):
+        size += len(block)
+        if size > max_size:
+            return None
         sha1.update(block)
-    file_descriptor.seek(0)
+        if destination is not None:
+            destination.write(block)
     return sha1.hexdigest()
 
 
+def save_upload(file_descriptor, get_path, max_size):
+    """
+    Saves an uploaded file to default_storage at get_path(sha1), unless a file is already stored there.
+
+    On local storage the upload is read once: it is hashed while being copied next to its destination,
+    then renamed into place. On remote storage it is hashed first and then saved.
+
+    Returns the hex digest and storage path of the file, or None if it is larger than max_size.
+    """
+    try:
+        root = default_storage.path('')
+    except NotImplementedError:
+        root = None
+
+    if root is None:
+        sha1 = copy_and_hash(file_descriptor, max_size)
+        if sha1 is None:
+            return None
+        path = get_path(sha1)
+        if not default_storage.exists(path):
+            file_descriptor.seek(0)
+            default_storage.save(path, File(file_descriptor))
+        return sha1, path
+
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    staged_fd, staged_path = tempfile.mkstemp(prefix='.upload-', dir=root)
+    try:
+        with os.fdopen(staged_fd, 'wb') as staged:
+            sha1 = copy_and_hash(file_descriptor, max_size, staged)
+        if sha1 is None:
+            return None
+        path = get_path(sha1)
+        if not default_storage.exists(path):
+            full_path = default_storage.path(path)
+            try:
+                os.makedirs(os.path.dirname(full_path))
+            except OSError as ex:
+                if ex.errno != errno.EEXIST:
+                    raise
+            os.chmod(staged_path, getattr(default_storage, 'file_permissions_mode', None) or 0o644)
+            os.rename(staged_path, full_path)
+        return sha1, path
+    finally:
+        if os.path.exists(staged_path):
+            os.remove(staged_path)
+
+
 def get_file_storage_path(locator, file_hash, original_filename):
     """
     Returns the file path for an uploaded SGA submission file
@@ -86,9 +127,74 @@ def get_file_storage_path(locator, file_hash, original_filename):
         )
 
 
-def file_contents_iter(file_path):
+def get_local_path(file_path):
     """
-    Returns an iterator over the contents of a file located at the given file path
+    Returns the local filesystem path of a file in default_storage, or None for remote storage
     """
-    file_descriptor = default_storage.open(file_path)
-    return iter(partial(file_descriptor.read, BLOCK_SIZE), b'')
+    try:
+        return default_storage.path(file_path)
+    except NotImplementedError:
+        return None
+
+
+class StorageFileIter(six.Iterator):
+    """
+    Iterates over the contents of a file in default_storage, or over the bytes from start up to stop.
+
+    The file is closed once it has been read, or when the WSGI server closes the response body.
+    Local files are read in DOWNLOAD_CHUNK_SIZE blocks. Reads from remote storage double in size
+    up to SGA_DOWNLOAD_MAX_CHUNK_SIZE, so large files take few requests without delaying the first bytes.
+    """
+    def __init__(self, file_path, start=0, stop=None):
+        self.local = get_local_path(file_path) is not None
+        self.filelike = default_storage.open(file_path, 'rb')
+        if start:
+            self.filelike.seek(start)
+        self.remaining = None if stop is None else stop - start
+        self.chunk_size = DOWNLOAD_CHUNK_SIZE
+        self.max_chunk_size = (
+            DOWNLOAD_CHUNK_SIZE if self.local
+            else getattr(settings, 'SGA_DOWNLOAD_MAX_CHUNK_SIZE', DOWNLOAD_MAX_CHUNK_SIZE)
+        )
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        size = self.chunk_size if self.remaining is None else min(self.chunk_size, self.remaining)
+        data = self.filelike.read(size) if size > 0 else b''
+        if not data:
+            self.close()
+            raise StopIteration
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        self.chunk_size = min(self.chunk_size * 2, self.max_chunk_size)
+        return data
+
+    def close(self):
+        """
+        Closes the file
+        """
+        self.filelike.close()
+
+
+def encode_cursor(query):
+    """
+    Returns an opaque, URL-safe pagination cursor encoding the given query dict
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps(query, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    ).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Returns the query dict encoded in a pagination cursor, or raises ValueError if it is malformed
+    """
+    try:
+        query = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError("Invalid cursor: {}".format(cursor))
+    if not isinstance(query, dict):
+        raise ValueError("Invalid cursor: {}".format(cursor))
+    return query